@@ -1,13 +1,21 @@
+import hmac
 import os
 from fastapi import FastAPI, Request
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 
 from telebot import types as tg_types
 
 from loader import bot
 from bot import register_all_handlers
-from config import TELEGRAM_WEBHOOK_BASE, TELEGRAM_WEBHOOK_PATH
+from config import (
+    TELEGRAM_WEBHOOK_BASE,
+    TELEGRAM_WEBHOOK_PATH,
+    NANOBANANA_CALLBACK_PATH,
+    NANOBANANA_CALLBACK_SECRET,
+)
+from services.nanobanana_client import resolve_callback
 
 # Миниап backend (твой router)
 from web.backend import router as kling_router
@@ -30,6 +38,23 @@ def on_startup():
     Включаем webhook.
     ВАЖНО: на Render НЕ запускаем polling, иначе будет 409 Conflict.
     """
+    # Фоновый опрос очереди NanoBanana
+    from task_worker import start_background_worker
+    start_background_worker()
+
+    # Периодическая сверка счётчиков админ-панели
+    from services.admin_stats import start_stats_reconciler
+    start_stats_reconciler()
+
+    # Последний обработанный update_id — заранее, не в первом апдейте
+    bot.dedup.restore()
+
+    # Данные бота (username для ссылок) — один раз при старте
+    try:
+        bot.refresh_identity()
+    except Exception as e:
+        print(f"⚠️ get_me failed: {e}")
+
     if not TELEGRAM_WEBHOOK_BASE:
         # Если не задано — бот НЕ сможет получать апдейты
         print("⚠️ TELEGRAM_WEBHOOK_BASE is empty. Set it in Render Env.")
@@ -55,8 +80,104 @@ def index():
 async def telegram_webhook(request: Request):
     """
     Telegram будет слать сюда апдейты.
+    Апдейт только ставим в очередь (loader.bot.dispatcher) и сразу отвечаем —
+    хендлеры выполняются в пуле потоков, event loop не блокируется
+    (enqueue_update тоже вызываем в пуле: отсев повторов читает SQLite).
     """
     data = await request.json()
     update = tg_types.Update.de_json(data)
-    bot.process_new_updates([update])
-    return {"ok": True}
\ No newline at end of file
+
+    # отсев повторов ходит в SQLite — не в потоке event loop
+    if not await run_in_threadpool(bot.enqueue_update, update):
+        # очередь переполнена — Telegram повторит доставку позже
+        return JSONResponse({"ok": False}, status_code=503)
+    return {"ok": True}
+
+
+@app.get("/metrics/dispatcher")
+def dispatcher_metrics():
+    """
+    Глубина очереди апдейтов, время ожидания / обработки и отсеянные повторы.
+    """
+    stats = bot.dispatcher.stats()
+    stats["dedup"] = bot.dedup.stats()
+    return stats
+
+
+@app.get("/metrics/admission")
+def admission_metrics():
+    """
+    Очереди к NanoBanana / Kling: сколько ждут, сколько в работе, время ожидания.
+    """
+    from services.admission import nanobanana_gate, kling_gate
+    return {
+        "nanobanana": nanobanana_gate.stats(),
+        "kling": kling_gate.stats(),
+    }
+
+
+@app.get("/metrics/worker")
+def worker_metrics():
+    """
+    Фоновый опрос NanoBanana: циклы, задачи в работе, время опроса и отставание.
+    """
+    from task_worker import worker_stats
+    return worker_stats()
+
+
+@app.get("/metrics/prompt-cache")
+def prompt_cache_metrics():
+    """
+    Кэш TEXT -> IMAGE: попадания / промахи / hit rate (и включён ли он).
+    """
+    from services.prompt_cache import prompt_cache_stats
+    return prompt_cache_stats()
+
+
+@app.get("/metrics/media")
+def media_metrics():
+    """
+    Кэши медиа: задачи анимации, пути файлов Telegram, file_id при отправке.
+    """
+    from utils.tasks import animation_tasks_stats
+    from services.telegram_files import file_cache_stats
+    from services.telegram_delivery import delivery_stats
+    return {
+        "animation_tasks": animation_tasks_stats(),
+        "telegram_files": file_cache_stats(),
+        "delivery": delivery_stats(),
+    }
+
+
+@app.get("/metrics/providers")
+def provider_metrics():
+    """
+    Повторы, сбои, состояние circuit breaker и переиспользование соединений.
+    """
+    from services.http_resilience import providers_stats
+    from services.http_pool import pool_stats
+    return {
+        "resilience": providers_stats(),
+        "connections": pool_stats(),
+    }
+
+
+@app.post(NANOBANANA_CALLBACK_PATH)
+async def nanobanana_callback(request: Request):
+    """
+    NanoBanana сообщает сюда о готовности задачи (callBackUrl).
+    Будим того, кто ждёт этот taskId; результат он сам проверит через
+    /record-info. Без настроенного секрета коллбэки не принимаем.
+    """
+    secret = request.query_params.get("secret") or ""
+    if not NANOBANANA_CALLBACK_SECRET or not hmac.compare_digest(secret.encode(), NANOBANANA_CALLBACK_SECRET.encode()):
+        return JSONResponse({"ok": False}, status_code=403)
+
+    try:
+        body = await request.json()
+    except Exception:
+        return JSONResponse({"ok": False}, status_code=400)
+
+    task_id = resolve_callback(body)
+    print(f"[NanoBanana] callback: taskId={task_id}")
+    return {"ok": True}
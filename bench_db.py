@@ -0,0 +1,133 @@
+# bench_db.py
+#
+# Бенчмарк services/db.py: ops/sec под 50 параллельными "хендлерами".
+#
+# "До"    — как было: новое sqlite3.connect() на каждый вызов, обычный журнал.
+# "После" — пул соединений services/db.py (одно на поток, WAL, synchronous=NORMAL).
+#
+# Одна операция = набор запросов, как при открытии /profile:
+#   ensure_user + get_token_balance + get_auto_renew + set_token_balance
+#
+# Запуск:
+#   python bench_db.py
+
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+THREADS = 50
+OPS_PER_THREAD = 200
+
+_tmp_dir = tempfile.mkdtemp(prefix="chudo_bench_")
+os.environ["CHUDO_DB_PATH"] = os.path.join(_tmp_dir, "pooled.db")
+
+from services import db  # noqa: E402  (DB_PATH берётся из env при импорте)
+
+LEGACY_DB_PATH = os.path.join(_tmp_dir, "legacy.db")
+
+
+# ================================
+# 📌 "До": соединение на каждый вызов
+# ================================
+def _legacy_conn():
+    conn = sqlite3.connect(LEGACY_DB_PATH, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _legacy_init():
+    conn = _legacy_conn()
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, created_at TEXT, referrer_id INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS tokens (user_id INTEGER PRIMARY KEY, balance INTEGER DEFAULT 0)")
+    conn.execute("CREATE TABLE IF NOT EXISTS auto_renew (user_id INTEGER PRIMARY KEY, tariff_key TEXT, status INTEGER DEFAULT 1)")
+    conn.commit()
+    conn.close()
+
+
+def _legacy_profile_op(user_id):
+    conn = _legacy_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
+    if not cur.fetchone():
+        cur.execute("INSERT INTO users (user_id, created_at) VALUES (?, ?)",
+                    (user_id, datetime.utcnow().isoformat()))
+        cur.execute("INSERT INTO tokens (user_id, balance) VALUES (?, 0)", (user_id,))
+        conn.commit()
+    conn.close()
+
+    conn = _legacy_conn()
+    row = conn.execute("SELECT balance FROM tokens WHERE user_id=?", (user_id,)).fetchone()
+    conn.close()
+    balance = row["balance"] if row else 0
+
+    conn = _legacy_conn()
+    conn.execute("SELECT * FROM auto_renew WHERE user_id=?", (user_id,)).fetchone()
+    conn.close()
+
+    conn = _legacy_conn()
+    conn.execute("UPDATE tokens SET balance=? WHERE user_id=?", (balance + 1, user_id))
+    conn.commit()
+    conn.close()
+
+
+# ================================
+# 📌 "После": пул services/db.py
+# ================================
+def _pooled_profile_op(user_id):
+    db.ensure_user(user_id)
+    balance = db.get_token_balance(user_id)
+    db.get_auto_renew(user_id)
+    db.set_token_balance(user_id, balance + 1)
+
+
+# ================================
+# 📌 Прогон
+# ================================
+def _run(op) -> float:
+    errors = []
+
+    def worker(idx):
+        try:
+            for i in range(OPS_PER_THREAD):
+                op(idx * 1000 + i % 20)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(THREADS)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        print(f"⚠️ Ошибок: {len(errors)} (первая: {errors[0]})")
+
+    return THREADS * OPS_PER_THREAD / elapsed
+
+
+def main():
+    _legacy_init()
+
+    print(f"Потоков: {THREADS}, операций на поток: {OPS_PER_THREAD}")
+    print(f"SQLite {sqlite3.sqlite_version}, Python {sys.version.split()[0]}")
+
+    before = _run(_legacy_profile_op)
+    print(f"До (connect на каждый вызов): {before:,.0f} ops/sec")
+
+    after = _run(_pooled_profile_op)
+    print(f"После (пул + WAL):           {after:,.0f} ops/sec")
+
+    print(f"Ускорение: x{after / before:.1f}")
+
+    db.close_all_conns()
+
+
+if __name__ == "__main__":
+    main()
@@ -99,6 +99,21 @@ def main():
     # Регистрируем все обработчики
     register_all_handlers()
 
+    # Фоновый опрос очереди NanoBanana
+    from task_worker import start_background_worker
+    start_background_worker()
+
+    # Периодическая сверка счётчиков админ-панели
+    from services.admin_stats import start_stats_reconciler
+    start_stats_reconciler()
+
+    # Данные бота (username для ссылок) — один раз при старте;
+    # не вышло — bot.user запросит их позже сам
+    try:
+        bot.refresh_identity()
+    except Exception as e:
+        print(f"⚠️ get_me failed: {e}")
+
     # На всякий случай отключаем вебхук, чтобы polling не конфликтовал
     try:
         bot.remove_webhook()
@@ -17,6 +17,18 @@ TELEGRAM_WEBHOOK_BASE = os.getenv("TELEGRAM_WEBHOOK_BASE", "").rstrip("/")
 # Путь вебхука (можно оставить дефолт)
 TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/tg/webhook")
 
+# Обработка апдейтов (utils/dispatcher.py):
+# сколько дорожек (потоков; чат всегда на одной дорожке)
+# и сколько апдейтов всего может ждать в очередях
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32"))
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "1000"))
+
+# Где хранится состояние диалогов (utils/state_store.py):
+#   memory — в памяти процесса (TTL + лимит записей)
+#   sqlite — в общей базе, видно всем процессам и переживает рестарт
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_MAX_ITEMS = int(os.getenv("STATE_MAX_ITEMS", "100000"))
+
 # ============================
 # OPENAI
 # ============================
@@ -32,6 +44,30 @@ NANOBANANA_BASE_URL = os.getenv(
 ).rstrip("/")
 NANOBANANA_MODEL = os.getenv("NANOBANANA_MODEL", "nano-banana-pro")
 
+# Допуск к NanoBanana (services/admission.py):
+# сколько генераций одновременно (слот занят до готового результата,
+# а не только на создании задачи) и сколько новых задач в секунду
+NANOBANANA_MAX_CONCURRENCY = int(os.getenv("NANOBANANA_MAX_CONCURRENCY", "20"))
+NANOBANANA_RATE_PER_SEC = float(os.getenv("NANOBANANA_RATE_PER_SEC", "2"))
+
+# Кэш результатов TEXT -> IMAGE по одинаковому промпту (services/prompt_cache.py).
+# Выключен по умолчанию: включайте, если одинаковые "шаблонные" промпты
+# часто повторяются и один и тот же результат всем подходит.
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "0") == "1"
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", str(6 * 3600)))
+PROMPT_CACHE_MAX_ITEMS = int(os.getenv("PROMPT_CACHE_MAX_ITEMS", "5000"))
+
+# Коллбэк о готовности задачи (POST от NanoBanana в app.py).
+# Если URL не задан и нет TELEGRAM_WEBHOOK_BASE (polling-режим) —
+# коллбэков нет, работаем обычным опросом /record-info.
+NANOBANANA_CALLBACK_PATH = os.getenv("NANOBANANA_CALLBACK_PATH", "/nb/callback")
+NANOBANANA_CALLBACK_URL = os.getenv("NANOBANANA_CALLBACK_URL", "").rstrip("/") or (
+    f"{TELEGRAM_WEBHOOK_BASE}{NANOBANANA_CALLBACK_PATH}" if TELEGRAM_WEBHOOK_BASE else ""
+)
+# Секрет добавляется в URL коллбэка как ?secret=...; без него коллбэки
+# выключены (эндпоинт отвечает 403), работаем опросом /record-info
+NANOBANANA_CALLBACK_SECRET = os.getenv("NANOBANANA_CALLBACK_SECRET", "")
+
 # ============================
 # Kling (JWT auth)
 # ============================
@@ -39,6 +75,11 @@ KLING_ACCESS_KEY = os.getenv("KLING_ACCESS_KEY")
 KLING_SECRET_KEY = os.getenv("KLING_SECRET_KEY")
 KLING_API_BASE_URL = os.getenv("KLING_API_BASE_URL", "https://api.klingai.com").rstrip("/")
 
+# Допуск к Kling: одновременные задачи (от создания до передачи
+# наблюдателю kling_worker) и новых задач в секунду
+KLING_MAX_CONCURRENCY = int(os.getenv("KLING_MAX_CONCURRENCY", "4"))
+KLING_RATE_PER_SEC = float(os.getenv("KLING_RATE_PER_SEC", "1"))
+
 # ============================
 # Payments
 # ============================
@@ -15,6 +15,7 @@
 from telebot import types
 from services.db import get_conn
 from services.billing import get_user_tariff
+from services.admin_stats import collect_admin_stats
 
 ADMIN_ID = 13502816  # твой ID
 
@@ -180,61 +181,5 @@ def register_admin_handlers(bot):
 # 🔍 Сбор статистики
 # ================================================
 def _collect_stats():
-    conn = get_conn()
-    cur = conn.cursor()
-
-    # пользователи
-    cur.execute("SELECT COUNT(*) FROM users")
-    users = cur.fetchone()[0]
-
-    # покупки
-    cur.execute("SELECT COUNT(*) FROM purchases")
-    purchases_total = cur.fetchone()[0]
-
-    # покупки за сегодня
-    cur.execute("SELECT COUNT(*) FROM purchases WHERE date(created_at)=date('now')")
-    purchases_today = cur.fetchone()[0]
-
-    # использованные промокоды
-    cur.execute("SELECT COUNT(*) FROM user_promo_usage")
-    promocodes_used = cur.fetchone()[0]
-
-    # тарифы
-    cur.execute("SELECT COUNT(*) FROM purchases WHERE tariff_key='start'")
-    tariff_start = cur.fetchone()[0]
-
-    cur.execute("SELECT COUNT(*) FROM purchases WHERE tariff_key='pro'")
-    tariff_pro = cur.fetchone()[0]
-
-    cur.execute("SELECT COUNT(*) FROM purchases WHERE tariff_key='max'")
-    tariff_max = cur.fetchone()[0]
-
-    # рефералы
-    cur.execute("SELECT COUNT(DISTINCT referrer_id) FROM referrals")
-    ref_users = cur.fetchone()[0]
-
-    cur.execute("SELECT SUM(reward_referrer) FROM referrals")
-    ref_bonus_total = cur.fetchone()[0] or 0
-
-    # токены
-    cur.execute("SELECT SUM(balance) FROM tokens")
-    tokens_total = cur.fetchone()[0] or 0
-
-    cur.execute("SELECT AVG(balance) FROM tokens")
-    avg_balance = int(cur.fetchone()[0] or 0)
-
-    conn.close()
-
-    return {
-        "users": users,
-        "purchases_total": purchases_total,
-        "purchases_today": purchases_today,
-        "promocodes_used": promocodes_used,
-        "tariff_start": tariff_start,
-        "tariff_pro": tariff_pro,
-        "tariff_max": tariff_max,
-        "ref_users": ref_users,
-        "ref_bonus_total": ref_bonus_total,
-        "tokens_added_total": tokens_total,
-        "avg_balance": avg_balance,
-    }
+    # готовые счётчики (services/admin_stats.py), без сканирования таблиц
+    return collect_admin_stats()
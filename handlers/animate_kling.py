@@ -1,11 +1,17 @@
 # handlers/animate_kling.py
 #
 # Анимация Kling — один статус + "анимация загрузки" + ссылка на видео в полном качестве ✨
+# Хендлер только ставит задачу в очередь к Kling (services/admission.py) и
+# сразу освобождается; создание задачи идёт в пуле Kling, когда подойдёт
+# очередь (тогда же списывается лимит), а опрос статуса и отправку видео
+# делает фоновый наблюдатель kling_worker.py.
 
-import time
 from telebot import types
-from services.billing import consume_tokens_or_limit, format_usage_left_message
-from services.kling_service import create_kling_image_to_video, get_kling_task_status
+from services.billing import can_use_animation, consume_tokens_or_limit
+from services.kling_service import create_kling_image_to_video
+from services.admission import kling_gate, queue_position_notifier, queue_timeout_notifier
+from services.telegram_files import prefetch_file, resolve_file_url
+from kling_worker import add_kling_job
 
 MENU_BUTTONS = [
     "🖼 Создать картинку по описанию",
@@ -35,8 +41,9 @@ def register_kling_animation_handlers(bot):
             bot.send_message(chat_id, "Ты вышел из режима анимации.")
             return
 
-        # Проверяем лимит на анимации
-        if not consume_tokens_or_limit(user_id, mode="animation"):
+        # Проверяем лимит на анимации (спишем, когда подойдёт очередь к Kling)
+        ok, _ = can_use_animation(user_id)
+        if not ok:
             bot.send_message(
                 chat_id,
                 "⚠️ Похоже, лимит на анимации закончился.\n\n"
@@ -59,9 +66,8 @@ def register_kling_animation_handlers(bot):
             bot.register_next_step_handler(message, receive_image)
             return
 
-        # Получаем URL файла
-        file_info = bot.get_file(file_id)
-        image_url = f"https://api.telegram.org/file/bot{bot.token}/{file_info.file_path}"
+        # Ссылку на файл получаем в фоне, пока пользователь пишет описание
+        prefetch_file(bot, file_id)
 
         bot.send_message(
             chat_id,
@@ -74,10 +80,10 @@ def register_kling_animation_handlers(bot):
 
         bot.register_next_step_handler(
             message,
-            lambda msg: process_prompt(msg, image_url)
+            lambda msg: process_prompt(msg, file_id)
         )
 
-    def process_prompt(message: types.Message, image_url: str):
+    def process_prompt(message: types.Message, file_id: str):
         chat_id = message.chat.id
         user_id = message.from_user.id
 
@@ -92,168 +98,47 @@ def register_kling_animation_handlers(bot):
                 chat_id,
                 "Напиши, пожалуйста, хотя бы пару слов — как должна двигаться картинка 🙂"
             )
-            bot.register_next_step_handler(message, lambda msg: process_prompt(msg, image_url))
-            return
-
-        # Пытаемся создать задачу в Kling
-        try:
-            task_id = create_kling_image_to_video(prompt=prompt, image_url=image_url)
-        except Exception as e:
-            bot.send_message(
-                chat_id,
-                f"Что-то пошло не так при запуске анимации 😔\n"
-                f"Текст ошибки: {e}"
-            )
+            bot.register_next_step_handler(message, lambda msg: process_prompt(msg, file_id))
             return
 
-        # Одно статусное сообщение, которое будем редактировать
+        # Одно статусное сообщение — пока ждём допуска к Kling, в нём место
+        # в очереди, дальше его обновляет kling_worker
         status_msg = bot.send_message(
             chat_id,
             "🪄 Я отправил твою картинку в волшебную очередь...\n"
             "Чуть-чуть терпения ✨"
         )
 
-        # Кадры для "анимации загрузки"
-        submitted_frames = [
-            "🪄 Твоя картинка в волшебной очереди\n\nЖдём её звёздной минуты ✨",
-            "🪄 Твоя картинка в волшебной очереди.\n\nЖдём её звёздной минуты ✨",
-            "🪄 Твоя картинка в волшебной очереди..\n\nЖдём её звёздной минуты ✨",
-            "🪄 Твоя картинка в волшебной очереди...\n\nЖдём её звёздной минуты ✨",
-        ]
-
-        processing_frames = [
-            "✨ Волшебники уже колдуют над твоей картинкой\n\nВнутри всё начинает оживать 🪄",
-            "✨ Волшебники уже колдуют над твоей картинкой.\n\nВнутри всё начинает оживать 🪄",
-            "✨ Волшебники уже колдуют над твоей картинкой..\n\nВнутри всё начинает оживать 🪄",
-            "✨ Волшебники уже колдуют над твоей картинкой...\n\nВнутри всё начинает оживать 🪄",
-        ]
-
-        submitted_idx = 0
-        processing_idx = 0
-
-        max_attempts = 40
-        delay = 6
-
-        for _ in range(max_attempts):
-            try:
-                status, video_url = get_kling_task_status(task_id)
-            except Exception as e:
-                try:
-                    bot.edit_message_text(
-                        f"😔 Не получилось узнать, как там наша анимация.\n"
-                        f"Ошибка: {e}",
-                        chat_id,
-                        status_msg.message_id,
-                    )
-                except Exception:
-                    bot.send_message(
-                        chat_id,
-                        f"😔 Не получилось узнать, как там наша анимация.\nОшибка: {e}"
-                    )
-                return
-
-            status = (status or "").lower()
-            print("Kling status:", status)
-
-            # Очередь — крутим анимацию ожидания
-            if status in ("submitted", "queued", "pending", "unknown"):
-                frame = submitted_frames[submitted_idx % len(submitted_frames)]
-                submitted_idx += 1
-                try:
-                    bot.edit_message_text(frame, chat_id, status_msg.message_id)
-                except Exception:
-                    pass
-
-            # Обработка — крутим анимацию "волшебники колдуют"
-            elif status in ("processing", "running"):
-                frame = processing_frames[processing_idx % len(processing_frames)]
-                processing_idx += 1
-                try:
-                    bot.edit_message_text(frame, chat_id, status_msg.message_id)
-                except Exception:
-                    pass
-
-            # Успех — видео готово
-            elif status in ("succeed", "success", "completed"):
-                try:
-                    bot.edit_message_text(
-                        "🎞 Готово! Загружаю твоё волшебное видео... ✨",
-                        chat_id,
-                        status_msg.message_id,
-                    )
-                except Exception:
-                    pass
-
-                if not video_url:
-                    bot.send_message(
-                        chat_id,
-                        "Видео вроде бы готово, но я не смог найти ссылку на него 😔"
-                    )
-                    return
-
-                caption_html = (
-                    "🎞 Готово! Вот твоё маленькое волшебное видео ✨\n\n"
-                    f"🔗 <a href=\"{video_url}\">Видео в полном качестве</a>"
-                )
-
-                # Пытаемся отправить как видео с подписью и ссылкой
-                try:
-                    bot.send_video(
-                        chat_id,
-                        video_url,
-                        caption=caption_html,
-                        parse_mode="HTML",
-                    )
-                except Exception:
-                    # Если не получилось как видео — хотя бы текст с кликабельной ссылкой
-                    bot.send_message(
-                        chat_id,
-                        caption_html,
-                        parse_mode="HTML",
-                    )
-
-                # Показываем остаток лимита
-                try:
-                    bot.send_message(
-                        chat_id,
-                        format_usage_left_message(user_id),
-                        parse_mode="Markdown",
-                    )
-                except Exception:
-                    pass
-
-                return
-
-            # Ошибка/провал
-            elif status in ("failed", "error"):
-                try:
-                    bot.edit_message_text(
-                        "😔 Волшебная машина анимации не справилась.\n"
-                        "Попробуй ещё раз позже или с другой картинкой.",
-                        chat_id,
-                        status_msg.message_id,
-                    )
-                except Exception:
-                    bot.send_message(
-                        chat_id,
-                        "😔 Волшебная машина анимации не справилась.\n"
-                        "Попробуй ещё раз позже или с другой картинкой."
-                    )
-                return
-
-            time.sleep(delay)
+        kling_gate.submit(
+            user_id,
+            lambda: _start_animation(chat_id, user_id, file_id, prompt, status_msg.message_id),
+            on_position=queue_position_notifier(bot, chat_id, status_msg.message_id),
+            on_timeout=queue_timeout_notifier(bot, chat_id, status_msg.message_id),
+        )
 
-        # Таймаут — слишком долго не получили результат
-        try:
-            bot.edit_message_text(
-                "⏳ Сегодня волшебники слишком заняты, и мы не дождались видео вовремя.\n"
-                "Попробуй ещё раз немного позже 🪄",
+    def _start_animation(chat_id, user_id, file_id, prompt, status_message_id):
+        """
+        Выполняется в пуле Kling после допуска: списание лимита и создание
+        задачи; дальше её ведёт kling_worker.
+        """
+        if not consume_tokens_or_limit(user_id, mode="animation"):
+            bot.send_message(
                 chat_id,
-                status_msg.message_id,
+                "⚠️ Похоже, лимит на анимации закончился.\n\n"
+                "Загляни в «👤 Мой тариф и баланс», чтобы пополнить магию ✨"
             )
-        except Exception:
+            return
+
+        # Пытаемся создать задачу в Kling
+        try:
+            image_url = resolve_file_url(bot, file_id)
+            task_id = create_kling_image_to_video(prompt=prompt, image_url=image_url)
+        except Exception as e:
             bot.send_message(
                 chat_id,
-                "⏳ Сегодня волшебники слишком заняты, и мы не дождались видео вовремя.\n"
-                "Попробуй ещё раз немного позже 🪄",
-            )
\ No newline at end of file
+                f"Что-то пошло не так при запуске анимации 😔\n"
+                f"Текст ошибки: {e}"
+            )
+            return
+
+        add_kling_job(task_id, chat_id, user_id, status_message_id, kind="image2video")
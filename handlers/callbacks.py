@@ -2,6 +2,7 @@ from telebot import types
 from loader import bot   # берём bot из loader.py
 from utils.tasks import get_task
 from services.kling_service import animate_image
+from services.admission import kling_gate
 
 
 def register_callback_handlers():
@@ -26,25 +27,30 @@ def register_callback_handlers():
 
         bot.answer_callback_query(call.id, "✨ Создаю видео из описания...")
 
+        # видео создаётся минутами — в пуле Kling, не в потоке хендлера
+        chat_id = call.message.chat.id
+        kling_gate.submit(call.from_user.id, lambda: _animate(chat_id, prompt))
+
+    def _animate(chat_id, prompt):
         try:
             video_url = animate_image(prompt)
         except Exception as e:
             bot.send_message(
-                call.message.chat.id,
+                chat_id,
                 f"Не удалось создать видео 😔\nОшибка: {e}"
             )
             return
 
         # Отправляем результат
         bot.send_message(
-            call.message.chat.id,
+            chat_id,
             "Готово! 🎞 Я создал анимацию по этому описанию:"
         )
-        bot.send_message(call.message.chat.id, f"📝 {prompt}")
+        bot.send_message(chat_id, f"📝 {prompt}")
 
         # Если Kling вернул HTTP-URL — TeleBot умеет отправлять его напрямую
         bot.send_video(
-            call.message.chat.id,
+            chat_id,
             video=video_url,
             caption="✨ Вот твоё видео от Kling"
         )
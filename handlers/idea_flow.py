@@ -13,6 +13,8 @@ from services.billing import (
     register_image_usage,
     format_usage_left_message,
 )
+from services.telegram_delivery import send_photo_bytes
+from services.admission import nanobanana_gate, queue_position_notifier, queue_timeout_notifier
 
 
 def register_idea_handlers(bot):
@@ -49,8 +51,17 @@ def register_idea_handlers(bot):
             return
 
         bot.send_chat_action(chat_id, "upload_photo")
-        bot.send_message(chat_id, "✨ Создаю изображение, подожди немного…")
+        status_msg = bot.send_message(chat_id, "✨ Создаю изображение, подожди немного…")
 
+        # генерация — в пуле NanoBanana, поток хендлера не ждём
+        nanobanana_gate.submit(
+            user_id,
+            lambda: _generate(chat_id, user_id, prompt),
+            on_position=queue_position_notifier(bot, chat_id, status_msg.message_id),
+            on_timeout=queue_timeout_notifier(bot, chat_id, status_msg.message_id),
+        )
+
+    def _generate(chat_id, user_id, prompt):
         try:
             # generate_image должна вернуть байты готовой картинки
             image_bytes = generate_image(prompt)
@@ -66,7 +77,8 @@ def register_idea_handlers(bot):
         register_image_usage(user_id)
 
         # отправляем картинку
-        bot.send_photo(
+        send_photo_bytes(
+            bot,
             chat_id,
             image_bytes,
             caption="Готово! ✨\n\n" + format_usage_left_message(user_id),
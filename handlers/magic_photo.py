@@ -17,6 +17,13 @@
 # Ссылки на оригинал скрыты в HTML-гиперссылке:
 # 🔗 <a href="URL">Оригинал в полном разрешении</a>
 #
+# Картинку сами не скачиваем: отдаём Telegram URL результата
+# (services/telegram_delivery.py), при неудаче — стримим через себя.
+#
+# Сама генерация идёт не в потоке хендлера, а в пуле NanoBanana
+# (services/admission.py): хендлер проверяет лимит, ставит задачу в очередь
+# и сразу освобождается. Лимит списывается, когда очередь подошла.
+#
 # Дополнительно:
 # - при генерации и обработке есть одно "статусное" сообщение,
 #   которое обновляется (как у анимации Kling), но без лишних наворотов,
@@ -28,13 +35,18 @@ from services.nanobanana_service import (
     generate_image_from_url,
     generate_scene_from_urls,
 )
-from services.billing import consume_tokens_or_limit, format_usage_left_message
+from services.billing import can_use_image, consume_tokens_or_limit, format_usage_left_message
+from services.admission import nanobanana_gate, queue_position_notifier, queue_timeout_notifier
+from services.telegram_delivery import send_photo_from_url
+from services.telegram_files import prefetch_file, resolve_file_urls
+from utils.state_store import make_state_store
 
-# Настройки пользователей
-user_aspect_ratio = {}   # user_id -> "1:1" / "9:16" / "16:9" / "3:4"
+# Настройки пользователей (utils/state_store.py: память с TTL или sqlite)
+user_aspect_ratio = make_state_store("aspect_ratio", ttl=30 * 24 * 3600)   # user_id -> "1:1" / "9:16" / "16:9" / "3:4"
 
 # Сессии обработки фото для Remix: user_id -> { "images": [file_id,...], "aspect": "1:1" }
-photo_sessions = {}
+# После изменения сессию сохраняем обратно: photo_sessions[user_id] = session
+photo_sessions = make_state_store("photo_sessions", ttl=6 * 3600)
 
 
 def _aspect_human(aspect: str) -> str:
@@ -104,6 +116,7 @@ def register_magic_photo_handlers(bot):
         session = photo_sessions.get(user_id)
         if session is not None:
             session["aspect"] = aspect
+            photo_sessions[user_id] = session
 
         human = _aspect_human(aspect)
         if human:
@@ -158,7 +171,9 @@ def register_magic_photo_handlers(bot):
             bot.register_next_step_handler(message, receive_prompt_for_generation)
             return
 
-        if not consume_tokens_or_limit(user_id, mode="image"):
+        # лимит только проверяем, списываем — когда подойдёт очередь
+        ok, _ = can_use_image(user_id)
+        if not ok:
             bot.send_message(
                 chat_id,
                 "⚠️ Недостаточно лимита для генерации изображения.\n\n"
@@ -167,7 +182,6 @@ def register_magic_photo_handlers(bot):
             return
 
         aspect = user_aspect_ratio.get(user_id, "1:1")
-        aspect_line = _aspect_caption_line(aspect)
 
         # Статусное сообщение, которое будем обновлять
         status_msg = bot.send_message(
@@ -176,24 +190,44 @@ def register_magic_photo_handlers(bot):
             "Немного подождём, пока магия сработает ✨"
         )
 
+        # генерация идёт в пуле NanoBanana, когда подойдёт очередь;
+        # поток хендлера освобождается сразу
+        nanobanana_gate.submit(
+            user_id,
+            lambda: _generate_by_prompt(chat_id, user_id, prompt, aspect, status_msg.message_id),
+            on_position=queue_position_notifier(bot, chat_id, status_msg.message_id),
+            on_timeout=queue_timeout_notifier(bot, chat_id, status_msg.message_id),
+        )
+
+    def _generate_by_prompt(chat_id, user_id, prompt, aspect, status_message_id):
+        """
+        Выполняется в пуле NanoBanana после допуска: списание лимита,
+        генерация и отправка результата.
+        """
+        if not consume_tokens_or_limit(user_id, mode="image"):
+            _edit_status(
+                chat_id,
+                status_message_id,
+                "⚠️ Недостаточно лимита для генерации изображения.\n\n"
+                "Загляни в «👤 Мой тариф и баланс», чтобы пополнить или обновить тариф ✨"
+            )
+            return
+
         try:
-            img_bytes, img_url = generate_image(
+            img_url = generate_image(
                 prompt=prompt,
                 resolution="2K",
                 aspect=aspect,
-                return_url=True,
+                download=False,
             )
         except Exception as e:
             # Обновим статус, что магия не сработала
-            try:
-                bot.edit_message_text(
-                    "😔 Магия с картинкой не сработала.\n"
-                    "Попробуй ещё раз чуть позже или измени запрос.",
-                    chat_id,
-                    status_msg.message_id,
-                )
-            except Exception:
-                pass
+            _edit_status(
+                chat_id,
+                status_message_id,
+                "😔 Магия с картинкой не сработала.\n"
+                "Попробуй ещё раз чуть позже или измени запрос.",
+            )
 
             bot.send_message(
                 chat_id,
@@ -202,22 +236,15 @@ def register_magic_photo_handlers(bot):
             return
 
         # Обновляем статус: всё получилось
-        try:
-            bot.edit_message_text(
-                "🎨 Магия сработала! Отправляю твою картинку ✨",
-                chat_id,
-                status_msg.message_id,
-            )
-        except Exception:
-            pass
+        _edit_status(chat_id, status_message_id, "🎨 Магия сработала! Отправляю твою картинку ✨")
 
         caption = (
             "Готово! ✨\n"
-            f"{aspect_line}\n\n"
+            f"{_aspect_caption_line(aspect)}\n\n"
             f"🔗 <a href=\"{img_url}\">Оригинал в полном разрешении</a>"
         )
 
-        bot.send_photo(chat_id, img_bytes, caption=caption, parse_mode="HTML")
+        send_photo_from_url(bot, chat_id, img_url, caption=caption, parse_mode="HTML")
 
         try:
             bot.send_message(
@@ -228,6 +255,12 @@ def register_magic_photo_handlers(bot):
         except Exception:
             pass
 
+    def _edit_status(chat_id, message_id, text):
+        try:
+            bot.edit_message_text(text, chat_id, message_id)
+        except Exception:
+            pass
+
     # =========================================================
     # 2) ОБРАБОТКА ФОТО ("📸 Обработать моё фото") + Remix
     # =========================================================
@@ -334,8 +367,10 @@ def register_magic_photo_handlers(bot):
             bot.register_next_step_handler(message, collect_photos_step)
             return
 
-        # Добавили изображение
+        # Добавили изображение — ссылку на файл начинаем получать сразу
         session["images"].append(file_id)
+        photo_sessions[user_id] = session
+        prefetch_file(bot, file_id)
         num = len(session["images"])
 
         # После первого изображения → спрашиваем формат
@@ -393,10 +428,10 @@ def register_magic_photo_handlers(bot):
             return
 
         aspect = session.get("aspect") or user_aspect_ratio.get(user_id, "1:1")
-        aspect_line = _aspect_caption_line(aspect)
 
-        # проверяем лимит
-        if not consume_tokens_or_limit(user_id, mode="image"):
+        # лимит только проверяем, списываем — когда подойдёт очередь
+        ok, _ = can_use_image(user_id)
+        if not ok:
             bot.send_message(
                 chat_id,
                 "⚠️ Недостаточно лимита для обработки фото.\n\n"
@@ -421,70 +456,81 @@ def register_magic_photo_handlers(bot):
                 "Немного подождём, пока мир сложится в одну картинку ✨"
             )
 
+        # сессия больше не нужна: всё нужное передаём в задачу
+        photo_sessions.pop(user_id, None)
+
+        nanobanana_gate.submit(
+            user_id,
+            lambda: _process_photos(chat_id, user_id, prompt, list(images), aspect, status_msg.message_id),
+            on_position=queue_position_notifier(bot, chat_id, status_msg.message_id),
+            on_timeout=queue_timeout_notifier(bot, chat_id, status_msg.message_id),
+        )
+
+    def _process_photos(chat_id, user_id, prompt, images, aspect, status_message_id):
+        """
+        Выполняется в пуле NanoBanana после допуска: списание лимита,
+        обработка (одно фото / Remix) и отправка результата.
+        """
+        if not consume_tokens_or_limit(user_id, mode="image"):
+            _edit_status(
+                chat_id,
+                status_message_id,
+                "⚠️ Недостаточно лимита для обработки фото.\n\n"
+                "Загляни в «👤 Мой тариф и баланс», чтобы пополнить или обновить тариф ✨"
+            )
+            return
+
+        count = len(images)
+
         # Собираем URL'ы изображений и запускаем обработку
         try:
-            file_urls = []
-            for fid in images:
-                file_info = bot.get_file(fid)
-                file_path = file_info.file_path
-                file_url = f"https://api.telegram.org/file/bot{bot.token}/{file_path}"
-                file_urls.append(file_url)
+            # ссылки обычно уже в кэше (prefetch в collect_photos_step)
+            file_urls = resolve_file_urls(bot, images)
 
             if count == 1:
-                img_bytes, img_url = generate_image_from_url(
+                img_url = generate_image_from_url(
                     image_url=file_urls[0],
                     prompt=prompt,
                     resolution="2K",
                     aspect=aspect,
-                    return_url=True,
+                    download=False,
                 )
                 title_line = "Готово! ✨ Обработано 1 изображение."
             else:
-                img_bytes, img_url = generate_scene_from_urls(
+                img_url = generate_scene_from_urls(
                     image_urls=file_urls,
                     prompt=prompt,
                     resolution="2K",
                     aspect=aspect,
-                    return_url=True,
+                    download=False,
                 )
                 title_line = f"Готово! ✨ Режим Remix: общая сцена из {count} изображений."
 
         except Exception as e:
             # Обновляем статус — магия не сработала
-            try:
-                bot.edit_message_text(
-                    "😔 Магия с обработкой не сработала.\n"
-                    "Попробуй ещё раз чуть позже или с другими параметрами.",
-                    chat_id,
-                    status_msg.message_id,
-                )
-            except Exception:
-                pass
+            _edit_status(
+                chat_id,
+                status_message_id,
+                "😔 Магия с обработкой не сработала.\n"
+                "Попробуй ещё раз чуть позже или с другими параметрами.",
+            )
 
             bot.send_message(
                 chat_id,
                 f"Не удалось обработать изображение 😔\nОшибка: {e}"
             )
-            photo_sessions.pop(user_id, None)
             return
 
         # Магия удалась — обновим статус
-        try:
-            bot.edit_message_text(
-                "🎨 Магия сработала! Отправляю результат ✨",
-                chat_id,
-                status_msg.message_id,
-            )
-        except Exception:
-            pass
+        _edit_status(chat_id, status_message_id, "🎨 Магия сработала! Отправляю результат ✨")
 
         caption = (
             f"{title_line}\n"
-            f"{aspect_line}\n\n"
+            f"{_aspect_caption_line(aspect)}\n\n"
             f"🔗 <a href=\"{img_url}\">Оригинал в полном разрешении</a>"
         )
 
-        bot.send_photo(chat_id, img_bytes, caption=caption, parse_mode="HTML")
+        send_photo_from_url(bot, chat_id, img_url, caption=caption, parse_mode="HTML")
 
         # остаток лимита
         try:
@@ -494,7 +540,4 @@ def register_magic_photo_handlers(bot):
                 parse_mode="Markdown",
             )
         except Exception:
-            pass
-
-        # очищаем сессию
-        photo_sessions.pop(user_id, None)
\ No newline at end of file
+            pass
\ No newline at end of file
@@ -100,7 +100,7 @@ def register_payment_handlers(bot):
         tariff_key = sp.invoice_payload
         tokens_to_add = int(TARIFF_TOKENS.get(tariff_key, 0))
 
-        add_tokens(user_id, tokens_to_add)
+        add_tokens(user_id, tokens_to_add, reason=f"purchase:{tariff_key}")
         set_last_tariff(user_id, tariff_key)
         apply_tariff_pricing(user_id, tariff_key)
 
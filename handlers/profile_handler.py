@@ -11,10 +11,9 @@
 from telebot import types
 from services.billing import (
     format_balance_message,
-    get_user_tariff,
+    get_user_snapshot,
 )
 from services.db import get_auto_renew
-from handlers.referrals_handler import _get_referral_stats
 
 
 AUTO_RENEW_ON = "🔁 Автопродление: Включено"
@@ -31,24 +30,24 @@ def register_profile_handlers(bot):
     def show_profile(message):
         user_id = message.from_user.id
 
+        # всё о пользователе — одним запросом (и из кэша при повторе)
+        snapshot = get_user_snapshot(user_id)
+
         reply = "👤 *Твой профиль*\n\n"
         reply += format_balance_message(user_id) + "\n"
 
         # тариф
-        tariff = get_user_tariff(user_id)
-        if tariff:
-            reply += f"💳 Тариф: *{tariff.upper()}*\n"
+        if snapshot.tariff:
+            reply += f"💳 Тариф: *{snapshot.tariff.upper()}*\n"
 
         # автопродление
-        auto = get_auto_renew(user_id)
-        if auto and auto["status"] == 1:
+        if snapshot.auto_renew:
             reply += AUTO_RENEW_ON + "\n"
         else:
             reply += AUTO_RENEW_OFF + "\n"
 
         # рефералы
-        invited, bonus = _get_referral_stats(user_id)
-        reply += f"👥 Приглашено друзей: *{invited}*\n"
+        reply += f"👥 Приглашено друзей: *{snapshot.referrals_invited}*\n"
 
         # кнопки
         kb = types.InlineKeyboardMarkup()
@@ -63,7 +62,7 @@ def register_profile_handlers(bot):
         kb.add(
             types.InlineKeyboardButton(
                 "👥 Пригласить друга",
-                url=f"https://t.me/{bot.get_me().username}?start=ref{user_id}"
+                url=bot.invite_link(user_id)
             )
         )
 
@@ -50,7 +50,7 @@ def register_referral_handlers(bot):
         kb.add(
             types.InlineKeyboardButton(
                 "🔗 Пригласить друга",
-                url=f"https://t.me/{bot.get_me().username}?start=ref{user_id}"
+                url=bot.invite_link(user_id)
             )
         )
 
@@ -96,8 +96,8 @@ def _process_referral(invited_id: int, referrer_id: int):
     conn.commit()
 
     # Начисляем токены
-    add_tokens(referrer_id, REFERRAL_BONUS)
-    add_tokens(invited_id, REFERRAL_BONUS)
+    add_tokens(referrer_id, REFERRAL_BONUS, reason="referral")
+    add_tokens(invited_id, REFERRAL_BONUS, reason="referral")
 
     conn.close()
 
@@ -0,0 +1,311 @@
+# kling_worker.py
+#
+# Фоновый наблюдатель за задачами Kling (🎞 Оживить картинку).
+# Хендлер только создаёт задачу и статусное сообщение, а дальше
+# все висящие задачи опрашивает один общий поток:
+# - крутит "анимацию загрузки" в статусном сообщении,
+# - отправляет готовое видео,
+# - сообщает об ошибке или таймауте.
+# Поток хендлера TeleBot освобождается сразу.
+#
+# Раз в TICK задачи, у которых подошло время, отдаются в пул опроса (не
+# больше MAX_IN_FLIGHT сразу), без ожидания всей пачки. Загрузка готового
+# видео идёт в отдельном пуле доставки — медленная отправка не держит
+# опрос остальных задач.
+
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from loader import bot
+from services.billing import format_usage_left_message
+from services.kling_service import get_kling_task_status
+from services.telegram_delivery import send_video_from_url
+
+# Пауза между опросами одной задачи (сек)
+POLL_DELAY = 6
+
+# Сколько всего ждём видео (сек) — как раньше 40 попыток × 6 сек
+JOB_TIMEOUT = 240
+
+# Пауза между циклами и сколько задач опрашиваем одновременно
+TICK = 1
+POLL_CONCURRENCY = 8
+
+# Сколько задач максимум отдано в пул опроса (в работе + ждут потока)
+MAX_IN_FLIGHT = POLL_CONCURRENCY * 2
+
+# Сколько видео отправляем одновременно
+DELIVERY_CONCURRENCY = 4
+
+# Кадры для "анимации загрузки"
+SUBMITTED_FRAMES = [
+    "🪄 Твоя картинка в волшебной очереди\n\nЖдём её звёздной минуты ✨",
+    "🪄 Твоя картинка в волшебной очереди.\n\nЖдём её звёздной минуты ✨",
+    "🪄 Твоя картинка в волшебной очереди..\n\nЖдём её звёздной минуты ✨",
+    "🪄 Твоя картинка в волшебной очереди...\n\nЖдём её звёздной минуты ✨",
+]
+
+PROCESSING_FRAMES = [
+    "✨ Волшебники уже колдуют над твоей картинкой\n\nВнутри всё начинает оживать 🪄",
+    "✨ Волшебники уже колдуют над твоей картинкой.\n\nВнутри всё начинает оживать 🪄",
+    "✨ Волшебники уже колдуют над твоей картинкой..\n\nВнутри всё начинает оживать 🪄",
+    "✨ Волшебники уже колдуют над твоей картинкой...\n\nВнутри всё начинает оживать 🪄",
+]
+
+FAILED_TEXT = (
+    "😔 Волшебная машина анимации не справилась.\n"
+    "Попробуй ещё раз позже или с другой картинкой."
+)
+
+TIMEOUT_TEXT = (
+    "⏳ Сегодня волшебники слишком заняты, и мы не дождались видео вовремя.\n"
+    "Попробуй ещё раз немного позже 🪄"
+)
+
+# Висящие задачи Kling: task_id -> job
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+_in_flight = 0
+
+_executor = ThreadPoolExecutor(max_workers=POLL_CONCURRENCY, thread_name_prefix="kling-poll")
+_delivery_executor = ThreadPoolExecutor(max_workers=DELIVERY_CONCURRENCY, thread_name_prefix="kling-deliver")
+
+
+# =============================================================
+# Публичный API
+# =============================================================
+
+def add_kling_job(task_id: str, chat_id: int, user_id: int, status_message_id: int,
+                  kind: str = "image2video"):
+    """
+    Передаёт задачу Kling наблюдателю. Возвращается сразу.
+    kind — тип задачи (image2video / text2video / effects), чтобы статус
+    спрашивать ровно у одного эндпоинта.
+    """
+    now = time.time()
+    with _jobs_lock:
+        _jobs[task_id] = {
+            "task_id": task_id,
+            "kind": kind,
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "status_message_id": status_message_id,
+            "created_at": now,
+            "next_poll_at": now + POLL_DELAY,
+            "submitted_idx": 0,
+            "processing_idx": 0,
+            "polling": False,
+        }
+
+    start_kling_watcher()
+
+
+def pending_kling_jobs() -> int:
+    return len(_jobs)
+
+
+# =============================================================
+# Работа с одной задачей
+# =============================================================
+
+def _edit_status(job: dict, text: str, fallback: bool = False):
+    """
+    Обновляет статусное сообщение; fallback=True — если не вышло, шлёт новое.
+    Никогда не бросает: ошибки Telegram не должны мешать завершить задачу.
+    """
+    try:
+        bot.edit_message_text(text, job["chat_id"], job["status_message_id"])
+        return
+    except Exception:
+        if not fallback:
+            return
+
+    try:
+        bot.send_message(job["chat_id"], text)
+    except Exception as e:
+        print(f"⚠️ Kling {job['task_id']}: не удалось отправить статус: {e}")
+
+
+def _finish(job: dict):
+    with _jobs_lock:
+        _jobs.pop(job["task_id"], None)
+
+
+def _deliver(job: dict, video_url: str | None):
+    chat_id = job["chat_id"]
+
+    _edit_status(job, "🎞 Готово! Загружаю твоё волшебное видео... ✨")
+
+    if not video_url:
+        bot.send_message(
+            chat_id,
+            "Видео вроде бы готово, но я не смог найти ссылку на него 😔"
+        )
+        return
+
+    caption_html = (
+        "🎞 Готово! Вот твоё маленькое волшебное видео ✨\n\n"
+        f"🔗 <a href=\"{video_url}\">Видео в полном качестве</a>"
+    )
+
+    # Пытаемся отправить как видео с подписью и ссылкой
+    try:
+        send_video_from_url(
+            bot,
+            chat_id,
+            video_url,
+            caption=caption_html,
+            parse_mode="HTML",
+        )
+    except Exception:
+        # Если не получилось как видео — хотя бы текст с кликабельной ссылкой
+        bot.send_message(
+            chat_id,
+            caption_html,
+            parse_mode="HTML",
+        )
+
+    # Показываем остаток лимита
+    try:
+        bot.send_message(
+            chat_id,
+            format_usage_left_message(job["user_id"]),
+            parse_mode="Markdown",
+        )
+    except Exception:
+        pass
+
+
+def _poll_job(job: dict):
+    try:
+        status, video_url = get_kling_task_status(job["task_id"], kind=job["kind"])
+    except Exception as e:
+        _finish(job)
+        _edit_status(
+            job,
+            f"😔 Не получилось узнать, как там наша анимация.\nОшибка: {e}",
+            fallback=True,
+        )
+        return
+
+    status = (status or "").lower()
+    print("Kling status:", status)
+
+    # Очередь — крутим анимацию ожидания
+    if status in ("submitted", "queued", "pending", "unknown"):
+        frame = SUBMITTED_FRAMES[job["submitted_idx"] % len(SUBMITTED_FRAMES)]
+        job["submitted_idx"] += 1
+        _edit_status(job, frame)
+
+    # Обработка — крутим анимацию "волшебники колдуют"
+    elif status in ("processing", "running"):
+        frame = PROCESSING_FRAMES[job["processing_idx"] % len(PROCESSING_FRAMES)]
+        job["processing_idx"] += 1
+        _edit_status(job, frame)
+
+    # Успех — видео готово
+    elif status in ("succeed", "success", "completed"):
+        _finish(job)
+        _delivery_executor.submit(_safe_deliver, job, video_url)
+        return
+
+    # Ошибка/провал
+    elif status in ("failed", "error"):
+        _finish(job)
+        _edit_status(job, FAILED_TEXT, fallback=True)
+        return
+
+    # Таймаут — слишком долго не получили результат
+    if time.time() - job["created_at"] > JOB_TIMEOUT:
+        _finish(job)
+        _edit_status(job, TIMEOUT_TEXT, fallback=True)
+        return
+
+    job["next_poll_at"] = time.time() + POLL_DELAY
+
+
+def _safe_poll_job(job: dict):
+    """
+    Любая неожиданная ошибка завершает задачу — иначе она опрашивалась бы
+    каждый цикл бесконечно.
+    """
+    global _in_flight
+    try:
+        _poll_job(job)
+    except Exception as e:
+        print(f"⚠️ Kling job {job['task_id']} error: {e}")
+        traceback.print_exc()
+        _finish(job)
+    finally:
+        with _jobs_lock:
+            job["polling"] = False
+            _in_flight -= 1
+
+
+def _safe_deliver(job: dict, video_url: str | None):
+    try:
+        _deliver(job, video_url)
+    except Exception as e:
+        print(f"⚠️ Kling job {job['task_id']} delivery error: {e}")
+        traceback.print_exc()
+        _edit_status(job, FAILED_TEXT, fallback=True)
+
+
+# =============================================================
+# Фоновый цикл
+# =============================================================
+
+def _submit_due():
+    """
+    Отдаёт в пул задачи, у которых подошло время (не больше свободных мест),
+    не дожидаясь уже запущенных.
+    """
+    global _in_flight
+    now = time.time()
+    with _jobs_lock:
+        free = MAX_IN_FLIGHT - _in_flight
+        due = [
+            job for job in _jobs.values()
+            if not job["polling"] and job["next_poll_at"] <= now
+        ]
+        due.sort(key=lambda job: job["next_poll_at"])
+        due = due[:max(0, free)]
+        for job in due:
+            job["polling"] = True
+        _in_flight += len(due)
+
+    for job in due:
+        _executor.submit(_safe_poll_job, job)
+
+
+def _watcher_loop():
+    print("🎞 Kling watcher started")
+    while True:
+        try:
+            _submit_due()
+        except Exception as e:
+            print(f"⚠️ Kling watcher error: {e}")
+            traceback.print_exc()
+
+        time.sleep(TICK)
+
+
+_watcher_started = False
+_watcher_lock = threading.Lock()
+
+
+def start_kling_watcher():
+    """
+    Запускает наблюдатель в отдельном потоке (daemon), один раз на процесс.
+    """
+    global _watcher_started
+    with _watcher_lock:
+        if _watcher_started:
+            return
+        _watcher_started = True
+
+    t = threading.Thread(target=_watcher_loop, daemon=True)
+    t.start()
@@ -1,5 +1,122 @@
+import threading
+import time
+
 import telebot
-from config import TELEGRAM_TOKEN
+from config import TELEGRAM_TOKEN, UPDATE_WORKERS, UPDATE_QUEUE_MAX
+from utils.dedup import UpdateDeduplicator
+from utils.dispatcher import UpdateDispatcher
+from utils.state_store import TTLHandlerBackend
+
+# Сколько ждём ответа пользователя в пошаговом диалоге (сек)
+NEXT_STEP_TTL = 6 * 3600
+
+# Данные самого бота (get_me) обновляем не чаще, чем раз в столько секунд
+BOT_IDENTITY_TTL = 6 * 3600
+
+
+def update_chat_key(update):
+    """
+    chat_id апдейта (для колбэков/платежей без чата — id пользователя).
+    По нему диспетчер держит порядок: один чат — одна дорожка.
+    """
+    for name in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        msg = getattr(update, name, None)
+        if msg is not None:
+            return msg.chat.id
+
+    call = getattr(update, "callback_query", None)
+    if call is not None:
+        if call.message is not None:
+            return call.message.chat.id
+        return call.from_user.id
+
+    for name in ("pre_checkout_query", "shipping_query", "inline_query", "chosen_inline_result"):
+        obj = getattr(update, name, None)
+        if obj is not None:
+            return obj.from_user.id
+
+    return None
+
+
+class DispatchingTeleBot(telebot.TeleBot):
+    """
+    TeleBot, у которого апдейты обрабатываются в нашем диспетчере
+    (utils/dispatcher.py), и для вебхука, и для polling: один чат — по порядку,
+    разные чаты — параллельно. Встроенный пул TeleBot выключен (threaded=False):
+    хендлер выполняется прямо в потоке дорожки.
+    """
+
+    def __init__(self, token, **kwargs):
+        kwargs.setdefault("next_step_backend", TTLHandlerBackend(ttl=NEXT_STEP_TTL))
+        super().__init__(token, threaded=False, **kwargs)
+        self.dispatcher = UpdateDispatcher(
+            self._handle_update,
+            workers=UPDATE_WORKERS,
+            max_queue=UPDATE_QUEUE_MAX,
+            key=update_chat_key,
+        )
+        # повторные доставки того же update_id отбрасываем до очереди
+        self.dedup = UpdateDeduplicator()
+
+        self._identity_at = 0.0
+        self._identity_lock = threading.Lock()
+
+    # ------- данные самого бота -------
+
+    def refresh_identity(self):
+        """
+        Запрашивает get_me() и кладёт результат в кэш (вызывается при старте).
+        """
+        me = self.get_me()
+        with self._identity_lock:
+            self._user = me
+            self._identity_at = time.monotonic()
+        return me
+
+    @property
+    def user(self):
+        """
+        Бот (types.User) из кэша; раз в BOT_IDENTITY_TTL обновляется.
+        Если обновить не вышло — отдаём прежнее значение.
+        """
+        if self._user is None or time.monotonic() - self._identity_at > BOT_IDENTITY_TTL:
+            try:
+                return self.refresh_identity()
+            except Exception as e:
+                if self._user is None:
+                    raise
+                print(f"⚠️ get_me не удался, использую прежние данные бота: {e}")
+                self._identity_at = time.monotonic()
+        return self._user
+
+    def invite_link(self, user_id) -> str:
+        return f"https://t.me/{self.user.username}?start=ref{user_id}"
+
+    def _handle_update(self, update):
+        telebot.TeleBot.process_new_updates(self, [update])
+
+    def enqueue_update(self, update) -> bool:
+        """
+        Для вебхука: не ждёт. False — очередь полна.
+        Повтор уже принятого апдейта молча пропускаем (True).
+        """
+        if not self.dedup.check(update.update_id):
+            return True
+
+        if not self.dispatcher.submit(update):
+            # Telegram пришлёт его снова — тогда и примем
+            self.dedup.forget(update.update_id)
+            return False
+        self.dedup.accept(update.update_id)
+        return True
+
+    def process_new_updates(self, updates):
+        # polling: если очередь полна — ждём, а не теряем апдейты
+        for update in updates:
+            if self.dedup.check(update.update_id):
+                self.dispatcher.submit(update, block=True)
+                self.dedup.accept(update.update_id)
+
 
 # один общий экземпляр бота для всего проекта
-bot = telebot.TeleBot(TELEGRAM_TOKEN, parse_mode="HTML")
+bot = DispatchingTeleBot(TELEGRAM_TOKEN, parse_mode="HTML")
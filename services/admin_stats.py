@@ -0,0 +1,81 @@
+# services/admin_stats.py
+#
+# Статистика для админ-панели (/admin).
+#
+# Цифры не считаются заново на каждое открытие панели: их ведут триггеры
+# SQLite в таблице admin_counters (services/db.py), и чтение — один запрос
+# по маленькой таблице. Раз в RECONCILE_INTERVAL фоновый поток
+# пересчитывает счётчики по исходным таблицам и пишет в лог расхождения
+# (например, после ручной правки базы). Тем же потоком чистим кэш
+# Telegram file_id (media_file_ids) от давно не используемых записей.
+
+import threading
+import time
+from datetime import datetime
+
+from services.db import get_admin_counter_rows, reconcile_admin_counters, purge_media_file_id_rows
+
+# Как часто сверяем счётчики с исходными таблицами (сек)
+RECONCILE_INTERVAL = 3600
+
+_reconciler_started = False
+_reconciler_lock = threading.Lock()
+
+
+def collect_admin_stats() -> dict:
+    # "сегодня" — по UTC, как created_at покупок
+    today = datetime.utcnow().date().isoformat()
+    counters = get_admin_counter_rows(today)
+    tokens_rows = counters.get("tokens_rows", 0)
+    tokens_sum = counters.get("tokens_sum", 0)
+
+    return {
+        "users": counters.get("users", 0),
+        "purchases_total": counters.get("purchases", 0),
+        "purchases_today": counters.get(f"purchases:{today}", 0),
+        "promocodes_used": counters.get("promocodes_used", 0),
+        "tariff_start": counters.get("tariff:start", 0),
+        "tariff_pro": counters.get("tariff:pro", 0),
+        "tariff_max": counters.get("tariff:max", 0),
+        "ref_users": counters.get("ref_users", 0),
+        "ref_bonus_total": counters.get("ref_bonus_total", 0),
+        "tokens_added_total": tokens_sum,
+        "avg_balance": int(tokens_sum / tokens_rows) if tokens_rows else 0,
+    }
+
+
+def reconcile_now() -> dict:
+    drift = reconcile_admin_counters()
+    if drift:
+        print(f"⚠️ admin counters: расхождения исправлены {drift}")
+    return drift
+
+
+def _reconciler_loop():
+    while True:
+        time.sleep(RECONCILE_INTERVAL)
+        try:
+            reconcile_now()
+        except Exception as e:
+            print(f"⚠️ admin counters reconcile error: {e}")
+
+        try:
+            purged = purge_media_file_id_rows(time.time())
+            if purged:
+                print(f"🧹 media_file_ids: удалено {purged} старых file_id")
+        except Exception as e:
+            print(f"⚠️ media_file_ids purge error: {e}")
+
+
+def start_stats_reconciler():
+    """
+    Запускает фоновую сверку счётчиков (daemon).
+    Повторные вызовы ничего не делают.
+    """
+    global _reconciler_started
+    with _reconciler_lock:
+        if _reconciler_started:
+            return
+        _reconciler_started = True
+
+    threading.Thread(target=_reconciler_loop, daemon=True).start()
@@ -0,0 +1,320 @@
+# services/admission.py
+#
+# Допуск запросов к провайдерам (NanoBanana, Kling), чтобы пик пользователей
+# не упирался в их лимиты (429) и не валил всех сразу.
+#
+# У каждого провайдера свой AdmissionGate:
+# - семафор: не больше max_concurrency задач одновременно;
+# - token bucket: не чаще rate новых задач в секунду (с запасом burst);
+# - честная очередь: ожидающие пользователи обслуживаются по кругу
+#   (один пользователь с пачкой запросов не занимает всех впереди).
+#
+# Хендлер ничего не ждёт: gate.submit(user_id, job) кладёт задачу в очередь
+# и сразу возвращается (поток дорожки диспетчера свободен). Когда подходит
+# очередь, job() выполняется в собственном пуле потоков ворот и держит слот
+# до своего завершения. Ожидающим сообщаем место в очереди (on_position),
+# по таймауту очереди — on_timeout(). Время ожидания пишется в stats().
+#
+# Слот занят всё время job(), т.е. вместе с ожиданием результата у
+# провайдера (генерация NanoBanana — до нескольких минут), а не только на
+# запросе создания. Поэтому max_concurrency — это лимит одновременных
+# генераций целиком, а частоту запросов создания ограничивает rate.
+#
+# Места в очереди правит отдельный пул уведомлений. Чтобы запоздавшее
+# "ты N-й в очереди" не перезаписало статус уже запущенной задачи, правка
+# места и "очередь подошла" (0) идут под блокировкой ожидающего, и после
+# допуска места больше не показываем.
+
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (
+    NANOBANANA_MAX_CONCURRENCY,
+    NANOBANANA_RATE_PER_SEC,
+    KLING_MAX_CONCURRENCY,
+    KLING_RATE_PER_SEC,
+)
+
+# Сколько максимум ждём в очереди (сек)
+QUEUE_TIMEOUT = 600
+
+# Не чаще, чем раз в столько секунд, сообщаем пользователю новое место
+POSITION_NOTIFY_INTERVAL = 3
+
+# Как часто планировщик проверяет таймауты и места в очереди (сек)
+HOUSEKEEPING_INTERVAL = 1
+
+
+class _Waiter:
+
+    def __init__(self, user_id, job, on_position, on_timeout, timeout):
+        self.user_id = user_id
+        self.job = job
+        self.on_position = on_position
+        self.on_timeout = on_timeout
+        self.enqueued_at = time.monotonic()
+        self.deadline = self.enqueued_at + timeout
+        # первое сообщение — только если ждём дольше POSITION_NOTIFY_INTERVAL
+        self.notified_at = self.enqueued_at
+        self.last_position = None
+        # допущен к выполнению; меняется под gate._cond, читается под notify_lock
+        self.admitted = False
+        self.notify_lock = threading.Lock()
+
+
+class AdmissionGate:
+
+    def __init__(self, name: str, max_concurrency: int, rate: float, burst: int = None):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst or max(1, max_concurrency)
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._housekeeping_at = 0.0
+
+        # user_id -> deque[_Waiter]; порядок ключей — очередь на обслуживание
+        self._queues = OrderedDict()
+        self._queued = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=f"gate-{name}")
+        # уведомления (правки сообщений в Telegram) — отдельно от задач
+        self._notifier = ThreadPoolExecutor(max_workers=2, thread_name_prefix=f"gate-{name}-notify")
+        self._scheduler = None
+        self._start_lock = threading.Lock()
+
+        self._stats = {
+            "admitted": 0,
+            "timeouts": 0,
+            "errors": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    # ------- публичное -------
+
+    def submit(self, user_id, job, on_position=None, on_timeout=None, timeout=QUEUE_TIMEOUT):
+        """
+        Ставит job() в очередь и сразу возвращается.
+        on_position(n) — пока ждём (n — место; 0 — очередь подошла),
+        on_timeout() — если очередь так и не подошла за timeout сек.
+        """
+        self._start()
+        waiter = _Waiter(user_id, job, on_position, on_timeout, timeout)
+        with self._cond:
+            self._queues.setdefault(user_id, deque()).append(waiter)
+            self._queued += 1
+            self._cond.notify_all()
+
+    def queue_length(self) -> int:
+        with self._cond:
+            return self._queued
+
+    def stats(self) -> dict:
+        with self._cond:
+            result = dict(self._stats)
+            result["in_flight"] = self._in_flight
+            result["queued"] = self._queued
+            result["queued_users"] = len(self._queues)
+        admitted = result["admitted"]
+        result["wait_seconds_avg"] = result["wait_seconds_total"] / admitted if admitted else 0.0
+        return result
+
+    # ------- планировщик -------
+
+    def _start(self):
+        if self._scheduler is not None:
+            return
+        with self._start_lock:
+            if self._scheduler is None:
+                self._scheduler = threading.Thread(
+                    target=self._scheduler_loop, name=f"gate-{self.name}", daemon=True,
+                )
+                self._scheduler.start()
+
+    def _scheduler_loop(self):
+        while True:
+            notifications = []
+            with self._cond:
+                self._refill()
+                while self._queues and self._can_start():
+                    self._start_next()
+
+                now = time.monotonic()
+                if now - self._housekeeping_at >= HOUSEKEEPING_INTERVAL:
+                    self._housekeeping_at = now
+                    notifications.extend(self._housekeeping(now))
+
+                if not notifications:
+                    self._cond.wait(self._wait_hint())
+
+            for waiter, callback, args in notifications:
+                self._notifier.submit(self._notify_waiter, waiter, callback, *args)
+
+    def _run(self, waiter: _Waiter, was_notified: bool):
+        # место в очереди показывали — сообщаем, что очередь подошла (0),
+        # до того как job() начнёт менять то же сообщение
+        if waiter.on_position and was_notified:
+            with waiter.notify_lock:
+                self._notify(waiter.on_position, 0)
+        try:
+            waiter.job()
+        except Exception as e:
+            with self._cond:
+                self._stats["errors"] += 1
+            print(f"[{self.name}] ошибка задачи: {e}")
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def _notify_waiter(self, waiter: _Waiter, callback, *args):
+        # место в очереди устарело, если задача уже допущена: её статус
+        # теперь правит сама задача
+        with waiter.notify_lock:
+            if callback is waiter.on_position and waiter.admitted:
+                return
+            self._notify(callback, *args)
+
+    def _notify(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception as e:
+            print(f"[{self.name}] notify error: {e}")
+
+    # ------- внутреннее (под self._cond) -------
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _can_start(self) -> bool:
+        return self._in_flight < self.max_concurrency and self._tokens >= 1
+
+    def _wait_hint(self) -> float:
+        if not self._queues:
+            return HOUSEKEEPING_INTERVAL
+        # свободный слот есть, но нет токена — проснёмся, когда он появится
+        if self._in_flight < self.max_concurrency and self._tokens < 1:
+            return min(HOUSEKEEPING_INTERVAL, max(0.05, (1 - self._tokens) / self.rate))
+        return HOUSEKEEPING_INTERVAL
+
+    def _start_next(self):
+        """
+        Запускает первый запрос первого пользователя в круге; пользователь
+        уходит в конец круга.
+        """
+        user_id, queue = next(iter(self._queues.items()))
+        waiter = queue.popleft()
+        if queue:
+            self._queues.move_to_end(user_id)
+        else:
+            del self._queues[user_id]
+        self._queued -= 1
+        waiter.admitted = True
+
+        self._in_flight += 1
+        self._tokens -= 1
+
+        waited = time.monotonic() - waiter.enqueued_at
+        self._stats["admitted"] += 1
+        self._stats["wait_seconds_total"] += waited
+        self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], waited)
+
+        self._executor.submit(self._run, waiter, waiter.last_position is not None)
+
+    def _housekeeping(self, now: float) -> list:
+        """
+        Раз в HOUSEKEEPING_INTERVAL: снимаем просроченных и сообщаем новые места.
+        """
+        notifications = []
+        position = 0
+        for waiter in self._order():
+            if now >= waiter.deadline:
+                self._remove(waiter)
+                self._stats["timeouts"] += 1
+                if waiter.on_timeout:
+                    notifications.append((waiter, waiter.on_timeout, ()))
+                continue
+
+            position += 1
+            if (
+                waiter.on_position
+                and position != waiter.last_position
+                and now - waiter.notified_at >= POSITION_NOTIFY_INTERVAL
+            ):
+                waiter.last_position, waiter.notified_at = position, now
+                notifications.append((waiter, waiter.on_position, (position,)))
+        return notifications
+
+    def _order(self) -> list:
+        """
+        Порядок обслуживания: по одному запросу от каждого пользователя по кругу.
+        """
+        queues = [list(q) for q in self._queues.values()]
+        order = []
+        depth = 0
+        while True:
+            row = [q[depth] for q in queues if len(q) > depth]
+            if not row:
+                return order
+            order.extend(row)
+            depth += 1
+
+    def _remove(self, waiter: _Waiter):
+        q = self._queues.get(waiter.user_id)
+        if q is None:
+            return
+        try:
+            q.remove(waiter)
+        except ValueError:
+            return
+        self._queued -= 1
+        if not q:
+            del self._queues[waiter.user_id]
+
+
+def queue_position_notifier(bot, chat_id, message_id):
+    """
+    on_position для статусного сообщения: показывает место в очереди.
+    """
+    def notify(position: int):
+        if position == 0:
+            bot.edit_message_text(
+                "🪄 Твоя очередь подошла — начинаю колдовать ✨",
+                chat_id,
+                message_id,
+            )
+            return
+        bot.edit_message_text(
+            f"⏳ Сейчас у волшебников много заказов — ты {position}-й в очереди.\n"
+            "Как только подойдёт твой черёд, сразу начну колдовать ✨",
+            chat_id,
+            message_id,
+        )
+    return notify
+
+
+def queue_timeout_notifier(bot, chat_id, message_id):
+    """
+    on_timeout для статусного сообщения: очередь не подошла, ничего не списано.
+    """
+    def notify():
+        bot.edit_message_text(
+            "⏳ Сегодня у волшебников слишком длинная очередь, и твой черёд так и не подошёл.\n"
+            "Лимит не списан — попробуй ещё раз немного позже 🪄",
+            chat_id,
+            message_id,
+        )
+    return notify
+
+
+# Общие "ворота" на процесс
+nanobanana_gate = AdmissionGate("NanoBanana", NANOBANANA_MAX_CONCURRENCY, NANOBANANA_RATE_PER_SEC)
+kling_gate = AdmissionGate("Kling", KLING_MAX_CONCURRENCY, KLING_RATE_PER_SEC)
@@ -14,10 +14,19 @@ from services.db import (
     get_token_balance,
     set_token_balance,
     adjust_tokens,
+    debit_tokens,
     get_auto_renew,
     set_auto_renew,
+    get_user_billing_row,
+    take_free_image_row,
+    set_user_tariff_row,
+    get_user_snapshot_row,
 )
+from utils.cache import LRUCache
+from dataclasses import dataclass
 from datetime import datetime
+import threading
+import time
 
 
 # =====================================
@@ -52,11 +61,124 @@ TARIFF_PRICING = {
     },
 }
 
-# Здесь храним тариф пользователя в рантайме
-USER_TARIFF_CACHE = {}
+# =====================================
+# 🔮 Бесплатные картинки и тариф
+# =====================================
+# Хранятся в SQLite (таблица user_billing).
+# Бесплатные картинки списываются сразу в базе одним условным UPDATE
+# (take_free_image_row) — их тратят параллельные запросы из разных
+# процессов gunicorn, кэшировать их нельзя.
+# Тариф меняется редко и только покупкой: пишется в базу сразу,
+# а читается через кэш процесса (BILLING_CACHE_TTL).
+BILLING_CACHE_TTL = 30
+BILLING_CACHE_MAX_ITEMS = 100000
+
+# user_id -> {"tariff": str | None}
+_billing_cache = LRUCache(max_items=BILLING_CACHE_MAX_ITEMS, ttl=BILLING_CACHE_TTL)
+
+# user_id -> метка текущего чтения из базы; set_last_tariff её снимает,
+# чтобы чтение, начатое до записи, не положило в кэш старый тариф
+_billing_loads = {}
+_billing_lock = threading.Lock()
+
+_NOT_LOADED = object()
+
+
+def _load_billing(user_id: int, row=_NOT_LOADED) -> dict:
+    """
+    Тариф пользователя: из кэша, иначе из базы.
+    row — уже прочитанная строка user_billing (или None, если её нет).
+    Базу читаем без блокировки — она нужна только чтобы заполнить кэш.
+    """
+    state = _billing_cache.get(user_id)
+    if state is not None:
+        return state
 
-# Здесь храним бесплатные изображения в рантайме
-USER_FREE_IMAGES = {}
+    token = object()
+    with _billing_lock:
+        _billing_loads[user_id] = token
+
+    if row is _NOT_LOADED:
+        row = get_user_billing_row(user_id)
+    state = {"tariff": row["tariff"] if row else None}
+
+    with _billing_lock:
+        if _billing_loads.get(user_id) is token:
+            del _billing_loads[user_id]
+            _billing_cache.set(user_id, state)
+    return state
+
+
+def get_free_images(user_id: int) -> int:
+    # всегда из базы: остаток могли потратить в другом процессе
+    row = get_user_billing_row(user_id)
+    return row["free_images"] if row else WELCOME_FREE_IMAGES
+
+
+# =====================================
+# 📌 Снимок пользователя (профиль / баланс / остаток)
+# =====================================
+# Баланс, бесплатные картинки, тариф, автопродление и рефералы читаются
+# одним запросом (get_user_snapshot_row) и кэшируются на SNAPSHOT_TTL.
+# Любое изменение этих данных через billing сбрасывает снимок.
+SNAPSHOT_TTL = 15
+
+_snapshots = LRUCache(max_items=BILLING_CACHE_MAX_ITEMS, ttl=SNAPSHOT_TTL)
+
+# user_id -> метка текущего чтения снимка. invalidate_user_snapshot её
+# снимает: если данные поменялись, пока мы читали, снимок не кэшируем.
+_snapshot_loads = {}
+_snapshot_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    user_id: int
+    balance: int
+    free_images: int
+    tariff: str | None
+    auto_renew: bool
+    auto_renew_tariff: str | None
+    referrals_invited: int
+    referrals_bonus: int
+
+
+def get_user_snapshot(user_id: int) -> UserSnapshot:
+    snapshot = _snapshots.get(user_id)
+    if snapshot is not None:
+        return snapshot
+
+    token = object()
+    with _snapshot_lock:
+        _snapshot_loads[user_id] = token
+
+    row = get_user_snapshot_row(user_id)
+    billing_row = row if row["has_billing"] else None
+
+    # тариф — через кэш биллинга; заодно прогреваем его строкой из запроса
+    tariff = _load_billing(user_id, row=billing_row)["tariff"]
+
+    snapshot = UserSnapshot(
+        user_id=user_id,
+        balance=max(0, row["balance"]),
+        free_images=row["free_images"] if billing_row else WELCOME_FREE_IMAGES,
+        tariff=tariff,
+        auto_renew=row["auto_renew_status"] == 1,
+        auto_renew_tariff=row["auto_renew_tariff"],
+        referrals_invited=row["referrals_invited"],
+        referrals_bonus=row["referrals_bonus"],
+    )
+    with _snapshot_lock:
+        if _snapshot_loads.get(user_id) is token:
+            del _snapshot_loads[user_id]
+            _snapshots.set(user_id, snapshot)
+    return snapshot
+
+
+def invalidate_user_snapshot(user_id: int):
+    with _snapshot_lock:
+        _snapshot_loads.pop(user_id, None)
+        _snapshots.pop(user_id, None)
 
 
 # =====================================
@@ -66,24 +188,29 @@ def ensure_user_initialized(user_id: int):
     """
     Обеспечивает, чтобы у пользователя:
     - был баланс
-    - было 3 бесплатных изображения (если первый раз)
+    - было 3 бесплатных изображения (если первый раз) — это значение
+      по умолчанию, пока в user_billing нет строки
     """
-    if user_id not in USER_FREE_IMAGES:
-        USER_FREE_IMAGES[user_id] = WELCOME_FREE_IMAGES
-
     if get_token_balance(user_id) < 0:
         set_token_balance(user_id, 0)
+        invalidate_user_snapshot(user_id)
 
 
 # =====================================
 # 📌 Управление тарифами
 # =====================================
 def set_last_tariff(user_id: int, tariff_key: str):
-    USER_TARIFF_CACHE[user_id] = tariff_key
+    # покупка — редкое и важное событие: пишем сразу, ошибку отдаём
+    # вызывающему, а кэш обновляем только после успешной записи
+    set_user_tariff_row(user_id, tariff_key, WELCOME_FREE_IMAGES, time.time())
+    with _billing_lock:
+        _billing_loads.pop(user_id, None)
+        _billing_cache.set(user_id, {"tariff": tariff_key})
+    invalidate_user_snapshot(user_id)
 
 
 def get_user_tariff(user_id: int):
-    return USER_TARIFF_CACHE.get(user_id)
+    return _load_billing(user_id)["tariff"]
 
 
 # =====================================
@@ -104,7 +231,7 @@ def get_cost(user_id: int, mode: str) -> int:
 def can_use_image(user_id: int):
     ensure_user_initialized(user_id)
 
-    free_left = USER_FREE_IMAGES.get(user_id, 0)
+    free_left = get_free_images(user_id)
     if free_left > 0:
         return True, None
 
@@ -115,14 +242,21 @@ def can_use_image(user_id: int):
     return False, "У тебя закончились бесплатные генерации и токены."
 
 
-def register_image_usage(user_id: int):
-    free_left = USER_FREE_IMAGES.get(user_id, 0)
+def _take_free_image(user_id: int) -> bool:
+    """
+    Забирает одну бесплатную картинку, если она есть (атомарно в БД).
+    """
+    if take_free_image_row(user_id, WELCOME_FREE_IMAGES, time.time()) is None:
+        return False
+    invalidate_user_snapshot(user_id)
+    return True
 
-    if free_left > 0:
-        USER_FREE_IMAGES[user_id] = free_left - 1
-    else:
+
+def register_image_usage(user_id: int):
+    if not _take_free_image(user_id):
         cost = get_cost(user_id, "image")
-        adjust_tokens(user_id, -cost)
+        adjust_tokens(user_id, -cost, reason="image")
+        invalidate_user_snapshot(user_id)
 
 
 def can_use_animation(user_id: int):
@@ -139,61 +273,77 @@ def can_use_animation(user_id: int):
 
 def register_animation_usage(user_id: int):
     cost = get_cost(user_id, "animation")
-    adjust_tokens(user_id, -cost)
+    adjust_tokens(user_id, -cost, reason="animation")
+    invalidate_user_snapshot(user_id)
 
 
 # =====================================
 # 📌 Универсальная функция
 # =====================================
 def consume_tokens_or_limit(user_id: int, mode: str) -> bool:
-    if mode == "image":
-        ok, _ = can_use_image(user_id)
-        if not ok:
-            return False
-        register_image_usage(user_id)
-        return True
+    """
+    Проверка и списание за один проход:
+    - картинки сначала тратят бесплатный лимит (UPDATE ... WHERE free_images > 0),
+    - иначе одно атомарное списание в БД (UPDATE ... WHERE balance >= cost),
+      без отдельного чтения баланса перед ним.
+    """
+    if mode not in ("image", "animation"):
+        return False
 
-    if mode == "animation":
-        ok, _ = can_use_animation(user_id)
-        if not ok:
-            return False
-        register_animation_usage(user_id)
+    if mode == "image" and _take_free_image(user_id):
         return True
 
-    return False
+    cost = get_cost(user_id, mode)
+    if debit_tokens(user_id, cost, reason=mode) is None:
+        return False
+    invalidate_user_snapshot(user_id)
+    return True
 
 
 # =====================================
 # 📌 Начисление токенов
 # =====================================
-def add_tokens(user_id: int, amount: int):
-    return adjust_tokens(user_id, +amount)
+def add_tokens(user_id: int, amount: int, reason: str = "credit"):
+    balance = adjust_tokens(user_id, +amount, reason=reason)
+    invalidate_user_snapshot(user_id)
+    return balance
+
+
+# =====================================
+# 📌 Автопродление
+# =====================================
+def enable_auto_renew(user_id: int, tariff_key: str):
+    set_auto_renew(user_id, tariff_key, status=True)
+    invalidate_user_snapshot(user_id)
+
+
+def disable_auto_renew(user_id: int):
+    auto = get_auto_renew(user_id)
+    set_auto_renew(user_id, auto["tariff_key"] if auto else None, status=False)
+    invalidate_user_snapshot(user_id)
 
 
 # =====================================
 # 📌 Формирование простого профиля
 # =====================================
 def format_balance_message(user_id: int) -> str:
-    ensure_user_initialized(user_id)
-
-    tokens = get_token_balance(user_id)
-    free_images = USER_FREE_IMAGES.get(user_id, 0)
-    tariff = get_user_tariff(user_id)
+    snapshot = get_user_snapshot(user_id)
 
     lines = [
-        f"🔮 Токены: *{tokens}*",
-        f"🖼 Бесплатных изображений: *{free_images}*",
+        f"🔮 Токены: *{snapshot.balance}*",
+        f"🖼 Бесплатных изображений: *{snapshot.free_images}*",
     ]
 
-    if tariff:
-        lines.append(f"💳 Тариф: *{tariff.upper()}*")
+    if snapshot.tariff:
+        lines.append(f"💳 Тариф: *{snapshot.tariff.upper()}*")
 
     return "\n".join(lines)
 
 
 def format_usage_left_message(user_id: int) -> str:
+    snapshot = get_user_snapshot(user_id)
     return (
         f"🔢 Остаток:\n"
-        f"• изображения: *{USER_FREE_IMAGES.get(user_id, 0)}*\n"
-        f"• токены: *{get_token_balance(user_id)}*"
-    )
\ No newline at end of file
+        f"• изображения: *{snapshot.free_images}*\n"
+        f"• токены: *{snapshot.balance}*"
+    )
@@ -11,25 +11,164 @@
 # - promocodes
 # - user_promo_usage
 # - auto_renew
+# - token_ledger (журнал всех движений токенов, только INSERT)
+# - pending_generations (очередь задач NanoBanana для task_worker)
+# - admin_counters (готовые счётчики для админ-панели, ведутся триггерами)
 #
 # Все операции завернуты в удобные методы.
 
 import sqlite3
 import os
+import threading
+import weakref
 from datetime import datetime
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "chudo.db")
+DB_PATH = os.getenv(
+    "CHUDO_DB_PATH",
+    os.path.join(os.path.dirname(__file__), "chudo.db"),
+)
+
+# Сколько подготовленных выражений держит каждое соединение
+STATEMENT_CACHE_SIZE = 256
+
+# Сколько ждём блокировку записи другим потоком/процессом (сек)
+BUSY_TIMEOUT = 30
+
+
+# ================================
+# 📌 Пул соединений
+# ================================
+# Одно долгоживущее соединение на поток:
+# - WAL: читатели не блокируют писателя
+# - synchronous=NORMAL: fsync только на чекпоинте, а не на каждый commit
+# - кэш подготовленных выражений (cached_statements)
+#
+# Старый код зовёт conn.close() после каждого запроса —
+# для соединения из пула это безопасно: оно не закрывается,
+# а только откатывает незавершённую транзакцию (как и настоящий close).
+
+class _PooledConnection(sqlite3.Connection):
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+
+_local = threading.local()
+_pool = weakref.WeakSet()  # все открытые соединения (умирают вместе с потоком)
+_pool_lock = threading.Lock()
+
+
+def _open_conn():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        factory=_PooledConnection,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.pool_closed = False
+
+    with _pool_lock:
+        _pool.add(conn)
+
+    return conn
 
 
 # ================================
 # 📌 Подключение к БД
 # ================================
 def get_conn():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    """
+    Возвращает соединение текущего потока (создаёт при первом вызове).
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or conn.pool_closed:
+        conn = _open_conn()
+        _local.conn = conn
     return conn
 
 
+def close_all_conns():
+    """
+    Закрывает все соединения пула (остановка процесса / тесты).
+    Потоки при следующем get_conn() откроют новое соединение.
+    """
+    with _pool_lock:
+        conns = list(_pool)
+        _pool.clear()
+
+    for conn in conns:
+        conn.pool_closed = True
+        try:
+            sqlite3.Connection.close(conn)
+        except Exception:
+            pass
+
+
+# ================================
+# 📌 Триггеры счётчиков админ-панели
+# ================================
+# Каждая вставка в users / purchases / referrals / user_promo_usage и
+# каждое изменение tokens.balance сразу поправляет admin_counters в той же
+# транзакции — так счётчики ведут и старые обработчики с "сырым" SQL.
+# Даты покупок — UTC, как в created_at.
+
+def _counter_trigger(name, event, *items, when=""):
+    """
+    CREATE TRIGGER, прибавляющий к счётчикам значения: items — (ключ, значение),
+    оба SQL-выражения (могут ссылаться на NEW / OLD).
+    """
+    values = ", ".join(f"({key}, {value})" for key, value in items)
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS {name} {event}
+        {when}
+        BEGIN
+            INSERT INTO admin_counters (key, value) VALUES {values}
+            ON CONFLICT(key) DO UPDATE SET value = value + excluded.value;
+        END
+    """
+
+
+ADMIN_COUNTER_TRIGGERS = [
+    _counter_trigger(
+        "trg_counters_users", "AFTER INSERT ON users",
+        ("'users'", "1"),
+    ),
+    _counter_trigger(
+        "trg_counters_purchases", "AFTER INSERT ON purchases",
+        ("'purchases'", "1"),
+        ("'purchases:' || IFNULL(date(NEW.created_at), '')", "1"),
+        ("'tariff:' || IFNULL(NEW.tariff_key, '')", "1"),
+    ),
+    _counter_trigger(
+        "trg_counters_promo", "AFTER INSERT ON user_promo_usage",
+        ("'promocodes_used'", "1"),
+    ),
+    _counter_trigger(
+        "trg_counters_referrals", "AFTER INSERT ON referrals",
+        ("'referrals'", "1"),
+        ("'ref_bonus_total'", "IFNULL(NEW.reward_referrer, 0)"),
+        # +1, если это первый реферал пригласившего
+        ("'ref_users'", "(SELECT COUNT(*) = 1 FROM referrals WHERE referrer_id = NEW.referrer_id)"),
+    ),
+    _counter_trigger(
+        "trg_counters_tokens_insert", "AFTER INSERT ON tokens",
+        ("'tokens_rows'", "1"),
+        ("'tokens_sum'", "IFNULL(NEW.balance, 0)"),
+    ),
+    _counter_trigger(
+        "trg_counters_tokens_update", "AFTER UPDATE OF balance ON tokens",
+        ("'tokens_sum'", "IFNULL(NEW.balance, 0) - IFNULL(OLD.balance, 0)"),
+        when="WHEN NEW.balance IS NOT OLD.balance",
+    ),
+]
+
+
 # ================================
 # 📌 Создание всех таблиц
 # ================================
@@ -54,6 +193,16 @@ def init_db():
         )
     """)
 
+    # Бесплатные картинки и текущий тариф (services/billing.py)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_billing (
+            user_id INTEGER PRIMARY KEY,
+            free_images INTEGER,
+            tariff TEXT DEFAULT NULL,
+            updated_at REAL
+        )
+    """)
+
     # История покупок
     cur.execute("""
         CREATE TABLE IF NOT EXISTS purchases (
@@ -79,6 +228,10 @@ def init_db():
             created_at TEXT
         )
     """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_referrals_referrer
+        ON referrals (referrer_id)
+    """)
 
     # Промокоды
     cur.execute("""
@@ -108,8 +261,116 @@ def init_db():
         )
     """)
 
+    # Журнал движений токенов (append-only, для аудита)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS token_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            delta INTEGER,
+            balance_after INTEGER,
+            reason TEXT,
+            created_at TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_token_ledger_user
+        ON token_ledger (user_id)
+    """)
+
+    # Очередь задач NanoBanana (общая для всех процессов-воркеров)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS pending_generations (
+            nb_task_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            chat_id INTEGER,
+            prompt TEXT,
+            model TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            created_at REAL,
+            next_poll_at REAL,
+            lease_owner TEXT DEFAULT NULL,
+            lease_until REAL DEFAULT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_pending_generations_due
+        ON pending_generations (status, next_poll_at)
+    """)
+
+    # Готовые картинки с кнопкой "Анимировать" (utils/tasks.py)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS animation_tasks (
+            task_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            prompt TEXT,
+            image_url TEXT,
+            created_at REAL
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_animation_tasks_created
+        ON animation_tasks (created_at)
+    """)
+
+    # Служебные значения бота (например, последний update_id)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bot_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+
+    # Состояние диалогов (utils/state_store.py, бэкенд "sqlite")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            namespace TEXT NOT NULL,
+            state_key TEXT NOT NULL,
+            value TEXT,
+            expires_at REAL,
+            PRIMARY KEY (namespace, state_key)
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_conversation_state_expires
+        ON conversation_state (expires_at)
+    """)
+
+    # Уже загруженные в Telegram файлы: ключ медиа -> file_id
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS media_file_ids (
+            media_key TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            created_at REAL,
+            last_used_at REAL,
+            uses INTEGER DEFAULT 0
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_media_file_ids_last_used
+        ON media_file_ids (last_used_at)
+    """)
+
+    # Счётчики админ-панели: key -> value.
+    # Ключи: users, purchases, purchases:YYYY-MM-DD, tariff:<key>,
+    # promocodes_used, referrals, ref_users, ref_bonus_total,
+    # tokens_rows, tokens_sum.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS admin_counters (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    for trigger in ADMIN_COUNTER_TRIGGERS:
+        cur.execute(trigger)
+
     conn.commit()
 
+    # Счётчиков ещё нет (новая база или обновление) — считаем их один раз
+    cur.execute("SELECT 1 FROM admin_counters WHERE key='users'")
+    if cur.fetchone() is None:
+        reconcile_admin_counters()
+
     # Добавляем твой промокод по умолчанию
     cur.execute("""
         INSERT OR IGNORE INTO promocodes (code, discount_percent, uses_per_user)
@@ -163,11 +424,146 @@ def set_token_balance(user_id, balance):
     conn.close()
 
 
-def adjust_tokens(user_id, delta):
-    balance = get_token_balance(user_id)
-    new_balance = max(0, balance + delta)
-    set_token_balance(user_id, new_balance)
-    return new_balance
+# ================================
+# 📌 Движения токенов (ledger)
+# ================================
+# Каждое изменение баланса — один оператор UPDATE/UPSERT ... RETURNING
+# плюс строка в token_ledger, в одной транзакции.
+# Никаких "прочитал → посчитал → записал", поэтому параллельные
+# вебхуки не могут списать одни и те же токены дважды.
+
+def _write_ledger(conn, user_id, delta, balance_after, reason):
+    conn.execute("""
+        INSERT INTO token_ledger (user_id, delta, balance_after, reason, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, (user_id, delta, balance_after, reason, datetime.utcnow().isoformat()))
+
+
+def debit_tokens(user_id, amount, reason="debit"):
+    """
+    Списывает amount токенов, только если их хватает.
+    Возвращает новый баланс или None, если токенов недостаточно.
+    """
+    conn = get_conn()
+    with conn:
+        row = conn.execute("""
+            UPDATE tokens SET balance = balance - ?
+            WHERE user_id=? AND balance >= ?
+            RETURNING balance
+        """, (amount, user_id, amount)).fetchone()
+
+        if row is None:
+            return None
+
+        _write_ledger(conn, user_id, -amount, row["balance"], reason)
+
+    return row["balance"]
+
+
+def adjust_tokens(user_id, delta, reason="adjust"):
+    """
+    Меняет баланс на delta (не уходит ниже нуля).
+    Если строки в tokens ещё нет — создаёт её.
+    В ledger пишется фактическое изменение (новый баланс минус старый),
+    а не запрошенное delta — иначе при упоре в ноль сумма ledger
+    разойдётся с балансом.
+    Возвращает новый баланс.
+    """
+    conn = get_conn()
+    with conn:
+        # сразу берём блокировку записи: старый баланс не должен
+        # измениться между чтением и UPDATE
+        conn.execute("BEGIN IMMEDIATE")
+        old = conn.execute(
+            "SELECT balance FROM tokens WHERE user_id=?", (user_id,)
+        ).fetchone()
+        row = conn.execute("""
+            INSERT INTO tokens (user_id, balance)
+            VALUES (?, MAX(0, ?))
+            ON CONFLICT(user_id) DO UPDATE SET balance = MAX(0, balance + ?)
+            RETURNING balance
+        """, (user_id, delta, delta)).fetchone()
+
+        applied = row["balance"] - (old["balance"] if old else 0)
+        _write_ledger(conn, user_id, applied, row["balance"], reason)
+
+    return row["balance"]
+
+
+def get_user_billing_row(user_id):
+    conn = get_conn()
+    row = conn.execute(
+        "SELECT free_images, tariff FROM user_billing WHERE user_id=?",
+        (user_id,),
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def take_free_image_row(user_id, default_free_images, now):
+    """
+    Атомарно забирает одну бесплатную картинку (как debit_tokens — без
+    "прочитал → записал"), так что параллельные запросы из разных
+    процессов не потратят одну и ту же картинку дважды.
+    Если строки ещё нет — создаёт её со значением по умолчанию.
+    Возвращает остаток или None, если бесплатных картинок нет.
+    """
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+            INSERT OR IGNORE INTO user_billing (user_id, free_images, tariff, updated_at)
+            VALUES (?, ?, NULL, ?)
+        """, (user_id, default_free_images, now))
+        row = conn.execute("""
+            UPDATE user_billing SET free_images = free_images - 1, updated_at = ?
+            WHERE user_id=? AND free_images > 0
+            RETURNING free_images
+        """, (now, user_id)).fetchone()
+    return row["free_images"] if row else None
+
+
+def set_user_tariff_row(user_id, tariff, default_free_images, now):
+    """
+    Записывает тариф. Бесплатные картинки не трогаем (их списывает
+    take_free_image_row), для новой строки — значение по умолчанию.
+    """
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+            INSERT INTO user_billing (user_id, free_images, tariff, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                tariff = excluded.tariff,
+                updated_at = excluded.updated_at
+        """, (user_id, default_free_images, tariff, now))
+
+
+def get_user_snapshot_row(user_id):
+    """
+    Всё для экрана профиля / баланса одним запросом:
+    баланс, бесплатные картинки и тариф, автопродление, рефералы.
+    """
+    conn = get_conn()
+    row = conn.execute("""
+        SELECT
+            COALESCE(t.balance, 0) AS balance,
+            b.user_id IS NOT NULL AS has_billing,
+            b.free_images AS free_images,
+            b.tariff AS tariff,
+            a.tariff_key AS auto_renew_tariff,
+            COALESCE(a.status, 0) AS auto_renew_status,
+            r.invited AS referrals_invited,
+            r.bonus AS referrals_bonus
+        FROM (SELECT ? AS user_id) u
+        LEFT JOIN tokens t ON t.user_id = u.user_id
+        LEFT JOIN user_billing b ON b.user_id = u.user_id
+        LEFT JOIN auto_renew a ON a.user_id = u.user_id
+        LEFT JOIN (
+            SELECT COUNT(*) AS invited, COALESCE(SUM(reward_referrer), 0) AS bonus
+            FROM referrals
+            WHERE referrer_id = ?
+        ) r
+    """, (user_id, user_id)).fetchone()
+    return dict(row)
 
 
 def record_purchase(user_id, tariff_key, amount_rub, tokens, discounted, promo_used):
@@ -204,5 +600,347 @@ def get_auto_renew(user_id):
     return row
 
 
+# ================================
+# 📌 Очередь задач NanoBanana
+# ================================
+# Воркеры (в т.ч. из разных процессов gunicorn) забирают задачи "в аренду"
+# (lease_owner / lease_until). Пока аренда не истекла, задачу никто другой
+# не возьмёт. Если воркер умер — аренда истечёт и задачу подхватит другой.
+# Это касается и задач в статусе 'delivering': если процесс умер посреди
+# отправки, после истечения аренды задача снова опрашивается и доставляется.
+
+def add_pending_generation_row(nb_task_id, user_id, chat_id, prompt, model, now):
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO pending_generations
+                (nb_task_id, user_id, chat_id, prompt, model, status,
+                 attempts, created_at, next_poll_at)
+            VALUES (?, ?, ?, ?, ?, 'pending', 0, ?, ?)
+        """, (nb_task_id, user_id, chat_id, prompt, model, now, now))
+
+
+def get_pending_generation_rows():
+    conn = get_conn()
+    rows = conn.execute("""
+        SELECT * FROM pending_generations
+        WHERE status IN ('pending', 'delivering')
+        ORDER BY created_at
+    """).fetchall()
+    return [dict(r) for r in rows]
+
+
+def lease_pending_generation_rows(owner, now, lease_seconds, limit):
+    """
+    Атомарно забирает до limit задач, у которых подошло время опроса
+    и нет действующей аренды (в т.ч. 'delivering' с истёкшей арендой).
+    """
+    conn = get_conn()
+    with conn:
+        rows = conn.execute("""
+            UPDATE pending_generations
+            SET lease_owner=?, lease_until=?
+            WHERE nb_task_id IN (
+                SELECT nb_task_id FROM pending_generations
+                WHERE status IN ('pending', 'delivering')
+                  AND next_poll_at <= ?
+                  AND (lease_until IS NULL OR lease_until < ?)
+                ORDER BY next_poll_at
+                LIMIT ?
+            )
+            RETURNING *
+        """, (owner, now + lease_seconds, now, now, limit)).fetchall()
+    return [dict(r) for r in rows]
+
+
+def reschedule_pending_generation_row(nb_task_id, next_poll_at):
+    """
+    Откладывает опрос, возвращает задачу в 'pending' (например, после
+    неудачной доставки) и снимает аренду.
+    """
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+            UPDATE pending_generations
+            SET status='pending', next_poll_at=?, attempts=attempts + 1,
+                lease_owner=NULL, lease_until=NULL
+            WHERE nb_task_id=?
+        """, (next_poll_at, nb_task_id))
+
+
+def claim_pending_generation_row(nb_task_id, owner, lease_until):
+    """
+    Переводит задачу в 'delivering', только если она всё ещё в аренде у owner,
+    и продлевает аренду до lease_until на время отправки.
+    True — можно отправлять результат (никто другой его уже не отправит).
+    """
+    conn = get_conn()
+    with conn:
+        cur = conn.execute("""
+            UPDATE pending_generations SET status='delivering', lease_until=?
+            WHERE nb_task_id=? AND lease_owner=?
+        """, (lease_until, nb_task_id, owner))
+    return cur.rowcount == 1
+
+
+def delete_pending_generation_row(nb_task_id):
+    conn = get_conn()
+    with conn:
+        conn.execute("DELETE FROM pending_generations WHERE nb_task_id=?", (nb_task_id,))
+
+
+# ================================
+# 📌 Задачи анимации
+# ================================
+# task_id из кнопки "animate:<task_id>" -> prompt и картинка. В базе, а не
+# в памяти процесса: нажатие может прийти в другой процесс или после рестарта.
+
+def add_animation_task_row(task_id, user_id, prompt, image_url, now):
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO animation_tasks (task_id, user_id, prompt, image_url, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (task_id, user_id, prompt, image_url, now))
+
+
+def get_animation_task_row(task_id, created_after):
+    conn = get_conn()
+    row = conn.execute("""
+        SELECT user_id, prompt, image_url FROM animation_tasks
+        WHERE task_id=? AND created_at > ?
+    """, (task_id, created_after)).fetchone()
+    return dict(row) if row else None
+
+
+def count_animation_task_rows():
+    conn = get_conn()
+    return conn.execute("SELECT COUNT(*) FROM animation_tasks").fetchone()[0]
+
+
+def purge_animation_task_rows(created_before):
+    conn = get_conn()
+    with conn:
+        cur = conn.execute("DELETE FROM animation_tasks WHERE created_at <= ?", (created_before,))
+    return cur.rowcount
+
+
+# ================================
+# 📌 Кэш Telegram file_id
+# ================================
+# media_key — sha256 от содержимого (или от URL результата), file_id —
+# то, что вернул Telegram при первой загрузке. Повторно тот же файл
+# отправляем по file_id, без загрузки.
+
+def get_media_file_id(media_key, now):
+    conn = get_conn()
+    with conn:
+        row = conn.execute("""
+            UPDATE media_file_ids
+            SET uses = uses + 1, last_used_at = ?
+            WHERE media_key=?
+            RETURNING file_id
+        """, (now, media_key)).fetchone()
+    return row["file_id"] if row else None
+
+
+def set_media_file_id(media_key, file_id, now):
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+            INSERT INTO media_file_ids (media_key, file_id, created_at, last_used_at, uses)
+            VALUES (?, ?, ?, ?, 0)
+            ON CONFLICT(media_key) DO UPDATE SET file_id=excluded.file_id
+        """, (media_key, file_id, now, now))
+
+
+def delete_media_file_id(media_key):
+    conn = get_conn()
+    with conn:
+        conn.execute("DELETE FROM media_file_ids WHERE media_key=?", (media_key,))
+
+
+# Сколько храним неиспользуемый file_id и сколько записей максимум
+MEDIA_FILE_IDS_KEEP_DAYS = 30
+MEDIA_FILE_IDS_MAX_ROWS = 100000
+
+
+def purge_media_file_id_rows(now, keep_days=MEDIA_FILE_IDS_KEEP_DAYS, max_rows=MEDIA_FILE_IDS_MAX_ROWS):
+    """
+    Удаляет file_id, которыми не пользовались дольше keep_days, а сверх
+    max_rows — самые давно использованные. Возвращает, сколько удалено.
+    """
+    conn = get_conn()
+    with conn:
+        stale = conn.execute("""
+            DELETE FROM media_file_ids
+            WHERE COALESCE(last_used_at, created_at) < ?
+        """, (now - keep_days * 86400,)).rowcount
+        extra = conn.execute("""
+            DELETE FROM media_file_ids
+            WHERE media_key IN (
+                SELECT media_key FROM media_file_ids
+                ORDER BY COALESCE(last_used_at, created_at) DESC
+                LIMIT -1 OFFSET ?
+            )
+        """, (max_rows,)).rowcount
+    return stale + extra
+
+
+# ================================
+# 📌 Служебные значения
+# ================================
+
+def get_meta(key, default=None):
+    conn = get_conn()
+    row = conn.execute("SELECT value FROM bot_meta WHERE key=?", (key,)).fetchone()
+    return row["value"] if row else default
+
+
+def set_meta(key, value):
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+            INSERT INTO bot_meta (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value=excluded.value
+        """, (key, str(value)))
+
+
+def set_meta_max_int(key, value):
+    """
+    Сохраняет value, только если он больше уже записанного (для счётчиков,
+    которые могут писать несколько процессов).
+    """
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+            INSERT INTO bot_meta (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE
+            SET value=excluded.value
+            WHERE CAST(excluded.value AS INTEGER) > CAST(bot_meta.value AS INTEGER)
+        """, (key, str(value)))
+
+
+# ================================
+# 📌 Состояние диалогов
+# ================================
+# value — JSON; протухшие строки не читаются и периодически удаляются.
+
+def get_state_row(namespace, state_key, now):
+    conn = get_conn()
+    row = conn.execute("""
+        SELECT value FROM conversation_state
+        WHERE namespace=? AND state_key=? AND (expires_at IS NULL OR expires_at > ?)
+    """, (namespace, state_key, now)).fetchone()
+    return row["value"] if row else None
+
+
+def set_state_row(namespace, state_key, value, expires_at):
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+            INSERT INTO conversation_state (namespace, state_key, value, expires_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(namespace, state_key) DO UPDATE
+            SET value=excluded.value, expires_at=excluded.expires_at
+        """, (namespace, state_key, value, expires_at))
+
+
+def pop_state_row(namespace, state_key, now):
+    conn = get_conn()
+    with conn:
+        row = conn.execute("""
+            DELETE FROM conversation_state
+            WHERE namespace=? AND state_key=?
+            RETURNING value, expires_at
+        """, (namespace, state_key)).fetchone()
+    if row is None or (row["expires_at"] is not None and row["expires_at"] <= now):
+        return None
+    return row["value"]
+
+
+def purge_expired_state_rows(now):
+    conn = get_conn()
+    with conn:
+        cur = conn.execute(
+            "DELETE FROM conversation_state WHERE expires_at IS NOT NULL AND expires_at <= ?",
+            (now,),
+        )
+    return cur.rowcount
+
+
+# ================================
+# 📌 Счётчики админ-панели
+# ================================
+
+# Сколько дней храним счётчики покупок по дням
+ADMIN_COUNTERS_KEEP_DAYS = 31
+
+
+def get_admin_counter_rows(day):
+    """
+    Все общие счётчики + покупки за день day ('YYYY-MM-DD', UTC).
+    Один запрос по маленькой таблице, без сканирования исходных.
+    """
+    conn = get_conn()
+    rows = conn.execute("""
+        SELECT key, value FROM admin_counters
+        WHERE key NOT LIKE 'purchases:%' OR key = 'purchases:' || ?
+    """, (day,)).fetchall()
+    return {row["key"]: row["value"] for row in rows}
+
+
+def reconcile_admin_counters(keep_days=ADMIN_COUNTERS_KEEP_DAYS):
+    """
+    Пересчитывает admin_counters по исходным таблицам (полные сканы) в одной
+    транзакции записи — параллельные вставки ждут её и не теряются.
+    Заодно удаляет дневные счётчики старше keep_days.
+    Возвращает {key: (было, стало)} для счётчиков, которые разошлись.
+    """
+    conn = get_conn()
+    with conn:
+        old = {
+            row["key"]: row["value"]
+            for row in conn.execute("DELETE FROM admin_counters RETURNING key, value")
+        }
+        conn.execute("""
+            INSERT INTO admin_counters (key, value)
+            SELECT 'users', COUNT(*) FROM users
+            UNION ALL
+            SELECT 'purchases', COUNT(*) FROM purchases
+            UNION ALL
+            SELECT 'purchases:' || IFNULL(date(created_at), ''), COUNT(*) FROM purchases
+            WHERE date(created_at) >= date('now', ?)
+            GROUP BY date(created_at)
+            UNION ALL
+            SELECT 'tariff:' || IFNULL(tariff_key, ''), COUNT(*) FROM purchases
+            GROUP BY tariff_key
+            UNION ALL
+            SELECT 'promocodes_used', COUNT(*) FROM user_promo_usage
+            UNION ALL
+            SELECT 'referrals', COUNT(*) FROM referrals
+            UNION ALL
+            SELECT 'ref_users', COUNT(DISTINCT referrer_id) FROM referrals
+            UNION ALL
+            SELECT 'ref_bonus_total', IFNULL(SUM(reward_referrer), 0) FROM referrals
+            UNION ALL
+            SELECT 'tokens_rows', COUNT(*) FROM tokens
+            UNION ALL
+            SELECT 'tokens_sum', IFNULL(SUM(balance), 0) FROM tokens
+        """, (f"-{keep_days} days",))
+        new = {
+            row["key"]: row["value"]
+            for row in conn.execute("SELECT key, value FROM admin_counters")
+        }
+
+    return {
+        key: (old.get(key, 0), new.get(key, 0))
+        for key in old.keys() | new.keys()
+        if old.get(key, 0) != new.get(key, 0)
+        # дневные счётчики, удалённые по сроку, — не расхождение
+        and not (key.startswith("purchases:") and key not in new)
+    }
+
+
 # Инициализация базы при импорте
 init_db()
\ No newline at end of file
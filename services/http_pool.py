@@ -0,0 +1,162 @@
+# services/http_pool.py
+#
+# Общие HTTP-пулы для исходящих запросов к провайдерам.
+#
+# requests: одна requests.Session на провайдера (Kling, Telegram, CDN) —
+#   keep-alive, соединения переиспользуются между потоками, TLS-рукопожатие
+#   только на новое соединение. HTTP/2 requests не умеет.
+# httpx (NanoBanana, services/nanobanana_client.py): свой AsyncClient,
+#   здесь только счётчик новых соединений через trace (HttpxConnectionTrace).
+#
+# Метрика: connection reuse = 1 - новые соединения / запросы, см. pool_stats().
+
+import importlib.util
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Размер пула на хост (≈ сколько потоков одновременно ходят к провайдеру)
+POOL_MAXSIZE = 32
+
+# HTTP/2 для httpx — если установлен пакет h2 (httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class _ConnectionCounter:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+
+    def add_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def add_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def snapshot(self) -> tuple[int, int]:
+        with self._lock:
+            return self.connections, self.requests
+
+
+def _counting_pool_classes(counter: _ConnectionCounter) -> dict:
+    """
+    Подклассы пулов urllib3, которые отмечают каждое новое соединение.
+    Счётчик общий на адаптер, так что вытесненные из PoolManager пулы
+    статистику не теряют.
+    """
+
+    class CountingHTTPConnectionPool(HTTPConnectionPool):
+        def _new_conn(self):
+            counter.add_connection()
+            return super()._new_conn()
+
+    class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+        def _new_conn(self):
+            counter.add_connection()
+            return super()._new_conn()
+
+    return {"http": CountingHTTPConnectionPool, "https": CountingHTTPSConnectionPool}
+
+
+class _CountingAdapter(HTTPAdapter):
+    """
+    HTTPAdapter со счётчиком запросов и новых соединений.
+    """
+
+    def __init__(self, **kwargs):
+        self.counter = _ConnectionCounter()
+        self._pool_classes = _counting_pool_classes(self.counter)
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        # свой dict: модульный pool_classes_by_scheme urllib3 не трогаем
+        self.poolmanager.pool_classes_by_scheme = dict(self._pool_classes)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        manager.pool_classes_by_scheme = dict(self._pool_classes)
+        return manager
+
+    def send(self, request, **kwargs):
+        self.counter.add_request()
+        return super().send(request, **kwargs)
+
+    def counters(self) -> tuple[int, int]:
+        return self.counter.snapshot()
+
+
+_sessions = {}
+_tracers = {}
+_lock = threading.Lock()
+
+
+def get_session(name: str, pool_maxsize: int = POOL_MAXSIZE) -> requests.Session:
+    """
+    Общая (потокобезопасная для обычных запросов) сессия провайдера.
+    """
+    with _lock:
+        session = _sessions.get(name)
+        if session is None:
+            session = requests.Session()
+            adapter = _CountingAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[name] = session
+        return session
+
+
+class HttpxConnectionTrace:
+    """
+    Счётчик для httpx: сколько запросов и сколько из них открыли
+    новое TCP-соединение. Подключается как event hook клиента.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.requests = 0
+
+    async def on_request(self, request):
+        self.requests += 1
+        request.extensions["trace"] = self._trace
+
+    async def _trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            self.connections += 1
+
+
+def get_httpx_trace(name: str) -> HttpxConnectionTrace:
+    with _lock:
+        tracer = _tracers.get(name)
+        if tracer is None:
+            tracer = HttpxConnectionTrace()
+            _tracers[name] = tracer
+        return tracer
+
+
+def _reuse(connections: int, sent: int) -> dict:
+    return {
+        "requests": sent,
+        "new_connections": connections,
+        "reuse_ratio": 1 - connections / sent if sent else 0.0,
+    }
+
+
+def pool_stats() -> dict:
+    with _lock:
+        sessions = dict(_sessions)
+        tracers = dict(_tracers)
+
+    result = {}
+    for name, session in sessions.items():
+        adapter = session.get_adapter("https://")
+        result[name] = _reuse(*adapter.counters())
+    for name, tracer in tracers.items():
+        result[name] = _reuse(tracer.connections, tracer.requests)
+    return result
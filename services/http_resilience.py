@@ -0,0 +1,293 @@
+# services/http_resilience.py
+#
+# Общая "живучесть" HTTP-вызовов к провайдерам (NanoBanana, Kling).
+#
+# - повторы с экспоненциальной паузой и случайным разбросом (jitter);
+# - бюджет повторов: повторов не больше ~20% от числа запросов, чтобы
+#   при аварии у провайдера мы не добивали его лавиной ретраев;
+# - circuit breaker: после серии сбоев подряд провайдер считается лежащим,
+#   и запросы сразу падают с понятной ошибкой, пока не пройдёт RESET_TIMEOUT;
+# - создание задач (idempotent=False) повторяем только когда запрос точно
+#   не был принят: не удалось соединиться, 429 или 503. Иначе можно
+#   получить вторую платную задачу.
+
+import asyncio
+import random
+import threading
+import time
+
+import httpx
+import requests
+import urllib3
+
+# Повторы
+MAX_ATTEMPTS = 3
+BASE_DELAY = 0.5
+MAX_DELAY = 8
+
+# Бюджет повторов: каждый запрос добавляет RETRY_RATIO "права на повтор",
+# каждый повтор тратит 1; запас — от RETRY_MIN до RETRY_MAX
+RETRY_RATIO = 0.2
+RETRY_MIN = 10
+RETRY_MAX = 100
+
+# Circuit breaker
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+
+# Ответы, которые провайдер точно не обработал — можно повторить даже создание
+REJECTED_STATUSES = (429, 503)
+# Временные ошибки сервера — повторяем только безопасные (чтение статуса)
+TRANSIENT_STATUSES = (500, 502, 504)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self, name: str, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return "open"
+            return "half_open"
+
+    def before_call(self):
+        """
+        Бросает CircuitOpenError, если провайдер сейчас считается лежащим.
+        После RESET_TIMEOUT пропускает один пробный запрос.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_running:
+                raise CircuitOpenError(f"{self.name} временно недоступен, попробуйте чуть позже")
+            self._trial_running = True
+
+    def on_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def on_neutral(self):
+        """
+        Вызов завершился не сетевой ошибкой: о здоровье провайдера это
+        ничего не говорит — счётчики не трогаем, только освобождаем
+        пробный запрос, чтобы следующий мог попробовать снова.
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def on_failure(self):
+        with self._lock:
+            self._failures += 1
+            trial_failed = self._trial_running
+            self._trial_running = False
+            if trial_failed or self._failures >= self.failure_threshold:
+                if self._opened_at is None or trial_failed:
+                    self.opened += 1
+                    print(f"⚠️ {self.name}: circuit open после {self._failures} сбоев подряд")
+                self._opened_at = time.monotonic()
+
+
+class RetryBudget:
+
+    def __init__(self, ratio=RETRY_RATIO, min_tokens=RETRY_MIN, max_tokens=RETRY_MAX):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = float(min_tokens)
+        self._lock = threading.Lock()
+
+    def on_request(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def backoff_delay(attempt: int, base=BASE_DELAY, cap=MAX_DELAY) -> float:
+    """
+    Пауза перед повтором номер attempt (1, 2, ...): "full jitter".
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def is_connect_error(exc: Exception) -> bool:
+    """
+    Ошибка до отправки запроса (соединение не установлено) — провайдер
+    запрос не видел, повторять безопасно.
+    """
+    if isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, requests.exceptions.ConnectTimeout)):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError) and exc.args:
+        reason = getattr(exc.args[0], "reason", None)
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    return False
+
+
+def _is_transport_error(exc: Exception) -> bool:
+    return isinstance(exc, (httpx.TransportError, requests.exceptions.RequestException))
+
+
+class ResilientProvider:
+    """
+    Обёртка для вызовов одного провайдера:
+        resp = provider.call(lambda: requests.get(...), idempotent=True)
+        resp = await provider.call_async(lambda: client.get(...), idempotent=True)
+    status_of(resp) — "настоящий" код ответа (NanoBanana кладёт его в тело).
+    """
+
+    def __init__(self, name: str, max_attempts=MAX_ATTEMPTS, status_of=None):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.status_of = status_of or (lambda resp: resp.status_code)
+        self.breaker = CircuitBreaker(name)
+        self.budget = RetryBudget()
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "retries": 0,
+            "failures": 0,
+            "budget_exhausted": 0,
+            "circuit_rejected": 0,
+        }
+
+    # ------- публичное -------
+
+    def call(self, send, idempotent=True):
+        attempt = 0
+        while True:
+            attempt += 1
+            self._before(attempt)
+            try:
+                resp = send()
+            except Exception as e:
+                if not self._should_retry_error(e, idempotent, attempt):
+                    raise
+            else:
+                if not self._should_retry_response(resp, idempotent, attempt):
+                    return resp
+            time.sleep(backoff_delay(attempt))
+
+    async def call_async(self, send, idempotent=True):
+        attempt = 0
+        while True:
+            attempt += 1
+            self._before(attempt)
+            try:
+                resp = await send()
+            except Exception as e:
+                if not self._should_retry_error(e, idempotent, attempt):
+                    raise
+            else:
+                if not self._should_retry_response(resp, idempotent, attempt):
+                    return resp
+            await asyncio.sleep(backoff_delay(attempt))
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            result = dict(self._stats)
+        result["circuit"] = self.breaker.state
+        result["circuit_opened"] = self.breaker.opened
+        return result
+
+    # ------- внутреннее -------
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _before(self, attempt: int):
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            self._count("circuit_rejected")
+            raise
+        self._count("requests")
+        if attempt == 1:
+            self.budget.on_request()
+
+    def _can_retry(self, attempt: int) -> bool:
+        if attempt >= self.max_attempts:
+            return False
+        if not self.budget.try_spend():
+            self._count("budget_exhausted")
+            return False
+        self._count("retries")
+        return True
+
+    def _should_retry_error(self, exc: Exception, idempotent: bool, attempt: int) -> bool:
+        if not _is_transport_error(exc):
+            self.breaker.on_neutral()
+            return False
+
+        self.breaker.on_failure()
+        self._count("failures")
+
+        retryable = is_connect_error(exc) or idempotent
+        return retryable and self._can_retry(attempt)
+
+    def _should_retry_response(self, resp, idempotent: bool, attempt: int) -> bool:
+        status = self.status_of(resp)
+
+        if status in TRANSIENT_STATUSES or status == 503:
+            self.breaker.on_failure()
+            self._count("failures")
+        else:
+            self.breaker.on_success()
+
+        if status in REJECTED_STATUSES:
+            retryable = True
+        elif status in TRANSIENT_STATUSES:
+            retryable = idempotent
+        else:
+            return False
+
+        if not retryable or not self._can_retry(attempt):
+            return False
+        print(f"[{self.name}] ответ {status}, повтор #{attempt}")
+        return True
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(name: str, status_of=None) -> ResilientProvider:
+    """
+    Один ResilientProvider (бюджет + breaker) на провайдера на процесс.
+    """
+    with _providers_lock:
+        provider = _providers.get(name)
+        if provider is None:
+            provider = ResilientProvider(name, status_of=status_of)
+            _providers[name] = provider
+        return provider
+
+
+def providers_stats() -> dict:
+    with _providers_lock:
+        providers = dict(_providers)
+    return {name: p.stats() for name, p in providers.items()}
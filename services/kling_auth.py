@@ -0,0 +1,75 @@
+# services/kling_auth.py
+#
+# Общий источник JWT-токенов для Kling API.
+# Токен живёт 1800 сек — подписываем его один раз и переиспользуем,
+# а заранее (за REFRESH_MARGIN до истечения) подписываем новый.
+# Используется и ботом (services/kling_service.py), и бэкендом миниапа (web/backend.py).
+
+import threading
+import time
+
+import jwt
+
+TOKEN_LIFETIME = 1800
+REFRESH_MARGIN = 300
+
+
+class KlingTokenProvider:
+
+    def __init__(self, access_key: str, secret_key: str,
+                 lifetime: int = TOKEN_LIFETIME, refresh_margin: int = REFRESH_MARGIN):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def get_token(self) -> str:
+        """
+        Действующий токен; новый подписывается только ближе к истечению.
+        """
+        now = time.time()
+        if self._token and now < self._expires_at - self.refresh_margin:
+            return self._token
+
+        with self._lock:
+            now = time.time()
+            if not self._token or now >= self._expires_at - self.refresh_margin:
+                self._token, self._expires_at = self._sign(int(now))
+            return self._token
+
+    def _sign(self, now: int):
+        if not self.access_key or not self.secret_key:
+            raise RuntimeError("❌ Нет KLING_ACCESS_KEY или KLING_SECRET_KEY в .env")
+
+        exp = now + self.lifetime
+        payload = {
+            "iss": self.access_key,
+            "exp": exp,
+            "nbf": now - 5,
+        }
+
+        token = jwt.encode(payload, self.secret_key, algorithm="HS256", headers={"typ": "JWT"})
+        if isinstance(token, bytes):
+            token = token.decode("utf-8")
+        return token, exp
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_token_provider(access_key: str, secret_key: str) -> KlingTokenProvider:
+    """
+    Один провайдер на пару ключей на весь процесс.
+    """
+    key = (access_key, secret_key)
+    with _providers_lock:
+        provider = _providers.get(key)
+        if provider is None:
+            provider = KlingTokenProvider(access_key, secret_key)
+            _providers[key] = provider
+    return provider
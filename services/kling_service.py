@@ -10,10 +10,14 @@
 
 import os
 import time
-import jwt
-import requests
+import uuid
 from dotenv import load_dotenv
 
+from services.kling_auth import get_token_provider
+from services.http_resilience import get_provider
+from services.http_pool import get_session
+from utils.cache import LRUCache
+
 load_dotenv()
 
 AK = os.getenv("KLING_ACCESS_KEY")
@@ -23,26 +27,28 @@ BASE_URL = os.getenv("KLING_API_BASE_URL", "https://api.klingai.com").rstrip("/"
 # Модель по умолчанию устанавливаем здесь.
 DEFAULT_IMAGE_MODEL = os.getenv("KLING_IMAGE_MODEL", "kling-v2-5-turbo")
 
+# Тип задачи -> путь эндпоинта (создание: POST, статус: GET .../{task_id})
+TASK_ENDPOINTS = {
+    "image2video": "/v1/videos/image2video",
+    "text2video": "/v1/videos/text2video",
+    "effects": "/v1/videos/effects",
+}
 
-def _make_jwt_token() -> str:
-    """
-    Генерирует JWT токен для Kling API.
-    """
-    if not AK or not SK:
-        raise RuntimeError("❌ Нет KLING_ACCESS_KEY или KLING_SECRET_KEY в .env")
+# task_id -> тип задачи, чтобы статус спрашивать ровно у одного эндпоинта
+_task_kinds = LRUCache(max_items=20000, ttl=24 * 3600)
 
-    now = int(time.time())
+# Повторы / circuit breaker (services/http_resilience.py)
+_api = get_provider("Kling")
+
+# Общий пул соединений к Kling (services/http_pool.py)
+_session = get_session("kling")
 
-    payload = {
-        "iss": AK,
-        "exp": now + 1800,
-        "nbf": now - 5,
-    }
 
-    token = jwt.encode(payload, SK, algorithm="HS256")
-    if isinstance(token, bytes):
-        token = token.decode("utf-8")
-    return token
+def _make_jwt_token() -> str:
+    """
+    JWT токен для Kling API (из общего кэша, подписывается раз в ~25 минут).
+    """
+    return get_token_provider(AK, SK).get_token()
 
 
 def _headers():
@@ -67,7 +73,7 @@ def create_kling_image_to_video(
     """
     Создаёт задачу анимации изображения на Kling.
     """
-    url = f"{BASE_URL}/v1/videos/image2video"
+    url = f"{BASE_URL}{TASK_ENDPOINTS['image2video']}"
 
     model_to_use = model_name or DEFAULT_IMAGE_MODEL
 
@@ -78,9 +84,15 @@ def create_kling_image_to_video(
         "mode": mode,
         "duration": str(duration),
         "cfg_scale": cfg_scale,
+        # наш id задачи: повтор того же запроса Kling не примет как новую задачу
+        "external_task_id": uuid.uuid4().hex,
     }
 
-    resp = requests.post(url, headers=_headers(), json=payload, timeout=60)
+    # создание повторяем, только если Kling запрос точно не принял
+    resp = _api.call(
+        lambda: _session.post(url, headers=_headers(), json=payload, timeout=60),
+        idempotent=False,
+    )
 
     if resp.status_code != 200:
         raise RuntimeError(f"Kling create error: {resp.status_code} {resp.text}")
@@ -97,14 +109,60 @@ def create_kling_image_to_video(
     if not task_id:
         raise RuntimeError(f"Kling response error: task_id not found. Raw: {data}")
 
+    _task_kinds.set(task_id, "image2video")
     return task_id
 
 
+# ------------------------------------------------------------
+#  Разбор ответа о задаче (общий для бота и web/backend.py)
+# ------------------------------------------------------------
+
+def parse_kling_task(data: dict) -> tuple[str, str | None]:
+    """
+    Достаёт (status, video_url) из ответа Kling о задаче любого типа.
+    """
+    block = data.get("data") if isinstance(data.get("data"), dict) else {}
+
+    status = (
+        data.get("status")
+        or data.get("task_status")
+        or block.get("status")
+        or block.get("task_status")
+        or "unknown"
+    )
+
+    # Ссылка на видео
+    result = (
+        data.get("task_result")
+        or block.get("task_result")
+        or data.get("data")
+    )
+
+    video_url = None
+
+    if isinstance(result, dict):
+        arr = result.get("videos") or result.get("video")
+        if isinstance(arr, list) and arr:
+            first = arr[0]
+            if isinstance(first, dict):
+                video_url = first.get("url") or first.get("video_url")
+            elif isinstance(first, str):
+                video_url = first
+        if not video_url:
+            video_url = result.get("video_url") or result.get("videoUrl")
+
+    return status.lower(), video_url
+
+
 # ------------------------------------------------------------
 #  Получение статуса задачи
 # ------------------------------------------------------------
 
-def get_kling_task_status(task_id: str) -> tuple[str, str | None]:
+def task_status_url(task_id: str, kind: str, base_url: str = BASE_URL) -> str:
+    return f"{base_url}{TASK_ENDPOINTS[kind]}/{task_id}"
+
+
+def get_kling_task_status(task_id: str, kind: str | None = None) -> tuple[str, str | None]:
     """
     Возвращает (status, video_url).
     status:
@@ -112,12 +170,17 @@ def get_kling_task_status(task_id: str) -> tuple[str, str | None]:
         processing / running – в процессе
         succeed / completed – готово
         failed – ошибка
+    kind — тип задачи ("image2video" / "text2video" / "effects").
+    Если он известен (передан или запомнен при создании) — ровно один запрос;
+    иначе перебираем image2video → text2video и запоминаем, где нашлась.
     """
-    img_url = f"{BASE_URL}/v1/videos/image2video/{task_id}"
-    txt_url = f"{BASE_URL}/v1/videos/text2video/{task_id}"
+    kind = kind or _task_kinds.get(task_id)
+    kinds = (kind,) if kind else ("image2video", "text2video")
 
-    for endpoint in (img_url, txt_url):
-        resp = requests.get(endpoint, headers=_headers(), timeout=60)
+    for k in kinds:
+        resp = _api.call(
+            lambda: _session.get(task_status_url(task_id, k), headers=_headers(), timeout=60),
+        )
 
         if resp.status_code == 404:
             continue
@@ -125,37 +188,8 @@ def get_kling_task_status(task_id: str) -> tuple[str, str | None]:
         if resp.status_code != 200:
             raise RuntimeError(f"Kling status error: {resp.status_code} {resp.text}")
 
-        data = resp.json()
-
-        status = (
-            data.get("status")
-            or data.get("task_status")
-            or data.get("data", {}).get("status")
-            or data.get("data", {}).get("task_status")
-            or "unknown"
-        )
-
-        # Ссылка на видео
-        result = (
-            data.get("task_result")
-            or data.get("data", {}).get("task_result")
-            or data.get("data")
-        )
-
-        video_url = None
-
-        if isinstance(result, dict):
-            arr = result.get("videos") or result.get("video")
-            if isinstance(arr, list) and arr:
-                first = arr[0]
-                if isinstance(first, dict):
-                    video_url = first.get("url") or first.get("video_url")
-                elif isinstance(first, str):
-                    video_url = first
-            if not video_url:
-                video_url = result.get("video_url") or result.get("videoUrl")
-
-        return status.lower(), video_url
+        _task_kinds.set(task_id, k)
+        return parse_kling_task(resp.json())
 
     raise RuntimeError("Kling: cannot get status from any endpoint")
 
@@ -164,9 +198,9 @@ def get_kling_task_status(task_id: str) -> tuple[str, str | None]:
 #  Блокирующий режим (не используется напрямую в боте)
 # ------------------------------------------------------------
 
-def poll_kling_result(task_id: str, max_attempts=30, delay=5) -> str:
+def poll_kling_result(task_id: str, max_attempts=30, delay=5, kind: str | None = None) -> str:
     for attempt in range(1, max_attempts + 1):
-        status, video_url = get_kling_task_status(task_id)
+        status, video_url = get_kling_task_status(task_id, kind=kind)
         print(f"[Kling] poll {attempt}: {status}")
 
         if status in ("succeed", "success", "completed"):
@@ -0,0 +1,488 @@
+# services/nanobanana_client.py
+#
+# Асинхронный клиент NanoBanana PRO (httpx.AsyncClient).
+# - один общий HTTP-пул с keep-alive на весь процесс
+# - ожидание /record-info через asyncio.sleep, без блокировки потоков
+# - сотни генераций одновременно на одном event loop
+#
+# Event loop живёт в отдельном фоновом потоке.
+# Синхронный код (хендлеры TeleBot, task_worker) вызывает корутины
+# через run_sync() — см. services/nanobanana_service.py.
+#
+# Если настроены NANOBANANA_CALLBACK_URL и NANOBANANA_CALLBACK_SECRET,
+# NanoBanana будит нас коллбэком в app.py (resolve_callback), а /record-info
+# опрашиваем редко — только как запасной вариант. Содержимому коллбэка
+# не доверяем: это только сигнал "проверь задачу", результат всегда
+# берём из /record-info.
+
+import asyncio
+import threading
+import time
+import weakref
+
+import httpx
+
+from services.http_resilience import get_provider
+from services.http_pool import HTTP2_AVAILABLE, get_httpx_trace
+from config import (
+    NANOBANANA_API_KEY,
+    NANOBANANA_BASE_URL,
+    NANOBANANA_MODEL,
+    NANOBANANA_CALLBACK_URL,
+    NANOBANANA_CALLBACK_SECRET,
+)
+
+
+# =============================================================
+# Базовые настройки
+# =============================================================
+
+BASE_URL = NANOBANANA_BASE_URL.rstrip("/")
+
+GENERATE_PRO_URL = f"{BASE_URL}/generate-pro"
+RECORD_INFO_URL = f"{BASE_URL}/record-info"
+
+HEADERS_JSON = {
+    "Authorization": f"Bearer {NANOBANANA_API_KEY}",
+    "Content-Type": "application/json",
+}
+
+# Пауза между опросами /record-info (сек)
+POLL_INTERVAL = 2
+
+# Когда коллбэки включены — опрашиваем только изредка, на случай если
+# коллбэк потерялся или пришёл в другой процесс
+CALLBACK_FALLBACK_INTERVAL = 20
+
+# Сколько помним коллбэки, пришедшие раньше, чем кто-то начал ждать задачу
+EARLY_CALLBACK_TTL = 600
+EARLY_CALLBACK_MAX = 10000
+
+# Без секрета коллбэки не включаем: эндпоинт в app.py их отклонит
+CALLBACKS_ENABLED = bool(NANOBANANA_CALLBACK_URL and NANOBANANA_CALLBACK_SECRET)
+
+if CALLBACKS_ENABLED:
+    CALLBACK_URL = f"{NANOBANANA_CALLBACK_URL}?secret={NANOBANANA_CALLBACK_SECRET}"
+else:
+    # API требует callBackUrl, даже если коллбэк нам не нужен
+    CALLBACK_URL = "https://example.com/callback"
+
+# Пул соединений: держим keep-alive к api.nanobananaapi.ai и CDN с картинками
+HTTP_LIMITS = httpx.Limits(
+    max_connections=200,
+    max_keepalive_connections=50,
+    keepalive_expiry=60,
+)
+HTTP_TIMEOUT = httpx.Timeout(90, connect=10)
+
+
+def _api_status(resp) -> int:
+    """
+    NanoBanana отвечает HTTP 200, а настоящий код кладёт в тело ("code").
+    """
+    if resp.status_code != 200:
+        return resp.status_code
+    try:
+        code = resp.json().get("code")
+    except Exception:
+        return resp.status_code
+    return code if isinstance(code, int) else resp.status_code
+
+
+# Повторы / circuit breaker для API (services/http_resilience.py)
+_api = get_provider("NanoBanana", status_of=_api_status)
+
+
+def _ensure_pro_model():
+    """
+    На всякий случай подсвечиваем, если модель в конфиге не PRO.
+    """
+    if NANOBANANA_MODEL != "nano-banana-pro":
+        print(
+            f"[NanoBanana] ВНИМАНИЕ: NANOBANANA_MODEL={NANOBANANA_MODEL}, "
+            f"но используется PRO-эндпоинт /generate-pro."
+        )
+
+
+# =============================================================
+# Event loop и общий HTTP-клиент
+# =============================================================
+
+_loop = None
+_loop_lock = threading.Lock()
+
+# loop -> httpx.AsyncClient (клиент нельзя делить между разными loop'ами)
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """
+    Фоновый event loop NanoBanana (создаётся при первом вызове).
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            t = threading.Thread(
+                target=loop.run_forever,
+                name="nanobanana-loop",
+                daemon=True,
+            )
+            t.start()
+            _loop = loop
+    return _loop
+
+
+def run_sync(coro):
+    """
+    Выполняет корутину на фоновом loop'е и ждёт результат в текущем потоке.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+def _client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=HTTP_LIMITS,
+            timeout=HTTP_TIMEOUT,
+            http2=HTTP2_AVAILABLE,
+            # счётчик новых соединений для метрики переиспользования
+            event_hooks={"request": [get_httpx_trace("nanobanana").on_request]},
+        )
+        _clients[loop] = client
+    return client
+
+
+# =============================================================
+# Создание задач
+# =============================================================
+
+async def _create_pro_task(payload: dict, label: str) -> str:
+    _ensure_pro_model()
+
+    # создание платное и без ключа идемпотентности — повторяем, только
+    # если задача точно не создана (нет соединения, 429, 503)
+    resp = await _api.call_async(
+        lambda: _client().post(GENERATE_PRO_URL, headers=HEADERS_JSON, json=payload),
+        idempotent=False,
+    )
+
+    try:
+        data = resp.json()
+    except Exception:
+        raise Exception(f"NanoBanana PRO{label}: не удалось разобрать ответ: {resp.text}")
+
+    if resp.status_code != 200 or data.get("code") != 200:
+        msg = data.get("msg") or data.get("message") or resp.text
+        raise Exception(f"NanoBanana PRO{label} ошибка: {msg}")
+
+    task_id = (data.get("data") or {}).get("taskId")
+    if not task_id:
+        raise Exception(f"NanoBanana PRO{label} не вернул taskId: {data}")
+
+    return task_id
+
+
+async def create_pro_text_task(prompt: str, resolution: str = "2K", aspect: str = "1:1") -> str:
+    """
+    TEXT -> IMAGE.
+    """
+    payload = {
+        "prompt": prompt,
+        "resolution": resolution,
+        "aspectRatio": aspect,
+        "callBackUrl": CALLBACK_URL,
+    }
+    return await _create_pro_task(payload, "")
+
+
+async def create_pro_image_task(prompt: str, image_url: str, resolution: str = "2K", aspect: str = "1:1") -> str:
+    """
+    IMAGE -> IMAGE (одно фото).
+    """
+    payload = {
+        "prompt": prompt,
+        "imageUrls": [image_url],
+        "resolution": resolution,
+        "aspectRatio": aspect,
+        "callBackUrl": CALLBACK_URL,
+    }
+    return await _create_pro_task(payload, " (image)")
+
+
+async def create_pro_multi_image_task(prompt: str, image_urls, resolution: str = "2K", aspect: str = "1:1") -> str:
+    """
+    MULTI-IMAGE Remix: общая сцена из нескольких изображений.
+    """
+    payload = {
+        "prompt": prompt,
+        "imageUrls": list(image_urls),
+        "resolution": resolution,
+        "aspectRatio": aspect,
+        "callBackUrl": CALLBACK_URL,
+    }
+    return await _create_pro_task(payload, " (multi)")
+
+
+# =============================================================
+# Опрос задачи
+# =============================================================
+
+async def fetch_record_info(task_id: str) -> dict:
+    """
+    Один запрос /record-info. Возвращает блок data.
+    """
+    resp = await _api.call_async(lambda: _client().get(
+        RECORD_INFO_URL,
+        headers={"Authorization": f"Bearer {NANOBANANA_API_KEY}"},
+        params={"taskId": task_id},
+    ))
+
+    try:
+        body = resp.json()
+    except Exception:
+        raise Exception(f"NanoBanana PRO record-info: не удалось разобрать ответ: {resp.text}")
+
+    if resp.status_code != 200 or body.get("code") != 200:
+        msg = body.get("msg") or body.get("message") or resp.text
+        raise Exception(f"NanoBanana PRO record-info ошибка: {msg}")
+
+    return body.get("data") or {}
+
+
+def status_from_record(data: dict) -> str:
+    """
+    successFlag: 0 = generating, 1 = success, 2/3 = failed
+    """
+    flag = data.get("successFlag")
+    if flag == 1:
+        return "success"
+    if flag in (2, 3):
+        return "failed"
+    return "generating"
+
+
+async def poll_task(task_id: str, timeout: int = 240):
+    """
+    Ожидаем завершения задачи, не блокируя поток.
+    С коллбэками — ждём коллбэк (или CALLBACK_FALLBACK_INTERVAL) и после
+    него проверяем /record-info, без коллбэков — опрашиваем каждые
+    POLL_INTERVAL сек.
+    Возвращает ("success" | "failed", data).
+    """
+    start = time.time()
+    fut = _register_waiter(task_id) if CALLBACKS_ENABLED else None
+
+    try:
+        while True:
+            if fut is not None:
+                left = max(0, timeout - (time.time() - start))
+                try:
+                    await asyncio.wait_for(
+                        asyncio.shield(fut),
+                        min(CALLBACK_FALLBACK_INTERVAL, left),
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                else:
+                    # коллбэк пришёл, но задача ещё не готова по /record-info —
+                    # дальше обычный опрос
+                    fut = None
+
+            data = await fetch_record_info(task_id)
+            status = status_from_record(data)
+
+            if status != "generating":
+                return status, data
+
+            if time.time() - start > timeout:
+                raise Exception("NanoBanana PRO timeout")
+
+            if fut is None:
+                await asyncio.sleep(POLL_INTERVAL)
+    finally:
+        if CALLBACKS_ENABLED:
+            _unregister_waiter(task_id)
+
+
+# =============================================================
+# Коллбэки о готовности задач
+# =============================================================
+
+_waiters = {}          # task_id -> (loop, future)
+_early_callbacks = {}  # task_id -> received_at, в порядке прихода
+_waiters_lock = threading.Lock()
+
+
+def _register_waiter(task_id: str) -> asyncio.Future:
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+
+    with _waiters_lock:
+        early = _early_callbacks.pop(task_id, None)
+        if early is None:
+            _waiters[task_id] = (loop, fut)
+
+    if early is not None:
+        fut.set_result(None)
+    return fut
+
+
+def _unregister_waiter(task_id: str):
+    with _waiters_lock:
+        _waiters.pop(task_id, None)
+
+
+def _wake(fut: asyncio.Future):
+    if not fut.done():
+        fut.set_result(None)
+
+
+def pop_early_callback(task_id: str) -> bool:
+    """
+    Был ли коллбэк по задаче, которую никто не ждал (для фонового воркера).
+    """
+    with _waiters_lock:
+        return _early_callbacks.pop(task_id, None) is not None
+
+
+def callback_task_id(body: dict):
+    """
+    taskId из тела коллбэка. Остальное содержимое (статус, URL картинки)
+    не используем — его проверяет /record-info.
+    """
+    block = body.get("data") if isinstance(body, dict) else None
+    if not isinstance(block, dict):
+        return None
+    task_id = block.get("taskId")
+    return str(task_id) if task_id else None
+
+
+def resolve_callback(body: dict):
+    """
+    Принимает коллбэк NanoBanana (из любого потока / event loop'а)
+    и будит того, кто ждёт эту задачу. Возвращает taskId или None.
+    """
+    task_id = callback_task_id(body)
+    if not task_id:
+        return None
+
+    with _waiters_lock:
+        waiter = _waiters.get(task_id)
+        if waiter is None:
+            # чистим протухшие / лишние записи (самые старые — первые)
+            now = time.time()
+            for tid, ts in list(_early_callbacks.items()):
+                if now - ts < EARLY_CALLBACK_TTL and len(_early_callbacks) < EARLY_CALLBACK_MAX:
+                    break
+                _early_callbacks.pop(tid, None)
+            _early_callbacks[task_id] = now
+
+    if waiter is not None:
+        loop, fut = waiter
+        loop.call_soon_threadsafe(_wake, fut)
+
+    return task_id
+
+
+# =============================================================
+# Результат
+# =============================================================
+
+def extract_result_url(data: dict) -> str:
+    """
+    Достаёт resultImageUrl из ответа.
+    """
+    response_block = data.get("response") or {}
+    url = response_block.get("resultImageUrl")
+    if not url:
+        raise Exception(f"NanoBanana PRO: нет resultImageUrl: {data}")
+    return url
+
+
+async def download_result_bytes(url: str) -> bytes:
+    """
+    Скачивает картинку по URL и возвращает байты.
+    """
+    img = await _client().get(url)
+    if img.status_code != 200:
+        raise Exception(f"NanoBanana PRO: не удалось скачать картинку: {img.status_code}")
+    return img.content
+
+
+async def _finish(task_id: str, error_text: str, return_url: bool, download: bool = True):
+    status, data = await poll_task(task_id)
+
+    if status != "success":
+        raise Exception(data.get("errorMessage") or error_text)
+
+    url = extract_result_url(data)
+    if not download:
+        return url
+
+    img_bytes = await download_result_bytes(url)
+
+    if return_url:
+        return img_bytes, url
+    return img_bytes
+
+
+# =============================================================
+# Публичный async API
+# =============================================================
+
+async def generate_image(
+    prompt: str,
+    resolution: str = "2K",
+    aspect: str = "1:1",
+    return_url: bool = False,
+    download: bool = True,
+):
+    """
+    TEXT → IMAGE. Возвращает байты или (байты, url).
+    download=False — не качать картинку, вернуть только url результата.
+    """
+    task_id = await create_pro_text_task(prompt, resolution=resolution, aspect=aspect)
+    return await _finish(task_id, "Ошибка генерации", return_url, download)
+
+
+async def generate_image_from_url(
+    image_url: str,
+    prompt: str,
+    resolution: str = "2K",
+    aspect: str = "1:1",
+    return_url: bool = False,
+    download: bool = True,
+):
+    """
+    IMAGE → IMAGE (одно фото).
+    """
+    task_id = await create_pro_image_task(
+        prompt=prompt,
+        image_url=image_url,
+        resolution=resolution,
+        aspect=aspect,
+    )
+    return await _finish(task_id, "Ошибка обработки изображения", return_url, download)
+
+
+async def generate_scene_from_urls(
+    image_urls,
+    prompt: str,
+    resolution: str = "2K",
+    aspect: str = "1:1",
+    return_url: bool = False,
+    download: bool = True,
+):
+    """
+    MULTI-IMAGE Remix → общая сцена.
+    """
+    task_id = await create_pro_multi_image_task(
+        prompt=prompt,
+        image_urls=image_urls,
+        resolution=resolution,
+        aspect=aspect,
+    )
+    return await _finish(task_id, "Ошибка мульти-сцены", return_url, download)
@@ -7,39 +7,25 @@
 #   - IMAGE -> IMAGE (одно фото)
 #   - MULTI-IMAGE Remix -> общая сцена из нескольких фото
 #   - возврат bytes + оригинальный resultImageUrl
+#
+# Сетевой код — в services/nanobanana_client.py (asyncio + httpx),
+# здесь синхронные обёртки с прежними сигнатурами.
+# TEXT -> IMAGE может брать готовый результат из services/prompt_cache.py.
 
-import time
-import requests
-from config import NANOBANANA_API_KEY, NANOBANANA_BASE_URL, NANOBANANA_MODEL
+from services import nanobanana_client as nb
+from services.nanobanana_client import run_sync
+from services.prompt_cache import get_cached_result, store_result
 
 
 # =============================================================
-# Базовые настройки
+# Синхронные обёртки над services/nanobanana_client.py
 # =============================================================
+# Вся сетевая работа (общий HTTP-пул, ожидание через asyncio.sleep)
+# живёт в асинхронном клиенте; здесь — тонкие обёртки для хендлеров
+# TeleBot и task_worker, которые работают в обычных потоках.
 
-if not NANOBANANA_BASE_URL.endswith("/"):
-    BASE_URL = NANOBANANA_BASE_URL
-else:
-    BASE_URL = NANOBANANA_BASE_URL.rstrip("/")
-
-GENERATE_PRO_URL = f"{BASE_URL}/generate-pro"
-RECORD_INFO_URL = f"{BASE_URL}/record-info"
-
-HEADERS_JSON = {
-    "Authorization": f"Bearer {NANOBANANA_API_KEY}",
-    "Content-Type": "application/json",
-}
-
-
-def _ensure_pro_model():
-    """
-    На всякий случай подсвечиваем, если модель в конфиге не PRO.
-    """
-    if NANOBANANA_MODEL != "nano-banana-pro":
-        print(
-            f"[NanoBanana] ВНИМАНИЕ: NANOBANANA_MODEL={NANOBANANA_MODEL}, "
-            f"но используется PRO-эндпоинт /generate-pro."
-        )
+GENERATE_PRO_URL = nb.GENERATE_PRO_URL
+RECORD_INFO_URL = nb.RECORD_INFO_URL
 
 
 # =============================================================
@@ -56,36 +42,7 @@ def create_pro_text_task(
     resolution: "1K" / "2K" / "4K"
     aspect: "1:1" / "16:9" / "9:16" / "3:4" / ...
     """
-    _ensure_pro_model()
-
-    payload = {
-        "prompt": prompt,
-        "resolution": resolution,
-        "aspectRatio": aspect,
-        "callBackUrl": "https://example.com/callback",
-    }
-
-    resp = requests.post(
-        GENERATE_PRO_URL,
-        headers=HEADERS_JSON,
-        json=payload,
-        timeout=90,
-    )
-
-    try:
-        data = resp.json()
-    except Exception:
-        raise Exception(f"NanoBanana PRO: не удалось разобрать ответ: {resp.text}")
-
-    if resp.status_code != 200 or data.get("code") != 200:
-        msg = data.get("msg") or data.get("message") or resp.text
-        raise Exception(f"NanoBanana PRO ошибка: {msg}")
-
-    task_id = (data.get("data") or {}).get("taskId")
-    if not task_id:
-        raise Exception(f"NanoBanana PRO не вернул taskId: {data}")
-
-    return task_id
+    return run_sync(nb.create_pro_text_task(prompt, resolution=resolution, aspect=aspect))
 
 
 def create_pro_image_task(
@@ -97,37 +54,7 @@ def create_pro_image_task(
     """
     IMAGE -> IMAGE (одно фото).
     """
-    _ensure_pro_model()
-
-    payload = {
-        "prompt": prompt,
-        "imageUrls": [image_url],
-        "resolution": resolution,
-        "aspectRatio": aspect,
-        "callBackUrl": "https://example.com/callback",
-    }
-
-    resp = requests.post(
-        GENERATE_PRO_URL,
-        headers=HEADERS_JSON,
-        json=payload,
-        timeout=90,
-    )
-
-    try:
-        data = resp.json()
-    except Exception:
-        raise Exception(f"NanoBanana PRO (image): не удалось разобрать ответ: {resp.text}")
-
-    if resp.status_code != 200 or data.get("code") != 200:
-        msg = data.get("msg") or data.get("message") or resp.text
-        raise Exception(f"NanoBanana PRO (image) ошибка: {msg}")
-
-    task_id = (data.get("data") or {}).get("taskId")
-    if not task_id:
-        raise Exception("NanoBanana PRO image: taskId не найден")
-
-    return task_id
+    return run_sync(nb.create_pro_image_task(prompt, image_url, resolution=resolution, aspect=aspect))
 
 
 def create_pro_multi_image_task(
@@ -140,37 +67,7 @@ def create_pro_multi_image_task(
     MULTI-IMAGE Remix: общая сцена из нескольких изображений.
     image_urls: список URL исходных картинок.
     """
-    _ensure_pro_model()
-
-    payload = {
-        "prompt": prompt,
-        "imageUrls": image_urls,
-        "resolution": resolution,
-        "aspectRatio": aspect,
-        "callBackUrl": "https://example.com/callback",
-    }
-
-    resp = requests.post(
-        GENERATE_PRO_URL,
-        headers=HEADERS_JSON,
-        json=payload,
-        timeout=90,
-    )
-
-    try:
-        data = resp.json()
-    except Exception:
-        raise Exception(f"NanoBanana PRO (multi): не удалось разобрать ответ: {resp.text}")
-
-    if resp.status_code != 200 or data.get("code") != 200:
-        msg = data.get("msg") or data.get("message") or resp.text
-        raise Exception(f"NanoBanana PRO (multi) ошибка: {msg}")
-
-    task_id = (data.get("data") or {}).get("taskId")
-    if not task_id:
-        raise Exception("NanoBanana PRO multi: taskId не найден")
-
-    return task_id
+    return run_sync(nb.create_pro_multi_image_task(prompt, image_urls, resolution=resolution, aspect=aspect))
 
 
 # =============================================================
@@ -182,38 +79,7 @@ def poll_task(task_id: str, timeout: int = 240):
     Ожидаем завершения задачи.
     timeout — общий лимит ожидания (сек).
     """
-    start = time.time()
-
-    while True:
-        resp = requests.get(
-            RECORD_INFO_URL,
-            headers={"Authorization": f"Bearer {NANOBANANA_API_KEY}"},
-            params={"taskId": task_id},
-            timeout=60,
-        )
-
-        try:
-            body = resp.json()
-        except Exception:
-            raise Exception(f"NanoBanana PRO record-info: не удалось разобрать ответ: {resp.text}")
-
-        if resp.status_code != 200 or body.get("code") != 200:
-            msg = body.get("msg") or body.get("message") or resp.text
-            raise Exception(f"NanoBanana PRO record-info ошибка: {msg}")
-
-        data = body.get("data") or {}
-        flag = data.get("successFlag")
-
-        # 0 = generating, 1 = success, 2/3 = failed
-        if flag == 1:
-            return "success", data
-        elif flag in (2, 3):
-            return "failed", data
-
-        if time.time() - start > timeout:
-            raise Exception("NanoBanana PRO timeout")
-
-        time.sleep(2)
+    return run_sync(nb.poll_task(task_id, timeout=timeout))
 
 
 # =============================================================
@@ -224,21 +90,14 @@ def _extract_result_url(data: dict) -> str:
     """
     Достаёт resultImageUrl из ответа.
     """
-    response_block = data.get("response") or {}
-    url = response_block.get("resultImageUrl")
-    if not url:
-        raise Exception(f"NanoBanana PRO: нет resultImageUrl: {data}")
-    return url
+    return nb.extract_result_url(data)
 
 
 def _download_result_bytes(url: str) -> bytes:
     """
     Скачивает картинку по URL и возвращает байты.
     """
-    img = requests.get(url, timeout=90)
-    if img.status_code != 200:
-        raise Exception(f"NanoBanana PRO: не удалось скачать картинку: {img.status_code}")
-    return img.content
+    return run_sync(nb.download_result_bytes(url))
 
 
 # =============================================================
@@ -250,6 +109,7 @@ def generate_image(
     resolution: str = "2K",
     aspect: str = "1:1",
     return_url: bool = False,
+    download: bool = True,
 ):
     """
     Генерация по текстовому описанию.
@@ -257,22 +117,34 @@ def generate_image(
     return_url:
       False → вернуть только байты
       True  → вернуть (байты, url)
+    download=False → картинку не качать, вернуть только url
+      (для отправки через services/telegram_delivery.py)
     """
 
     print(f"[NanoBanana] generate_image(prompt=..., resolution={resolution}, aspect={aspect})")
 
-    task_id = create_pro_text_task(prompt, resolution=resolution, aspect=aspect)
-    status, data = poll_task(task_id)
-
-    if status != "success":
-        raise Exception(data.get("errorMessage") or "Ошибка генерации")
-
-    url = _extract_result_url(data)
-    img_bytes = _download_result_bytes(url)
-
-    if return_url:
-        return img_bytes, url
-    return img_bytes
+    # Тот же промпт уже генерировали — новую задачу не создаём
+    url = get_cached_result(prompt, resolution, aspect)
+    if url:
+        print("[NanoBanana] generate_image: результат из кэша промптов")
+        if not download:
+            return url
+        img = _download_result_bytes(url)
+        return (img, url) if return_url else img
+
+    if not download:
+        url = run_sync(nb.generate_image(prompt, resolution=resolution, aspect=aspect, download=False))
+        store_result(prompt, resolution, aspect, url)
+        return url
+
+    img, url = run_sync(nb.generate_image(
+        prompt,
+        resolution=resolution,
+        aspect=aspect,
+        return_url=True,
+    ))
+    store_result(prompt, resolution, aspect, url)
+    return (img, url) if return_url else img
 
 
 # =============================================================
@@ -285,6 +157,7 @@ def generate_image_from_url(
     resolution: str = "2K",
     aspect: str = "1:1",
     return_url: bool = False,
+    download: bool = True,
 ):
     """
     Редактирование по URL исходного изображения.
@@ -293,23 +166,14 @@ def generate_image_from_url(
 
     print(f"[NanoBanana] generate_image_from_url(prompt=..., resolution={resolution}, aspect={aspect})")
 
-    task_id = create_pro_image_task(
-        prompt=prompt,
-        image_url=image_url,
+    return run_sync(nb.generate_image_from_url(
+        image_url,
+        prompt,
         resolution=resolution,
         aspect=aspect,
-    )
-    status, data = poll_task(task_id)
-
-    if status != "success":
-        raise Exception(data.get("errorMessage") or "Ошибка обработки изображения")
-
-    url = _extract_result_url(data)
-    img_bytes = _download_result_bytes(url)
-
-    if return_url:
-        return img_bytes, url
-    return img_bytes
+        return_url=return_url,
+        download=download,
+    ))
 
 
 # =============================================================
@@ -322,6 +186,7 @@ def generate_scene_from_urls(
     resolution: str = "2K",
     aspect: str = "1:1",
     return_url: bool = False,
+    download: bool = True,
 ):
     """
     MULTI-IMAGE Remix: создаёт одну общую сцену из нескольких фото.
@@ -333,32 +198,24 @@ def generate_scene_from_urls(
         f"resolution={resolution}, aspect={aspect})"
     )
 
-    task_id = create_pro_multi_image_task(
-        prompt=prompt,
-        image_urls=image_urls,
+    return run_sync(nb.generate_scene_from_urls(
+        image_urls,
+        prompt,
         resolution=resolution,
         aspect=aspect,
-    )
-    status, data = poll_task(task_id)
-
-    if status != "success":
-        raise Exception(data.get("errorMessage") or "Ошибка мульти-сцены")
-
-    url = _extract_result_url(data)
-    img_bytes = _download_result_bytes(url)
-
-    if return_url:
-        return img_bytes, url
-    return img_bytes
+        return_url=return_url,
+        download=download,
+    ))
 
 
 # =============================================================
 # Для фонового воркера
 # =============================================================
 
-def check_generation_task(task_id: str):
+def check_generation_task(task_id: str, download: bool = True):
     """
     Для фонового воркера.
+    download=False — картинку не качаем (image_bytes=None), нужен только url.
     Возвращает:
     {
       "done": bool,
@@ -368,12 +225,15 @@ def check_generation_task(task_id: str):
       "error": str | None,
     }
     """
-    status, data = poll_task(task_id, timeout=10)
+    # коллбэк — только сигнал, результат всегда из /record-info
+    nb.pop_early_callback(task_id)
+    data = run_sync(nb.fetch_record_info(task_id))
+    status = nb.status_from_record(data)
 
     if status == "success":
         try:
             url = _extract_result_url(data)
-            img = _download_result_bytes(url)
+            img = _download_result_bytes(url) if download else None
         except Exception as e:
             return {
                 "done": True,
@@ -0,0 +1,51 @@
+# services/prompt_cache.py
+#
+# Кэш результатов TEXT -> IMAGE (включается PROMPT_CACHE_ENABLED=1).
+# Ключ — нормализованные (prompt, resolution, aspect, model): регистр и
+# лишние пробелы не важны. Значение — URL готовой картинки.
+# Повторный такой же запрос не создаёт новую платную задачу PRO.
+# file_id отдельно не храним: повторная отправка по тому же URL уже идёт
+# по file_id из services/telegram_delivery.py (таблица media_file_ids).
+
+import hashlib
+import re
+
+from config import (
+    NANOBANANA_MODEL,
+    PROMPT_CACHE_ENABLED,
+    PROMPT_CACHE_TTL,
+    PROMPT_CACHE_MAX_ITEMS,
+)
+from utils.cache import LRUCache
+
+_results = LRUCache(max_items=PROMPT_CACHE_MAX_ITEMS, ttl=PROMPT_CACHE_TTL)
+
+
+def normalize_prompt(prompt: str) -> str:
+    return re.sub(r"\s+", " ", (prompt or "").strip()).casefold()
+
+
+def prompt_key(prompt: str, resolution: str, aspect: str, model: str = NANOBANANA_MODEL) -> str:
+    raw = "\n".join((normalize_prompt(prompt), resolution.upper(), aspect, model))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def get_cached_result(prompt: str, resolution: str, aspect: str) -> str | None:
+    """
+    URL готового результата или None (в т.ч. если кэш выключен).
+    """
+    if not PROMPT_CACHE_ENABLED:
+        return None
+    return _results.get(prompt_key(prompt, resolution, aspect))
+
+
+def store_result(prompt: str, resolution: str, aspect: str, url: str):
+    if not PROMPT_CACHE_ENABLED or not url:
+        return
+    _results.set(prompt_key(prompt, resolution, aspect), url)
+
+
+def prompt_cache_stats() -> dict:
+    stats = _results.stats()
+    stats["enabled"] = PROMPT_CACHE_ENABLED
+    return stats
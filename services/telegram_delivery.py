@@ -0,0 +1,328 @@
+# services/telegram_delivery.py
+#
+# Доставка готовых картинок в Telegram без буферизации целиком в памяти.
+#
+# 1) Сначала отдаём Telegram просто URL результата — он сам скачает картинку
+#    (наш процесс байты вообще не трогает).
+# 2) Если Telegram прямо ответил, что не смог скачать URL (лимит размера,
+#    недоступный хост, не тот Content-Type) — сами качаем картинку потоком
+#    и тут же потоком же отдаём в sendPhoto (multipart собирается на лету,
+#    в памяти — только буфер CHUNK_SIZE). На прочие ошибки (таймаут и т.п.)
+#    повторно не шлём: Telegram мог уже доставить фото.
+#
+# Что уже однажды загружено в Telegram, повторно не грузим: file_id из
+# первого ответа запоминается в SQLite (таблица media_file_ids) по ключу
+# sha256 от содержимого или от URL результата, и дальше отправляем по нему.
+
+import hashlib
+import io
+import json
+import tempfile
+import threading
+import time
+import uuid
+
+from telebot import apihelper, types
+
+from services.db import get_media_file_id, set_media_file_id, delete_media_file_id
+from services.http_pool import get_session
+
+# Размер куска при перекачке (байт)
+CHUNK_SIZE = 64 * 1024
+
+# Если CDN не прислал Content-Length — копим во временный файл,
+# в памяти держим не больше этого
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+TELEGRAM_API_URL = "https://api.telegram.org/bot{0}/{1}"
+
+# Ответы Telegram "не смог скачать картинку по URL" — только тогда
+# перекачиваем её сами
+URL_FETCH_ERRORS = (
+    "failed to get http url content",
+    "wrong type of the web page content",
+)
+
+# Ответы Telegram "такого file_id больше нет" — только тогда забываем
+# сохранённый file_id и загружаем заново
+STALE_FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+)
+
+# Общие пулы соединений: CDN с результатами и Bot API
+_cdn = get_session("cdn")
+_telegram = get_session("telegram")
+
+# Метрики доставки
+DELIVERY_STATS = {
+    "file_id_hits": 0,
+    "file_id_stale": 0,
+    "url_sends": 0,
+    "stream_uploads": 0,
+    "byte_uploads": 0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str):
+    with _stats_lock:
+        DELIVERY_STATS[name] += 1
+
+
+def delivery_stats() -> dict:
+    with _stats_lock:
+        return dict(DELIVERY_STATS)
+
+
+# =============================================================
+# Кэш file_id
+# =============================================================
+
+def media_key_for_bytes(data: bytes) -> str:
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def media_key_for_url(url: str) -> str:
+    return "url:" + hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def _file_id_from_message(msg) -> str | None:
+    if msg is None:
+        return None
+    if getattr(msg, "photo", None):
+        return msg.photo[-1].file_id  # самый большой размер
+    if getattr(msg, "video", None):
+        return msg.video.file_id
+    if getattr(msg, "animation", None):
+        return msg.animation.file_id
+    return None
+
+
+def _remember(media_key: str, msg):
+    file_id = _file_id_from_message(msg)
+    if not file_id:
+        return
+    try:
+        set_media_file_id(media_key, file_id, time.time())
+    except Exception as e:
+        print(f"[Delivery] не удалось сохранить file_id: {e}")
+
+
+def _is_stale_file_id_error(exc: apihelper.ApiTelegramException) -> bool:
+    description = (exc.description or "").lower()
+    return exc.error_code == 400 and any(text in description for text in STALE_FILE_ID_ERRORS)
+
+
+def _send_cached(send, media_key: str, chat_id, **kwargs):
+    """
+    Отправляет медиа по сохранённому file_id. None — если его нет
+    или Telegram его больше не принимает (тогда запись удаляем).
+    Остальные ошибки (бот заблокирован, ошибка подписи, таймаут после
+    доставки) пробрасываем: повторная загрузка их не исправит, а фото
+    могло уже дойти.
+    """
+    try:
+        file_id = get_media_file_id(media_key, time.time())
+    except Exception as e:
+        print(f"[Delivery] кэш file_id недоступен: {e}")
+        return None
+
+    if not file_id:
+        return None
+
+    try:
+        msg = send(chat_id, file_id, **kwargs)
+    except apihelper.ApiTelegramException as e:
+        if not _is_stale_file_id_error(e):
+            raise
+        print(f"[Delivery] file_id устарел ({e.description}), загружаю заново")
+        _count("file_id_stale")
+        delete_media_file_id(media_key)
+        return None
+
+    _count("file_id_hits")
+    return msg
+
+
+# =============================================================
+# multipart/form-data, читаемый кусками
+# =============================================================
+
+class _RawReader:
+    """
+    Читает тело ответа requests (stream=True) кусками нужного размера.
+    """
+
+    def __init__(self, resp):
+        self._raw = resp.raw
+
+    def read(self, size=-1):
+        return self._raw.read(size if size and size > 0 else None, decode_content=True)
+
+
+class _MultipartBody:
+    """
+    Тело multipart/form-data: обычные поля + один файл из потока.
+    requests отправляет его кусками (есть read() и __len__ для Content-Length).
+    """
+
+    def __init__(self, fields: dict, file_field: str, filename: str, source, length: int,
+                 content_type: str = "application/octet-stream"):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+
+        head = b""
+        for name, value in fields.items():
+            if value is None:
+                continue
+            head += (
+                f"--{boundary}\r\n"
+                f"Content-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+                f"{value}\r\n"
+            ).encode("utf-8")
+        head += (
+            f"--{boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"{file_field}\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode("utf-8")
+        tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+        self._parts = [io.BytesIO(head), source, io.BytesIO(tail)]
+        self._length = len(head) + length + len(tail)
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = CHUNK_SIZE
+
+        while self._parts:
+            chunk = self._parts[0].read(size)
+            if chunk:
+                return chunk
+            self._parts.pop(0)
+        return b""
+
+
+# =============================================================
+# Отправка
+# =============================================================
+
+def _stream_upload_photo(bot, chat_id, url, caption=None, parse_mode=None, reply_markup=None):
+    """
+    Качает картинку по url потоком и сразу же потоком отправляет в sendPhoto.
+    """
+    fields = {
+        "chat_id": chat_id,
+        "caption": caption,
+        "parse_mode": parse_mode,
+        "reply_markup": reply_markup.to_json() if reply_markup is not None else None,
+    }
+
+    with _cdn.get(url, stream=True, timeout=90) as src:
+        if src.status_code != 200:
+            raise Exception(f"Не удалось скачать картинку: {src.status_code}")
+
+        content_type = src.headers.get("Content-Type") or "image/png"
+        length = src.headers.get("Content-Length")
+
+        if length and not src.headers.get("Content-Encoding"):
+            # Размер известен — перекачиваем напрямую, без промежуточного файла
+            source, size = _RawReader(src), int(length)
+        else:
+            source = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+            for chunk in src.iter_content(CHUNK_SIZE):
+                source.write(chunk)
+            size = source.tell()
+            source.seek(0)
+
+        body = _MultipartBody(fields, "photo", "image.png", source, size, content_type)
+
+        # как и сам TeleBot: apihelper.API_URL (свой Bot API сервер) и прокси
+        resp = _telegram.post(
+            (apihelper.API_URL or TELEGRAM_API_URL).format(bot.token, "sendPhoto"),
+            data=body,
+            headers={"Content-Type": body.content_type},
+            timeout=(15, 120),
+            proxies=apihelper.proxy,
+        )
+
+    result = resp.json()
+    if not result.get("ok"):
+        if "error_code" in result:
+            raise apihelper.ApiTelegramException("sendPhoto", resp, result)
+        raise Exception(f"Telegram sendPhoto: {result.get('description') or resp.text}")
+
+    return types.Message.de_json(json.dumps(result["result"]))
+
+
+def _is_url_fetch_error(exc: apihelper.ApiTelegramException) -> bool:
+    description = (exc.description or "").lower()
+    return exc.error_code == 400 and any(text in description for text in URL_FETCH_ERRORS)
+
+
+def send_photo_from_url(bot, chat_id, url, caption=None, parse_mode=None, reply_markup=None):
+    """
+    Отправляет картинку по URL результата. Возвращает Message.
+    Если она уже уходила в Telegram — по file_id; иначе сначала Telegram
+    качает её сам, а если не вышло — стримим через себя.
+    """
+    media_key = media_key_for_url(url)
+    kwargs = {"caption": caption, "parse_mode": parse_mode, "reply_markup": reply_markup}
+
+    msg = _send_cached(bot.send_photo, media_key, chat_id, **kwargs)
+    if msg is not None:
+        return msg
+
+    try:
+        msg = bot.send_photo(chat_id, url, **kwargs)
+        _count("url_sends")
+    except apihelper.ApiTelegramException as e:
+        if not _is_url_fetch_error(e):
+            raise
+        print(f"[Delivery] Telegram не смог скачать URL ({e.description}), отправляю потоком")
+        msg = _stream_upload_photo(bot, chat_id, url, **kwargs)
+        _count("stream_uploads")
+
+    _remember(media_key, msg)
+    return msg
+
+
+def send_photo_bytes(bot, chat_id, data: bytes, caption=None, parse_mode=None, reply_markup=None):
+    """
+    Отправляет картинку из байтов; одинаковое содержимое грузится один раз.
+    """
+    media_key = media_key_for_bytes(data)
+    kwargs = {"caption": caption, "parse_mode": parse_mode, "reply_markup": reply_markup}
+
+    msg = _send_cached(bot.send_photo, media_key, chat_id, **kwargs)
+    if msg is not None:
+        return msg
+
+    bio = io.BytesIO(data)
+    bio.name = "image.png"
+    msg = bot.send_photo(chat_id, bio, **kwargs)
+    _count("byte_uploads")
+
+    _remember(media_key, msg)
+    return msg
+
+
+def send_video_from_url(bot, chat_id, url, caption=None, parse_mode=None, reply_markup=None):
+    """
+    Отправляет видео по URL (Kling); повторно — по сохранённому file_id.
+    """
+    media_key = media_key_for_url(url)
+    kwargs = {"caption": caption, "parse_mode": parse_mode, "reply_markup": reply_markup}
+
+    msg = _send_cached(bot.send_video, media_key, chat_id, **kwargs)
+    if msg is not None:
+        return msg
+
+    msg = bot.send_video(chat_id, url, **kwargs)
+    _count("url_sends")
+
+    _remember(media_key, msg)
+    return msg
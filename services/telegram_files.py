@@ -0,0 +1,87 @@
+# services/telegram_files.py
+#
+# file_id → прямая ссылка на файл в Telegram (для NanoBanana / Kling).
+#
+# - bot.get_file() для нескольких фото выполняем параллельно, а не по очереди;
+# - результат кэшируем: Telegram гарантирует, что ссылка живёт не меньше часа,
+#   поэтому держим её FILE_PATH_TTL (чуть меньше часа);
+# - prefetch_file() можно звать сразу, как только фото пришло, — к моменту
+#   запуска генерации ссылка уже будет в кэше.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.cache import LRUCache
+
+# Ссылка Telegram действительна минимум 1 час — берём с запасом
+FILE_PATH_TTL = 55 * 60
+
+# Сколько get_file выполняем одновременно
+RESOLVE_CONCURRENCY = 8
+
+TELEGRAM_FILE_URL = "https://api.telegram.org/file/bot{0}/{1}"
+
+# file_id -> file_path
+_paths = LRUCache(max_items=20000, ttl=FILE_PATH_TTL)
+
+# file_id -> Future: запросы, которые уже в пути (второй раз не шлём)
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+_executor = ThreadPoolExecutor(max_workers=RESOLVE_CONCURRENCY, thread_name_prefix="tg-getfile")
+
+
+def _fetch_path(bot, file_id: str) -> str:
+    try:
+        file_path = bot.get_file(file_id).file_path
+        _paths.set(file_id, file_path)
+        return file_path
+    finally:
+        with _inflight_lock:
+            _inflight.pop(file_id, None)
+
+
+def prefetch_file(bot, file_id: str):
+    """
+    Запускает get_file в фоне (если ссылки ещё нет в кэше). Возвращает Future
+    или None, если ссылка уже известна.
+    """
+    if file_id in _paths:
+        return None
+
+    with _inflight_lock:
+        future = _inflight.get(file_id)
+        if future is None:
+            future = _executor.submit(_fetch_path, bot, file_id)
+            _inflight[file_id] = future
+    return future
+
+
+def _file_url(bot, file_path: str) -> str:
+    return TELEGRAM_FILE_URL.format(bot.token, file_path)
+
+
+def resolve_file_urls(bot, file_ids: list[str]) -> list[str]:
+    """
+    Прямые ссылки на файлы в том же порядке, что и file_ids.
+    Всё, чего нет в кэше, запрашивается параллельно.
+    """
+    futures = {fid: prefetch_file(bot, fid) for fid in file_ids}
+
+    urls = []
+    for fid in file_ids:
+        future = futures[fid]
+        file_path = future.result() if future is not None else _paths.get(fid)
+        if file_path is None:
+            # успело протухнуть между проверкой и чтением
+            file_path = _fetch_path(bot, fid)
+        urls.append(_file_url(bot, file_path))
+    return urls
+
+
+def resolve_file_url(bot, file_id: str) -> str:
+    return resolve_file_urls(bot, [file_id])[0]
+
+
+def file_cache_stats() -> dict:
+    return _paths.stats()
@@ -1,81 +1,154 @@
 # task_worker.py
+#
+# Фоновый воркер очереди NanoBanana.
+# Очередь лежит в SQLite (utils/tasks.py), поэтому воркеров может быть
+# несколько (по одному на процесс): задачи разбираются через аренду.
+# Раз в TICK берём задачи, у которых подошло время опроса, — ровно столько,
+# сколько есть свободных мест в пуле, — и сразу отдаём в пул потоков.
+# Общего ожидания "пока доделается весь цикл" нет: одна медленная задача
+# занимает только свой поток, остальные продолжают опрашиваться.
+# Чем дольше задача генерится, тем реже её опрашиваем (экспоненциальная пауза).
 
 import time
+import threading
 import traceback
-from io import BytesIO
-
-import requests
+from concurrent.futures import ThreadPoolExecutor
 
 from loader import bot
 from utils.tasks import (
-    get_all_pending_generations,
+    lease_pending_generations,
+    claim_pending_generation,
+    reschedule_pending_generation,
     remove_pending_generation,
     create_task,
 )
-# Эту функцию мы уже исправили в nanobanana_service.py
-from services.nanobanana_service import check_generation_task 
+from services.nanobanana_service import check_generation_task
+from services.telegram_delivery import send_photo_from_url
+
+# Сколько задач опрашиваем одновременно
+POLL_CONCURRENCY = 16
+
+# Пауза между проверками очереди (сек)
+TICK = 1
+
+# Сколько задач максимум держим взятыми (в работе + ждут потока)
+# и на сколько (сек) их арендуем
+MAX_IN_FLIGHT = POLL_CONCURRENCY * 2
+LEASE_SECONDS = 120
+
+# Аренда на время доставки результата: если процесс умер посреди отправки,
+# после неё задачу снова заберёт воркер
+DELIVERY_LEASE_SECONDS = 120
+
+# Пауза до следующего опроса: BASE * 2^(возраст // STEP), но не больше MAX
+BASE_POLL_DELAY = 3
+MAX_POLL_DELAY = 60
+BACKOFF_STEP = 30
+
+# Метрики воркера (отдаются в app.py: /metrics/worker).
+# lag — насколько позже назначенного next_poll_at задачу реально взяли.
+# Все счётчики меняются только под _stats_lock.
+WORKER_STATS = {
+    "cycles": 0,
+    "leased": 0,
+    "polled": 0,
+    "in_flight": 0,
+    "last_poll_seconds": 0.0,
+    "max_poll_seconds": 0.0,
+    "last_lag_seconds": 0.0,
+    "max_lag_seconds": 0.0,
+}
+_stats_lock = threading.Lock()
+
+
+def worker_stats() -> dict:
+    with _stats_lock:
+        return dict(WORKER_STATS)
+
+
+_executor = ThreadPoolExecutor(max_workers=POLL_CONCURRENCY, thread_name_prefix="nb-poll")
+
+
+def _next_poll_delay(age: float) -> float:
+    """
+    Пауза до следующего опроса задачи в зависимости от её возраста.
+    """
+    return min(MAX_POLL_DELAY, BASE_POLL_DELAY * 2 ** int(age // BACKOFF_STEP))
+
+
+def _reschedule(gen: dict):
+    age = time.time() - gen["created_at"]
+    reschedule_pending_generation(gen["nb_task_id"], time.time() + _next_poll_delay(age))
 
 
 def _process_pending_generation(gen: dict):
     nb_task_id = gen["nb_task_id"]
-    user_id = gen["user_id"]
-    chat_id = gen["chat_id"]
-    prompt = gen["prompt"]
-    model = gen["model"]
 
     try:
-        # Получаем статус в формате: {"status": "processing"|"success"|"error", "url": "..."|"msg": "..."}
-        status_info = check_generation_task(nb_task_id)
+        # {"done": bool, "success": bool, "image_url": ..., "error": ...}
+        status_info = check_generation_task(nb_task_id, download=False)
     except Exception as e:
         print(f"⚠️ Error checking NanoBanana task {nb_task_id}: {e}")
         traceback.print_exc()
-        return  # попробуем ещё в следующем цикле
-
-    current_status = status_info.get("status")
+        _reschedule(gen)
+        return  # попробуем ещё в следующий раз
 
     # 1. Ещё генерится
-    if current_status == "processing":
+    if not status_info["done"]:
+        _reschedule(gen)
+        return
+
+    # 2. Готово (успех или ошибка) — отправляем, только если доставку
+    # ещё никто не забрал
+    if not claim_pending_generation(nb_task_id, lease_seconds=DELIVERY_LEASE_SECONDS):
         return
 
-    # 2. Ошибка
-    if current_status == "error":
-        error_msg = status_info.get("msg", "Неизвестная ошибка.")
+    try:
+        _deliver(gen, status_info)
+    except Exception as e:
+        print(f"⚠️ Delivery of NanoBanana task {nb_task_id} failed: {e}")
+        traceback.print_exc()
+        if not _is_permanent_send_error(e):
+            # вернём задачу в очередь: следующий опрос попробует отправить снова
+            reschedule_pending_generation(nb_task_id, time.time() + BASE_POLL_DELAY)
+            return
+
+    remove_pending_generation(nb_task_id)
+
+
+def _is_permanent_send_error(exc: Exception) -> bool:
+    """
+    Telegram отказал окончательно (бот заблокирован, чат не найден и т.п.) —
+    повторять отправку бессмысленно. 429 — временное.
+    """
+    code = getattr(exc, "error_code", None)
+    return isinstance(code, int) and 400 <= code < 500 and code != 429
+
+
+def _deliver(gen: dict, status_info: dict):
+    user_id = gen["user_id"]
+    chat_id = gen["chat_id"]
+    prompt = gen["prompt"]
+
+    if not status_info["success"]:
+        error_msg = status_info.get("error") or "Неизвестная ошибка."
         bot.send_message(
             chat_id,
             f"Не удалось создать изображение 😔\n\n"
             f"Техническая ошибка: {error_msg}",
         )
-        remove_pending_generation(nb_task_id)
         return
 
-    # 3. Успех (current_status == "success")
-    
-    image_url = status_info.get("url")
+    image_url = status_info.get("image_url")
     if not image_url:
         bot.send_message(
             chat_id,
             "Изображение почти было готово, но не удалось получить ссылку 😔",
         )
-        remove_pending_generation(nb_task_id)
-        return
-
-    try:
-        resp = requests.get(image_url, timeout=60)
-        resp.raise_for_status()
-        image_bytes = resp.content
-    except Exception as e:
-        print(f"⚠️ Error downloading image from {image_url}: {e}")
-        traceback.print_exc()
-        bot.send_message(
-            chat_id,
-            "Изображение сгенерировалось, но не получилось его скачать 😔\n"
-            "Попробуй, пожалуйста, ещё раз.",
-        )
-        remove_pending_generation(nb_task_id)
         return
 
-    # создаём внутреннюю задачу для анимации
-    internal_task_id = create_task(prompt, image_bytes, user_id)
+    # создаём внутреннюю задачу для анимации (храним только ссылку)
+    internal_task_id = create_task(prompt, user_id, image_url=image_url)
 
     from telebot import types
     kb = types.InlineKeyboardMarkup()
@@ -85,46 +158,96 @@ def _process_pending_generation(gen: dict):
         )
     )
 
-    bio = BytesIO(image_bytes)
-    bio.name = "image.png"
-
-    # Строка 92 (bot.send_photo) - теперь она должна быть корректно закрыта.
-    bot.send_photo(
+    # Картинку не качаем в память: Telegram берёт её по URL
+    # (или она перекачивается потоком)
+    send_photo_from_url(
+        bot,
         chat_id,
-        bio,
+        image_url,
         caption="Готово ✨ Вот ваша магическая картинка!\n"
                 "Можете анимировать её кнопкой ниже.",
         reply_markup=kb,
     )
 
-    remove_pending_generation(nb_task_id)
+
+def _run_leased(gen: dict):
+    start = time.perf_counter()
+    try:
+        _process_pending_generation(gen)
+    except Exception as e:
+        print(f"⚠️ NanoBanana task {gen['nb_task_id']} error: {e}")
+        traceback.print_exc()
+    finally:
+        elapsed = time.perf_counter() - start
+        with _stats_lock:
+            WORKER_STATS["polled"] += 1
+            WORKER_STATS["in_flight"] -= 1
+            WORKER_STATS["last_poll_seconds"] = elapsed
+            WORKER_STATS["max_poll_seconds"] = max(WORKER_STATS["max_poll_seconds"], elapsed)
+
+
+def _submit_due():
+    """
+    Забирает задачи, чьё время пришло (не больше свободных мест),
+    и отдаёт их в пул, не дожидаясь уже запущенных.
+    """
+    with _stats_lock:
+        WORKER_STATS["cycles"] += 1
+        free = MAX_IN_FLIGHT - WORKER_STATS["in_flight"]
+    if free <= 0:
+        return
+
+    due = lease_pending_generations(free, lease_seconds=LEASE_SECONDS)
+    if not due:
+        return
+
+    now = time.time()
+    lag = max(0.0, max(now - (gen["next_poll_at"] or now) for gen in due))
+    with _stats_lock:
+        WORKER_STATS["leased"] += len(due)
+        WORKER_STATS["in_flight"] += len(due)
+        WORKER_STATS["last_lag_seconds"] = lag
+        WORKER_STATS["max_lag_seconds"] = max(WORKER_STATS["max_lag_seconds"], lag)
+
+    for i, gen in enumerate(due):
+        try:
+            _executor.submit(_run_leased, gen)
+        except Exception:
+            # не взяли в пул — эти задачи не в работе (аренда истечёт сама)
+            with _stats_lock:
+                WORKER_STATS["in_flight"] -= len(due) - i
+            raise
 
 
 def _worker_loop():
     """
-    Фоновый цикл: каждые несколько секунд опрашивает все незавершённые задачи.
+    Фоновый цикл: раз в TICK секунд отдаёт в пул задачи, у которых подошло время.
     """
     print("🛠️ Background NanoBanana worker started")
     while True:
         try:
-            pending = get_all_pending_generations()
-            if pending:
-                print(f"🔍 Checking {len(pending)} NanoBanana tasks...")
-            for gen in pending:
-                _process_pending_generation(gen)
+            _submit_due()
         except Exception as e:
             print(f"⚠️ Worker loop error: {e}")
             traceback.print_exc()
 
-        time.sleep(3)
+        time.sleep(TICK)
+
+
+_worker_started = False
+_worker_lock = threading.Lock()
 
 
 def start_background_worker():
     """
     Запускает воркер в отдельном потоке (daemon).
-    Вызывается один раз из bot.py.
+    Вызывается из bot.py / app.py при старте; повторные вызовы ничего не делают.
     """
-    import threading
+    global _worker_started
+    with _worker_lock:
+        if _worker_started:
+            return
+        _worker_started = True
 
     t = threading.Thread(target=_worker_loop, daemon=True)
     t.start()
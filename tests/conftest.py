@@ -0,0 +1,46 @@
+# tests/conftest.py
+#
+# services/db.py создаёт базу при импорте, поэтому путь к тестовой базе
+# задаём до любых импортов проекта. Каждый тест, которому нужна база,
+# берёт фикстуру db — чистый файл SQLite во временной папке.
+# wait_until — ожидание результата фоновых потоков.
+
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("TELEGRAM_TOKEN", "1:test")
+os.environ["CHUDO_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="chudo-tests-"), "chudo.db")
+
+import pytest
+
+from services import db as db_module
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_module, "DB_PATH", str(tmp_path / "chudo.db"))
+    db_module.close_all_conns()
+    db_module.init_db()
+    yield db_module
+    db_module.close_all_conns()
+
+
+@pytest.fixture
+def wait_until():
+    """
+    wait_until(predicate, timeout=5) — ждёт, пока predicate() станет True
+    (для фоновых потоков). Возвращает, дождались ли.
+    """
+    def wait(predicate, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if predicate():
+                return True
+            time.sleep(0.01)
+        return False
+    return wait
@@ -0,0 +1,52 @@
+from datetime import datetime
+
+
+def _counters(db):
+    return db.get_admin_counter_rows(datetime.utcnow().date().isoformat())
+
+
+def test_triggers_follow_inserts_and_updates(db):
+    db.ensure_user(1)
+    db.ensure_user(2)
+    db.adjust_tokens(1, 7)
+    db.adjust_tokens(2, 5)
+    db.debit_tokens(2, 2)
+    db.record_purchase(1, "pro", 199, 50, 0, None)
+
+    counters = _counters(db)
+    today = datetime.utcnow().date().isoformat()
+    assert counters["users"] == 2
+    assert counters["tokens_rows"] == 2
+    assert counters["tokens_sum"] == 10
+    assert counters["purchases"] == 1
+    assert counters[f"purchases:{today}"] == 1
+    assert counters["tariff:pro"] == 1
+
+
+def test_referral_counts_referrer_once(db):
+    conn = db.get_conn()
+    with conn:
+        for invited in (2, 3):
+            conn.execute(
+                "INSERT INTO referrals (referrer_id, invited_id, reward_referrer) VALUES (1, ?, 5)",
+                (invited,),
+            )
+
+    counters = _counters(db)
+    assert counters["referrals"] == 2
+    assert counters["ref_users"] == 1
+    assert counters["ref_bonus_total"] == 10
+
+
+def test_reconcile_fixes_drift(db):
+    db.ensure_user(1)
+    db.adjust_tokens(1, 4)
+    assert db.reconcile_admin_counters() == {}
+
+    # ручная правка базы в обход триггеров
+    conn = db.get_conn()
+    with conn:
+        conn.execute("UPDATE admin_counters SET value = 100 WHERE key = 'users'")
+
+    assert db.reconcile_admin_counters() == {"users": (100, 1)}
+    assert _counters(db)["users"] == 1
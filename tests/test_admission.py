@@ -0,0 +1,114 @@
+import threading
+import time
+
+from services import admission
+from services.admission import AdmissionGate
+
+
+def test_submit_does_not_block_and_runs_job(wait_until):
+    gate = AdmissionGate("test", max_concurrency=1, rate=100)
+    done = threading.Event()
+
+    started = time.monotonic()
+    gate.submit(1, done.set)
+    assert time.monotonic() - started < 0.5
+
+    assert done.wait(5)
+    assert wait_until(lambda: gate.stats()["admitted"] == 1)
+
+
+def test_concurrency_limit(wait_until):
+    gate = AdmissionGate("test", max_concurrency=2, rate=100, burst=10)
+    release = threading.Event()
+    lock = threading.Lock()
+    running = {"now": 0, "max": 0, "done": 0}
+
+    def job():
+        with lock:
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+        release.wait(5)
+        with lock:
+            running["now"] -= 1
+            running["done"] += 1
+
+    for user_id in range(6):
+        gate.submit(user_id, job)
+
+    assert wait_until(lambda: running["now"] == 2)
+    assert gate.stats()["queued"] == 4
+    release.set()
+    assert wait_until(lambda: running["done"] == 6)
+    assert running["max"] == 2
+
+
+def test_users_are_served_round_robin(wait_until):
+    gate = AdmissionGate("test", max_concurrency=1, rate=100, burst=10)
+    release = threading.Event()
+    order = []
+
+    gate.submit("blocker", lambda: release.wait(5))
+    assert wait_until(lambda: gate.stats()["in_flight"] == 1)
+
+    # у первого пользователя пачка запросов, второй пришёл позже
+    for i in range(3):
+        gate.submit("heavy", lambda i=i: order.append(f"heavy{i}"))
+    gate.submit("light", lambda: order.append("light"))
+
+    release.set()
+    assert wait_until(lambda: len(order) == 4)
+    assert order.index("light") == 1
+
+
+def test_queue_timeout_calls_on_timeout_and_skips_job(wait_until):
+    gate = AdmissionGate("test", max_concurrency=1, rate=100)
+    release = threading.Event()
+    timed_out = threading.Event()
+    ran = []
+
+    gate.submit(1, lambda: release.wait(5))
+    gate.submit(2, lambda: ran.append(True), on_timeout=timed_out.set, timeout=0.1)
+
+    assert timed_out.wait(5)
+    release.set()
+    assert wait_until(lambda: gate.stats()["in_flight"] == 0)
+    assert ran == []
+    assert gate.stats()["timeouts"] == 1
+
+
+def test_job_error_is_counted_and_frees_slot(wait_until):
+    gate = AdmissionGate("test", max_concurrency=1, rate=100)
+    done = threading.Event()
+
+    def broken():
+        raise RuntimeError("boom")
+
+    gate.submit(1, broken)
+    gate.submit(1, done.set)
+
+    assert done.wait(5)
+    assert wait_until(lambda: gate.stats()["errors"] == 1)
+
+
+def test_position_shown_while_waiting_then_zero(monkeypatch, wait_until):
+    monkeypatch.setattr(admission, "POSITION_NOTIFY_INTERVAL", 0)
+    gate = AdmissionGate("test", max_concurrency=1, rate=100)
+    release = threading.Event()
+    positions = []
+
+    gate.submit(1, lambda: release.wait(5))
+    gate.submit(2, lambda: None, on_position=positions.append)
+
+    assert wait_until(lambda: positions == [1])
+    release.set()
+    assert wait_until(lambda: positions == [1, 0])
+
+
+def test_late_position_is_dropped_after_admission():
+    gate = AdmissionGate("test", max_concurrency=1, rate=100)
+    positions = []
+    waiter = admission._Waiter(1, lambda: None, positions.append, None, timeout=10)
+
+    waiter.admitted = True
+    gate._notify_waiter(waiter, waiter.on_position, 3)
+    assert positions == []
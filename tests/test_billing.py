@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+
+from services import billing
+from utils.cache import LRUCache
+
+
+@pytest.fixture
+def fresh_billing(db, monkeypatch):
+    # кэши модуля живут весь процесс — на каждый тест свои
+    monkeypatch.setattr(billing, "_billing_cache", LRUCache())
+    monkeypatch.setattr(billing, "_snapshots", LRUCache())
+    return billing
+
+
+def test_new_user_gets_welcome_free_images(fresh_billing):
+    assert fresh_billing.get_free_images(1) == fresh_billing.WELCOME_FREE_IMAGES
+
+
+def test_free_images_are_spent_before_tokens(fresh_billing):
+    fresh_billing.add_tokens(1, 10)
+    for _ in range(fresh_billing.WELCOME_FREE_IMAGES):
+        assert fresh_billing.consume_tokens_or_limit(1, "image")
+
+    assert fresh_billing.get_free_images(1) == 0
+    assert fresh_billing.get_token_balance(1) == 10
+
+    assert fresh_billing.consume_tokens_or_limit(1, "image")
+    assert fresh_billing.get_token_balance(1) == 10 - fresh_billing.DEFAULT_COST_IMAGE
+
+
+def test_parallel_takes_never_overspend(fresh_billing):
+    results = []
+
+    def worker():
+        results.append(fresh_billing._take_free_image(1))
+
+    threads = [threading.Thread(target=worker) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sum(results) == fresh_billing.WELCOME_FREE_IMAGES
+    assert fresh_billing.get_free_images(1) == 0
+
+
+def test_tariff_is_written_through_and_changes_cost(fresh_billing):
+    assert fresh_billing.get_cost(1, "image") == fresh_billing.DEFAULT_COST_IMAGE
+
+    fresh_billing.set_last_tariff(1, "pro")
+
+    assert fresh_billing.get_user_billing_row(1)["tariff"] == "pro"
+    assert fresh_billing.get_cost(1, "image") == fresh_billing.TARIFF_PRICING["pro"]["image_cost"]
+    # смена тарифа не трогает бесплатные картинки
+    assert fresh_billing.get_free_images(1) == fresh_billing.WELCOME_FREE_IMAGES
+
+
+def test_failed_tariff_write_is_raised_and_not_cached(fresh_billing, monkeypatch):
+    def broken(*args):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(fresh_billing, "set_user_tariff_row", broken)
+    with pytest.raises(RuntimeError):
+        fresh_billing.set_last_tariff(1, "max")
+    assert fresh_billing.get_user_tariff(1) is None
@@ -0,0 +1,53 @@
+import time
+
+from utils.cache import LRUCache
+
+
+def test_lru_eviction_order():
+    cache = LRUCache(max_items=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ttl_expires():
+    cache = LRUCache(ttl=0.05)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_max_bytes_budget():
+    cache = LRUCache(max_items=100, max_bytes=10, sizeof=len)
+    cache.set("a", b"12345")
+    cache.set("b", b"12345")
+    cache.set("c", b"1")
+
+    assert "a" not in cache
+    assert cache.stats()["bytes"] == 6
+
+
+def test_on_evict_called_on_every_removal():
+    evicted = []
+    cache = LRUCache(max_items=1, on_evict=lambda k, v: evicted.append((k, v)))
+    cache.set("a", 1)
+    cache.set("a", 2)       # перезапись
+    cache.set("b", 3)       # вытеснение
+    cache.pop("b")          # явное удаление
+
+    assert evicted == [("a", 1), ("a", 2), ("b", 3)]
+
+
+def test_hit_rate():
+    cache = LRUCache()
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("b")
+    assert cache.stats()["hit_rate"] == 0.5
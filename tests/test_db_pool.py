@@ -0,0 +1,34 @@
+import threading
+
+
+def test_one_connection_per_thread(db):
+    main = db.get_conn()
+    assert db.get_conn() is main
+
+    other = []
+    t = threading.Thread(target=lambda: other.append(db.get_conn()))
+    t.start()
+    t.join()
+    assert other[0] is not main
+
+
+def test_wal_mode(db):
+    mode = db.get_conn().execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode.lower() == "wal"
+
+
+def test_close_keeps_pooled_connection_usable(db):
+    conn = db.get_conn()
+    conn.execute("INSERT INTO bot_meta (key, value) VALUES ('a', '1')")
+    conn.close()    # старый код: откат незавершённой транзакции, но не закрытие
+
+    assert db.get_conn() is conn
+    assert db.get_meta("a") is None
+
+
+def test_close_all_conns_reopens(db):
+    conn = db.get_conn()
+    db.close_all_conns()
+    fresh = db.get_conn()
+    assert fresh is not conn
+    assert fresh.execute("SELECT 1").fetchone()[0] == 1
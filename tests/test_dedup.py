@@ -0,0 +1,83 @@
+import pytest
+
+from utils import dedup as dedup_module
+from utils.dedup import META_KEY, UpdateDeduplicator
+
+
+@pytest.fixture(autouse=True)
+def no_timed_flush(monkeypatch):
+    # фоновые потоки прошлых тестов не должны писать в базу следующих
+    monkeypatch.setattr(dedup_module, "FLUSH_SECONDS", 3600)
+
+
+def _take(dedup, update_id) -> bool:
+    if not dedup.check(update_id):
+        return False
+    dedup.accept(update_id)
+    return True
+
+
+def test_duplicate_is_dropped(db):
+    dedup = UpdateDeduplicator(window=100)
+    assert _take(dedup, 10)
+    assert not _take(dedup, 10)
+    assert dedup.stats()["duplicates"] == 1
+
+
+def test_forgotten_update_passes_again(db):
+    dedup = UpdateDeduplicator(window=100)
+    assert dedup.check(10)
+    dedup.forget(10)
+    assert _take(dedup, 10)
+
+
+def test_older_than_window_is_duplicate(db):
+    dedup = UpdateDeduplicator(window=10)
+    for update_id in range(1, 30):
+        assert _take(dedup, update_id)
+    assert not dedup.check(5)
+
+
+def test_restart_keeps_high_water_mark(db):
+    dedup = UpdateDeduplicator(window=100)
+    for update_id in range(1, 6):
+        _take(dedup, update_id)
+    dedup.flush()
+
+    restarted = UpdateDeduplicator(window=100)
+    assert not restarted.check(5)
+    assert restarted.check(6)
+
+
+def test_rejected_update_survives_restart(db):
+    dedup = UpdateDeduplicator(window=100)
+    _take(dedup, 100)
+    assert dedup.check(101)
+    dedup.forget(101)
+    _take(dedup, 102)
+    dedup.flush()
+    assert db.get_meta(META_KEY) == "100"
+
+    restarted = UpdateDeduplicator(window=100)
+    assert restarted.check(101)
+
+
+def test_update_id_reset_is_accepted(db):
+    dedup = UpdateDeduplicator(window=100, reset_gap=1000)
+    _take(dedup, 5_000_000)
+    dedup.flush()
+
+    assert _take(dedup, 42)
+    assert dedup.stats()["resets"] == 1
+    dedup.flush()
+    # после сброса mark в базе перезаписан меньшим значением
+    assert db.get_meta(META_KEY) == "42"
+    assert not dedup.check(42)
+
+
+def test_accept_flushes_in_background(db, wait_until):
+    dedup = UpdateDeduplicator(window=100)
+    dedup.restore()
+    _take(dedup, 7)
+    dedup._flush_wanted.set()
+    assert wait_until(lambda: db.get_meta(META_KEY) == "7")
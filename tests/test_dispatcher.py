@@ -0,0 +1,52 @@
+import threading
+import time
+
+from utils.dispatcher import UpdateDispatcher
+
+
+def test_same_key_is_handled_in_order(wait_until):
+    handled = {}
+    lock = threading.Lock()
+
+    def handle(item):
+        chat_id, n = item
+        time.sleep(0.001)
+        with lock:
+            handled.setdefault(chat_id, []).append(n)
+
+    dispatcher = UpdateDispatcher(handle, workers=4, max_queue=1000, key=lambda item: item[0])
+    for n in range(50):
+        for chat_id in range(3):
+            assert dispatcher.submit((chat_id, n))
+
+    assert wait_until(lambda: dispatcher.stats()["processed"] == 150)
+    for chat_id in range(3):
+        assert handled[chat_id] == list(range(50))
+
+
+def test_full_lane_rejects(wait_until):
+    release = threading.Event()
+    dispatcher = UpdateDispatcher(lambda item: release.wait(5), workers=1, max_queue=1, key=lambda item: 0)
+
+    assert dispatcher.submit(1)
+    assert wait_until(lambda: dispatcher.queue_depth() == 0)   # первый уже в обработке
+    assert dispatcher.submit(2)
+    assert not dispatcher.submit(3)
+    assert dispatcher.stats()["rejected"] == 1
+    release.set()
+
+
+def test_handler_error_does_not_stop_lane(wait_until):
+    done = threading.Event()
+
+    def handle(item):
+        if item == "bad":
+            raise RuntimeError("boom")
+        done.set()
+
+    dispatcher = UpdateDispatcher(handle, workers=1, max_queue=10)
+    dispatcher.submit("bad")
+    dispatcher.submit("good")
+
+    assert done.wait(5)
+    assert wait_until(lambda: dispatcher.stats()["errors"] == 1)
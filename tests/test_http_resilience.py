@@ -0,0 +1,93 @@
+import httpx
+import pytest
+
+from services import http_resilience
+from services.http_resilience import CircuitBreaker, CircuitOpenError, ResilientProvider
+
+
+class _Resp:
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(http_resilience.time, "sleep", lambda seconds: None)
+
+
+def _raise(exc):
+    def send():
+        raise exc
+    return send
+
+
+def test_breaker_opens_after_threshold_and_allows_one_trial():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=0)
+    breaker.on_failure()
+    assert breaker.state == "closed"
+    breaker.on_failure()
+    assert breaker.state == "half_open"
+
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.on_success()
+    assert breaker.state == "closed"
+
+
+def test_breaker_rejects_while_open():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=60)
+    breaker.on_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_idempotent_call_retries_transport_error():
+    provider = ResilientProvider("test")
+    calls = []
+
+    def send():
+        calls.append(1)
+        if len(calls) == 1:
+            raise httpx.ReadTimeout("slow")
+        return _Resp(200)
+
+    assert provider.call(send).status_code == 200
+    assert len(calls) == 2
+    assert provider.stats()["retries"] == 1
+
+
+def test_create_call_is_not_retried_after_read_timeout():
+    provider = ResilientProvider("test")
+    calls = []
+
+    def send():
+        calls.append(1)
+        raise httpx.ReadTimeout("slow")
+
+    with pytest.raises(httpx.ReadTimeout):
+        provider.call(send, idempotent=False)
+    assert len(calls) == 1
+
+
+def test_create_call_is_retried_on_429():
+    provider = ResilientProvider("test")
+    responses = [_Resp(429), _Resp(200)]
+
+    assert provider.call(lambda: responses.pop(0), idempotent=False).status_code == 200
+
+
+def test_non_transport_error_does_not_reset_breaker():
+    provider = ResilientProvider("test")
+    provider.breaker.failure_threshold = 2
+
+    with pytest.raises(httpx.ReadTimeout):
+        provider.call(_raise(httpx.ReadTimeout("slow")), idempotent=False)
+    with pytest.raises(ValueError):
+        provider.call(_raise(ValueError("bad json")))
+    with pytest.raises(httpx.ReadTimeout):
+        provider.call(_raise(httpx.ReadTimeout("slow")), idempotent=False)
+
+    assert provider.breaker.state == "open"
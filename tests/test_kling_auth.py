@@ -0,0 +1,53 @@
+import jwt
+import pytest
+
+from services import kling_auth
+from services.kling_auth import KlingTokenProvider
+
+SECRET = "s" * 32
+
+
+class Clock:
+
+    def __init__(self, now=1_000_000):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(kling_auth.time, "time", clock.time)
+    return clock
+
+
+def test_token_is_reused_until_refresh_margin(clock):
+    provider = KlingTokenProvider("ak", SECRET, lifetime=1800, refresh_margin=300)
+    token = provider.get_token()
+
+    clock.now += 1800 - 300 - 1
+    assert provider.get_token() == token
+
+    clock.now += 1
+    assert provider.get_token() != token
+
+
+def test_token_claims(clock):
+    provider = KlingTokenProvider("ak", SECRET, lifetime=1800)
+    claims = jwt.decode(
+        provider.get_token(), SECRET, algorithms=["HS256"],
+        options={"verify_exp": False, "verify_nbf": False},
+    )
+    assert claims == {"iss": "ak", "exp": clock.now + 1800, "nbf": clock.now - 5}
+
+
+def test_missing_keys_raise():
+    with pytest.raises(RuntimeError):
+        KlingTokenProvider("", SECRET).get_token()
+
+
+def test_one_provider_per_key_pair():
+    assert kling_auth.get_token_provider("a", "b") is kling_auth.get_token_provider("a", "b")
+    assert kling_auth.get_token_provider("a", "b") is not kling_auth.get_token_provider("a", "c")
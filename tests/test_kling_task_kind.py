@@ -0,0 +1,59 @@
+import pytest
+
+from services import kling_service
+from utils.cache import LRUCache
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self._data = data or {}
+        self.text = str(self._data)
+
+    def json(self):
+        return self._data
+
+
+DONE = {"data": {"task_status": "succeed", "task_result": {"videos": [{"url": "https://cdn/v.mp4"}]}}}
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """
+    Kling API: задача "t2v" есть только у text2video, остальные — у image2video.
+    """
+    requested = []
+
+    def get(url, **kwargs):
+        requested.append(url)
+        kind = "text2video" if url.endswith("/t2v") else "image2video"
+        return FakeResponse(200, DONE) if f"/{kind}/" in url else FakeResponse(404)
+
+    monkeypatch.setattr(kling_service, "_session", type("S", (), {"get": staticmethod(get)}))
+    monkeypatch.setattr(kling_service, "_headers", lambda: {})
+    monkeypatch.setattr(kling_service, "_task_kinds", LRUCache())
+    return requested
+
+
+def test_known_kind_makes_one_request(api):
+    assert kling_service.get_kling_task_status("t2v", kind="text2video") == ("succeed", "https://cdn/v.mp4")
+    assert len(api) == 1
+
+
+def test_unknown_kind_is_probed_once_then_remembered(api):
+    kling_service.get_kling_task_status("t2v")
+    assert len(api) == 2    # image2video (404) → text2video
+
+    kling_service.get_kling_task_status("t2v")
+    assert len(api) == 3
+    assert api[-1].endswith("/v1/videos/text2video/t2v")
+
+
+def test_not_found_anywhere_raises(api, monkeypatch):
+    monkeypatch.setattr(
+        kling_service, "_session",
+        type("S", (), {"get": staticmethod(lambda url, **kw: FakeResponse(404))}),
+    )
+    with pytest.raises(RuntimeError):
+        kling_service.get_kling_task_status("nope")
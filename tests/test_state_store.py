@@ -0,0 +1,55 @@
+import time
+
+from utils import state_store
+from utils.state_store import MemoryStateStore, SqliteStateStore
+
+
+def test_sqlite_store_behaves_like_dict(db):
+    store = SqliteStateStore("test")
+    store[1] = {"step": "photo", "count": 2}
+
+    assert 1 in store
+    assert store[1] == {"step": "photo", "count": 2}
+    assert store.get(2, "none") == "none"
+    assert store.pop(1) == {"step": "photo", "count": 2}
+    assert 1 not in store
+
+
+def test_sqlite_store_namespaces_are_separate(db):
+    SqliteStateStore("a")[1] = "x"
+    assert SqliteStateStore("b").get(1) is None
+
+
+def test_sqlite_store_is_shared_and_survives_restart(db):
+    SqliteStateStore("test")[1] = "x"
+    db.close_all_conns()    # как новый процесс: новое соединение
+    assert SqliteStateStore("test")[1] == "x"
+
+
+def test_sqlite_store_ttl(db):
+    store = SqliteStateStore("test", ttl=0.05)
+    store[1] = "x"
+    time.sleep(0.1)
+
+    assert store.get(1) is None
+    assert 1 not in store
+    assert store.pop(1) is None
+
+
+def test_sqlite_store_purges_expired_rows(db, monkeypatch):
+    monkeypatch.setattr(state_store, "PURGE_EVERY", 2)
+    store = SqliteStateStore("test", ttl=0.05)
+    store[1] = "x"
+    time.sleep(0.1)
+    store[2] = "y"      # вторая запись запускает чистку
+
+    rows = db.get_conn().execute("SELECT state_key FROM conversation_state").fetchall()
+    assert [row["state_key"] for row in rows] == ["2"]
+
+
+def test_memory_store_is_bounded():
+    store = MemoryStateStore("test", max_items=2)
+    for key in range(5):
+        store[key] = key
+    assert 0 not in store
+    assert store[4] == 4
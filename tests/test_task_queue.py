@@ -0,0 +1,76 @@
+import time
+
+from utils import tasks
+
+
+def _statuses(db):
+    rows = db.get_conn().execute("SELECT nb_task_id, status FROM pending_generations").fetchall()
+    return {row["nb_task_id"]: row["status"] for row in rows}
+
+
+def test_lease_is_exclusive_until_expiry(db):
+    tasks.add_pending_generation("nb1", 1, 1, "cat", "model")
+
+    assert [g["nb_task_id"] for g in tasks.lease_pending_generations(10, owner="w1")] == ["nb1"]
+    assert tasks.lease_pending_generations(10, owner="w2") == []
+
+    # аренда истекла (воркер умер) — задачу забирает другой
+    conn = db.get_conn()
+    with conn:
+        conn.execute("UPDATE pending_generations SET lease_until = 0")
+    assert [g["nb_task_id"] for g in tasks.lease_pending_generations(10, owner="w2")] == ["nb1"]
+
+
+def test_lease_respects_limit_and_next_poll_at(db):
+    for n in range(3):
+        tasks.add_pending_generation(f"nb{n}", 1, 1, "cat", "model")
+    tasks.reschedule_pending_generation("nb0", time.time() + 60)
+
+    leased = tasks.lease_pending_generations(1, owner="w1")
+    assert len(leased) == 1
+    assert leased[0]["nb_task_id"] != "nb0"
+
+
+def test_only_lease_owner_can_claim_delivery(db):
+    tasks.add_pending_generation("nb1", 1, 1, "cat", "model")
+    tasks.lease_pending_generations(10, owner="w1")
+
+    assert not tasks.claim_pending_generation("nb1", owner="w2")
+    assert tasks.claim_pending_generation("nb1", owner="w1")
+    assert _statuses(db) == {"nb1": "delivering"}
+
+
+def test_stuck_delivery_is_leased_again(db):
+    tasks.add_pending_generation("nb1", 1, 1, "cat", "model")
+    tasks.lease_pending_generations(10, owner="w1")
+    tasks.claim_pending_generation("nb1", lease_seconds=-1, owner="w1")
+
+    # процесс умер посреди отправки: после аренды задачу снова берут
+    assert [g["nb_task_id"] for g in tasks.lease_pending_generations(10, owner="w2")] == ["nb1"]
+    assert tasks.claim_pending_generation("nb1", owner="w2")
+
+
+def test_reschedule_returns_task_to_pending(db):
+    tasks.add_pending_generation("nb1", 1, 1, "cat", "model")
+    tasks.lease_pending_generations(10, owner="w1")
+    tasks.claim_pending_generation("nb1", owner="w1")
+    tasks.reschedule_pending_generation("nb1", time.time())
+
+    assert _statuses(db) == {"nb1": "pending"}
+    assert tasks.lease_pending_generations(10, owner="w2")
+
+
+def test_worker_id_follows_pid(monkeypatch):
+    monkeypatch.setattr(tasks.os, "getpid", lambda: 111)
+    first = tasks.worker_id()
+    monkeypatch.setattr(tasks.os, "getpid", lambda: 222)
+    assert tasks.worker_id() != first
+
+
+def test_animation_task_roundtrip_and_ttl(db, monkeypatch):
+    task_id = tasks.create_task("cat", 1, image_url="https://cdn/cat.png")
+    assert tasks.get_task(task_id) == {"user_id": 1, "prompt": "cat", "image_url": "https://cdn/cat.png"}
+    assert tasks.get_task("missing") is None
+
+    monkeypatch.setattr(tasks, "ANIMATION_TASKS_TTL", 0)
+    assert tasks.get_task(task_id) is None
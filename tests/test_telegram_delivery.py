@@ -0,0 +1,90 @@
+from types import SimpleNamespace
+
+import pytest
+from telebot import apihelper
+
+from services import telegram_delivery
+from services.telegram_delivery import media_key_for_bytes, send_photo_bytes
+
+IMAGE = b"\x89PNG fake image"
+
+
+def _api_error(code, description):
+    return apihelper.ApiTelegramException(
+        "sendPhoto", None, {"error_code": code, "description": description},
+    )
+
+
+class FakeBot:
+    """
+    send_photo: строка — отправка по file_id, иначе — загрузка файла.
+    """
+
+    def __init__(self, file_id_error=None):
+        self.file_id_error = file_id_error
+        self.calls = []
+        self.uploads = 0
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        if isinstance(photo, str):
+            self.calls.append(("file_id", photo))
+            if self.file_id_error:
+                raise self.file_id_error
+            return SimpleNamespace(photo=[SimpleNamespace(file_id=photo)])
+
+        self.uploads += 1
+        self.calls.append(("upload", None))
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f"id{self.uploads}")])
+
+
+def _cached_file_id(db):
+    return db.get_media_file_id(media_key_for_bytes(IMAGE), 0)
+
+
+def test_second_send_reuses_file_id(db):
+    bot = FakeBot()
+    send_photo_bytes(bot, 1, IMAGE)
+    send_photo_bytes(bot, 1, IMAGE)
+
+    assert bot.calls == [("upload", None), ("file_id", "id1")]
+
+
+def test_stale_file_id_is_dropped_and_reuploaded(db):
+    send_photo_bytes(FakeBot(), 1, IMAGE)
+
+    bot = FakeBot(_api_error(400, "Bad Request: wrong file identifier/HTTP URL specified"))
+    send_photo_bytes(bot, 1, IMAGE)
+
+    assert bot.calls == [("file_id", "id1"), ("upload", None)]
+    assert _cached_file_id(db) == "id1"     # новый file_id от повторной загрузки
+
+
+@pytest.mark.parametrize("error", [
+    _api_error(400, "Bad Request: file_id is too long for caption"),
+    _api_error(403, "Forbidden: bot was blocked by the user"),
+])
+def test_other_errors_are_raised_and_keep_file_id(db, error):
+    send_photo_bytes(FakeBot(), 1, IMAGE)
+
+    bot = FakeBot(error)
+    with pytest.raises(apihelper.ApiTelegramException):
+        send_photo_bytes(bot, 1, IMAGE)
+
+    assert bot.uploads == 0
+    assert _cached_file_id(db) == "id1"
+
+
+def test_stale_counter(db):
+    before = telegram_delivery.delivery_stats()["file_id_stale"]
+    send_photo_bytes(FakeBot(), 1, IMAGE)
+    send_photo_bytes(FakeBot(_api_error(400, "Bad Request: wrong remote file identifier specified")), 1, IMAGE)
+    assert telegram_delivery.delivery_stats()["file_id_stale"] == before + 1
+
+
+def test_purge_media_file_ids(db):
+    for n in range(5):
+        db.set_media_file_id(f"k{n}", "f", 1000 + n)
+
+    assert db.purge_media_file_id_rows(1000 + 2 + 30 * 86400, keep_days=30, max_rows=2) == 3
+    rows = db.get_conn().execute("SELECT media_key FROM media_file_ids ORDER BY media_key").fetchall()
+    assert [row["media_key"] for row in rows] == ["k3", "k4"]
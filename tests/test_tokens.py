@@ -0,0 +1,48 @@
+import threading
+
+
+def _ledger_sum(db, user_id):
+    row = db.get_conn().execute(
+        "SELECT COALESCE(SUM(delta), 0) AS total FROM token_ledger WHERE user_id=?",
+        (user_id,),
+    ).fetchone()
+    return row["total"]
+
+
+def test_adjust_creates_row_and_writes_ledger(db):
+    assert db.adjust_tokens(1, 10, reason="credit") == 10
+    assert db.get_token_balance(1) == 10
+    assert _ledger_sum(db, 1) == 10
+
+
+def test_adjust_does_not_go_below_zero_and_ledger_matches(db):
+    db.adjust_tokens(1, 3)
+    assert db.adjust_tokens(1, -10) == 0
+    # в ledger — фактически списанные 3, а не запрошенные 10
+    assert _ledger_sum(db, 1) == db.get_token_balance(1) == 0
+
+
+def test_debit_only_when_enough(db):
+    db.adjust_tokens(1, 5)
+    assert db.debit_tokens(1, 3) == 2
+    assert db.debit_tokens(1, 3) is None
+    assert db.get_token_balance(1) == 2
+    assert _ledger_sum(db, 1) == 2
+
+
+def test_parallel_debits_never_overspend(db):
+    db.adjust_tokens(1, 10)
+    results = []
+
+    def worker():
+        results.append(db.debit_tokens(1, 1))
+
+    threads = [threading.Thread(target=worker) for _ in range(30)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sum(r is not None for r in results) == 10
+    assert db.get_token_balance(1) == 0
+    assert _ledger_sum(db, 1) == 0
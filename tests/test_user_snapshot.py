@@ -0,0 +1,58 @@
+import pytest
+
+from services import billing
+from utils.cache import LRUCache
+
+
+@pytest.fixture
+def fresh_billing(db, monkeypatch):
+    monkeypatch.setattr(billing, "_billing_cache", LRUCache())
+    monkeypatch.setattr(billing, "_snapshots", LRUCache())
+    return billing
+
+
+def test_snapshot_reads_everything(fresh_billing):
+    fresh_billing.add_tokens(1, 7)
+    fresh_billing.set_last_tariff(1, "start")
+    fresh_billing.enable_auto_renew(1, "start")
+
+    snapshot = fresh_billing.get_user_snapshot(1)
+    assert snapshot.balance == 7
+    assert snapshot.free_images == fresh_billing.WELCOME_FREE_IMAGES
+    assert snapshot.tariff == "start"
+    assert snapshot.auto_renew
+    assert snapshot.referrals_invited == 0
+
+
+def test_snapshot_is_cached(fresh_billing):
+    first = fresh_billing.get_user_snapshot(1)
+    assert fresh_billing.get_user_snapshot(1) is first
+
+
+@pytest.mark.parametrize("change", [
+    lambda b: b.add_tokens(1, 5),
+    lambda b: b.consume_tokens_or_limit(1, "image"),
+    lambda b: b.set_last_tariff(1, "pro"),
+    lambda b: b.disable_auto_renew(1),
+])
+def test_billing_changes_invalidate_snapshot(fresh_billing, change):
+    first = fresh_billing.get_user_snapshot(1)
+    change(fresh_billing)
+    assert fresh_billing.get_user_snapshot(1) is not first
+
+
+def test_snapshot_read_racing_invalidation_is_not_cached(fresh_billing, monkeypatch):
+    read = fresh_billing.get_user_snapshot_row
+
+    def read_then_change(user_id):
+        row = read(user_id)
+        # данные поменялись, пока снимок собирался
+        fresh_billing.add_tokens(user_id, 3)
+        return row
+
+    monkeypatch.setattr(fresh_billing, "get_user_snapshot_row", read_then_change)
+    stale = fresh_billing.get_user_snapshot(1)
+    monkeypatch.setattr(fresh_billing, "get_user_snapshot_row", read)
+
+    assert stale.balance == 0
+    assert fresh_billing.get_user_snapshot(1).balance == 3
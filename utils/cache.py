@@ -0,0 +1,144 @@
+# utils/cache.py
+#
+# Потокобезопасный LRU-кэш с TTL и бюджетом по размеру.
+# - max_items: сколько записей держим максимум
+# - max_bytes: суммарный "вес" записей (sizeof(value)), если задан
+# - ttl: сколько секунд запись живёт
+# Старые записи вытесняются первыми (LRU).
+# Счётчики hits / misses / evictions / expirations — в stats().
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+
+    def __init__(self, max_items=1000, ttl=None, max_bytes=None, sizeof=None, on_evict=None):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        # on_evict(key, value) — вызывается, когда запись уходит из кэша:
+        # вытеснение, протухание, перезапись через set() и pop()
+        self.on_evict = on_evict
+
+        self._data = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+
+            expires_at, _, value = item
+            if expires_at is not None and expires_at < time.time():
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                dropped = value
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+
+        self._notify(key, dropped)
+        return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else None
+        size = self.sizeof(value)
+
+        with self._lock:
+            evicted = []
+            old = self._data.get(key)
+            if old is not None:
+                self._drop(key)
+                if old[2] is not value:
+                    evicted.append((key, old[2]))
+            self._data[key] = (expires_at, size, value)
+            self._bytes += size
+            evicted.extend(self._shrink())
+
+        for k, v in evicted:
+            self._notify(k, v)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            self._drop(key)
+
+        self._notify(key, item[2])
+        return item[2]
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and (item[0] is None or item[0] >= time.time())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "items": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    # ------- внутреннее -------
+
+    def _drop(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def _shrink(self):
+        evicted = []
+        now = time.time()
+
+        # сначала выкидываем протухшие с начала очереди
+        while self._data:
+            key, (expires_at, _, value) = next(iter(self._data.items()))
+            if expires_at is None or expires_at >= now:
+                break
+            self._drop(key)
+            self.expirations += 1
+            evicted.append((key, value))
+
+        # потом — самые давно использованные, пока не влезем в лимиты
+        while self._data and (
+            len(self._data) > self.max_items
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            key, (_, size, value) = self._data.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            evicted.append((key, value))
+
+        return evicted
+
+    def _notify(self, key, value):
+        if self.on_evict is None:
+            return
+        try:
+            self.on_evict(key, value)
+        except Exception as e:
+            print(f"⚠️ cache on_evict error: {e}")
@@ -0,0 +1,230 @@
+# utils/dedup.py
+#
+# Отсев повторно доставленных апдейтов по update_id.
+# Если вебхук отвечает медленно, Telegram шлёт тот же апдейт ещё раз —
+# без отсева хендлер второй раз спишет токены и запустит вторую генерацию.
+#
+# - последние WINDOW update_id держим в кольцевом буфере + set (проверка O(1));
+# - всё, что немного старше окна относительно максимального id, считаем
+#   уже виденным;
+# - максимальный id (high-water mark) периодически пишем в SQLite (bot_meta),
+#   чтобы после рестарта не обработать заново то, что уже было. Пишет
+#   фоновый поток: accept() вызывается из вебхука, и занятая блокировка
+#   записи SQLite не должна останавливать обработку апдейтов.
+#
+# Порядок для вызывающего: check() -> положили в очередь -> accept();
+# не положили (очередь полна) -> forget(). High-water mark двигается
+# только в accept(), а отклонённые id не дают сохранить mark выше себя —
+# иначе повтор отклонённого апдейта после рестарта отсеялся бы как старый.
+#
+# Если бот долго (7+ дней) не получал апдейтов, Telegram начинает update_id
+# заново со случайного значения. id намного ниже сохранённого (на RESET_GAP
+# и больше) считаем таким сбросом: забываем старый mark и принимаем апдейт.
+
+import threading
+from collections import deque
+
+from services.db import get_meta, set_meta, set_meta_max_int
+
+META_KEY = "last_update_id"
+
+# Сколько последних update_id помним
+WINDOW = 10000
+
+# Насколько ниже mark должен быть id, чтобы считать это сбросом нумерации
+RESET_GAP = 1000000
+
+# Как часто сохраняем high-water mark (апдейтов / секунд)
+FLUSH_EVERY = 100
+FLUSH_SECONDS = 5
+
+
+class UpdateDeduplicator:
+
+    def __init__(self, window=WINDOW, reset_gap=RESET_GAP):
+        self.window = window
+        self.reset_gap = reset_gap
+        self._ring = deque()
+        self._seen = set()
+        self._rejected = set()     # отклонённые id, повтор которых ещё ждём
+        self._lock = threading.Lock()
+
+        self.high_water = None     # максимальный принятый update_id
+        self._restored = None      # high-water mark из базы на момент старта
+        self._reset_pending = False
+        self._dirty = 0
+        self._flush_wanted = threading.Event()
+        self._flusher = None
+
+        self.accepted = 0
+        self.duplicates = 0
+        self.resets = 0
+
+    def check(self, update_id) -> bool:
+        """
+        True — апдейт новый (и он запомнен), False — повтор.
+        После True нужно вызвать accept() или forget().
+        """
+        if update_id is None:
+            return True
+
+        self._restore()
+
+        with self._lock:
+            if update_id in self._seen:
+                self.duplicates += 1
+                return False
+
+            if self._is_reset(update_id):
+                self._reset(update_id)
+            elif self._is_old(update_id):
+                self.duplicates += 1
+                return False
+
+            self._ring.append(update_id)
+            self._seen.add(update_id)
+            if len(self._ring) > self.window:
+                self._seen.discard(self._ring.popleft())
+        return True
+
+    def accept(self, update_id):
+        """
+        Апдейт принят в обработку — двигаем high-water mark.
+        """
+        if update_id is None:
+            return
+
+        with self._lock:
+            self._rejected.discard(update_id)
+            if self.high_water is None or update_id > self.high_water:
+                self.high_water = update_id
+            self.accepted += 1
+            self._dirty += 1
+            need_flush = self._reset_pending or self._dirty >= FLUSH_EVERY
+
+        self._start_flusher()
+        if need_flush:
+            self._flush_wanted.set()
+
+    def forget(self, update_id):
+        """
+        Апдейт не удалось принять (очередь полна) — пусть повтор пройдёт,
+        в т.ч. после рестарта.
+        """
+        with self._lock:
+            self._seen.discard(update_id)
+            self._rejected.add(update_id)
+
+    def flush(self):
+        with self._lock:
+            value = self._safe_mark()
+            reset = self._reset_pending
+            self._reset_pending = False
+            self._dirty = 0
+        if value is None:
+            return
+        try:
+            if reset:
+                # после сброса нумерации старый (больший) mark надо перезаписать
+                set_meta(META_KEY, value)
+            else:
+                set_meta_max_int(META_KEY, value)
+        except Exception as e:
+            print(f"⚠️ dedup flush error: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "accepted": self.accepted,
+                "duplicates": self.duplicates,
+                "resets": self.resets,
+                "high_water": self.high_water,
+                "rejected_pending": len(self._rejected),
+                "window": len(self._ring),
+            }
+
+    def restore(self):
+        """
+        Читает сохранённый mark заранее (при старте), чтобы первый check()
+        не ходил в базу.
+        """
+        self._restore()
+
+    # ------- фоновая запись -------
+
+    def _start_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flusher_loop, name="dedup-flush", daemon=True)
+        self._flusher.start()
+
+    def _flusher_loop(self):
+        while True:
+            # раз в FLUSH_SECONDS или сразу, если накопилось / был сброс
+            self._flush_wanted.wait(FLUSH_SECONDS)
+            self._flush_wanted.clear()
+            with self._lock:
+                dirty = self._dirty or self._reset_pending
+            if dirty:
+                self.flush()
+
+    # ------- внутреннее (под self._lock) -------
+
+    def _floor(self):
+        """
+        Всё, что не выше этого id (и не в окне), уже обработано.
+        """
+        floors = []
+        if self._restored is not None and self._restored >= 0:
+            floors.append(self._restored)
+        if self.high_water is not None:
+            floors.append(self.high_water - self.window)
+        return max(floors) if floors else None
+
+    def _is_old(self, update_id) -> bool:
+        floor = self._floor()
+        return floor is not None and update_id <= floor
+
+    def _is_reset(self, update_id) -> bool:
+        # сравниваем с максимальным известным id, а не с нижней границей окна
+        marks = [m for m in (self._restored, self.high_water) if m is not None and m >= 0]
+        return bool(marks) and update_id < max(marks) - self.reset_gap
+
+    def _reset(self, update_id):
+        print(f"⚠️ dedup: update_id {update_id} намного ниже прежних — Telegram сбросил нумерацию")
+        self.resets += 1
+        self._ring.clear()
+        self._seen.clear()
+        self._rejected.clear()
+        self.high_water = None
+        self._restored = -1
+        self._reset_pending = True
+
+    def _safe_mark(self):
+        """
+        Что можно сохранить: high_water, но ниже самого раннего отклонённого
+        id, повтор которого ещё может прийти. Совсем старые (вне окна)
+        отклонённые уже не ждём.
+        """
+        if self.high_water is None:
+            return None
+        lowest = self.high_water - self.window
+        self._rejected = {uid for uid in self._rejected if uid > lowest}
+        if self._rejected:
+            return min(self.high_water, min(self._rejected) - 1)
+        return self.high_water
+
+    def _restore(self):
+        if self._restored is not None:
+            return
+        try:
+            value = get_meta(META_KEY)
+        except Exception as e:
+            print(f"⚠️ dedup restore error: {e}")
+            value = None
+        with self._lock:
+            if self._restored is None:
+                self._restored = int(value) if value is not None else -1
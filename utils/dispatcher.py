@@ -0,0 +1,161 @@
+# utils/dispatcher.py
+#
+# Ограниченные очереди апдейтов + потоки-обработчики ("дорожки").
+# Вебхук (app.py) только кладёт апдейт в очередь и сразу отвечает Telegram,
+# а долгие хендлеры (генерация NanoBanana и т.п.) выполняются в потоках.
+#
+# Апдейты раскладываются по дорожкам по ключу (chat_id): у каждой дорожки
+# своя очередь и ровно один поток. Поэтому сообщения одного чата
+# обрабатываются строго по порядку (важно для register_next_step_handler),
+# а разные чаты — параллельно, на разных дорожках.
+#
+# Поэтому хендлер на дорожке должен быть быстрым: долгую работу с
+# провайдерами (генерация NanoBanana, создание задач Kling) хендлеры
+# отдают в services/admission.py (gate.submit) и сразу возвращаются —
+# иначе все чаты этой дорожки ждали бы одного медленного. Хендлеры дольше
+# SLOW_HANDLE_SECONDS считаются в stats()["slow_handles"] и пишутся в лог.
+#
+# Если очередь дорожки переполнена — submit() возвращает False (вебхук
+# отвечает 503, Telegram пришлёт апдейт позже).
+# Метрики: глубина очередей, ожидание в очереди, время обработки — в stats().
+
+import queue
+import threading
+import time
+import traceback
+
+# Хендлер дольше этого (сек) держит всю дорожку — пишем в лог
+SLOW_HANDLE_SECONDS = 5
+
+
+class UpdateDispatcher:
+
+    def __init__(self, handle, workers=16, max_queue=1000, name="tg-dispatch", key=None):
+        # handle(item) — вызывается в потоке дорожки для каждого элемента
+        self.handle = handle
+        # key(item) — ключ упорядочивания (chat_id); None — любая дорожка
+        self.key = key or (lambda item: None)
+        self.workers = workers
+        self.name = name
+
+        # общий лимит max_queue делим между дорожками
+        lane_size = max(1, -(-max_queue // workers))
+        self._lanes = [queue.Queue(maxsize=lane_size) for _ in range(workers)]
+        self._next_lane = 0
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+        self._stats = {
+            "enqueued": 0,
+            "rejected": 0,
+            "processed": 0,
+            "errors": 0,
+            "max_queue_depth": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "handle_seconds_total": 0.0,
+            "handle_seconds_max": 0.0,
+            "slow_handles": 0,
+        }
+
+    # ------- публичное -------
+
+    def submit(self, item, block=False, timeout=None) -> bool:
+        """
+        Кладёт элемент в очередь. False — очередь полна
+        (при block=True ждёт место не дольше timeout).
+        """
+        self.start()
+        lane = self._lanes[self._lane_index(item)]
+        try:
+            lane.put((time.monotonic(), item), block=block, timeout=timeout)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats["rejected"] += 1
+            return False
+
+        depth = self.queue_depth()
+        with self._stats_lock:
+            self._stats["enqueued"] += 1
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], depth)
+        return True
+
+    def start(self):
+        """
+        Запускает потоки дорожек (один раз).
+        """
+        if self._threads:
+            return
+        with self._start_lock:
+            if self._threads:
+                return
+            for i, lane in enumerate(self._lanes):
+                t = threading.Thread(
+                    target=self._worker_loop,
+                    args=(lane,),
+                    name=f"{self.name}-{i}",
+                    daemon=True,
+                )
+                t.start()
+                self._threads.append(t)
+
+    def queue_depth(self) -> int:
+        return sum(lane.qsize() for lane in self._lanes)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            result = dict(self._stats)
+
+        done = result["processed"] + result["errors"]
+        depths = [lane.qsize() for lane in self._lanes]
+        result["queue_depth"] = sum(depths)
+        result["busiest_lane_depth"] = max(depths)
+        result["workers"] = self.workers
+        result["wait_seconds_avg"] = result["wait_seconds_total"] / done if done else 0.0
+        result["handle_seconds_avg"] = result["handle_seconds_total"] / done if done else 0.0
+        return result
+
+    # ------- внутреннее -------
+
+    def _lane_index(self, item) -> int:
+        try:
+            key = self.key(item)
+        except Exception:
+            key = None
+
+        if key is None:
+            # без ключа порядок не важен — по кругу
+            with self._stats_lock:
+                self._next_lane = (self._next_lane + 1) % self.workers
+                return self._next_lane
+        return hash(key) % self.workers
+
+    def _worker_loop(self, lane):
+        while True:
+            enqueued_at, item = lane.get()
+            started = time.monotonic()
+            ok = True
+            try:
+                self.handle(item)
+            except Exception as e:
+                ok = False
+                print(f"⚠️ {self.name}: ошибка обработки: {e}")
+                traceback.print_exc()
+            finally:
+                lane.task_done()
+
+            handled = time.monotonic() - started
+            if handled > SLOW_HANDLE_SECONDS:
+                print(f"⚠️ {self.name}: хендлер занял дорожку на {handled:.1f} с")
+            self._record(started - enqueued_at, handled, ok)
+
+    def _record(self, waited: float, handled: float, ok: bool):
+        with self._stats_lock:
+            self._stats["processed" if ok else "errors"] += 1
+            self._stats["wait_seconds_total"] += waited
+            self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], waited)
+            self._stats["handle_seconds_total"] += handled
+            self._stats["handle_seconds_max"] = max(self._stats["handle_seconds_max"], handled)
+            if handled > SLOW_HANDLE_SECONDS:
+                self._stats["slow_handles"] += 1
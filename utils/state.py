@@ -1,5 +1,8 @@
-user_states = {}      # user_id -> state string
-user_sessions = {}    # user_id -> dict
+from utils.state_store import make_state_store
+
+# Хранилища на бэкенде из config.STATE_BACKEND (utils/state_store.py)
+user_states = make_state_store("user_states", ttl=24 * 3600)      # user_id -> state string
+user_sessions = make_state_store("user_sessions", ttl=24 * 3600)  # user_id -> dict
 
 
 def set_state(user_id, state):
@@ -15,7 +18,11 @@ def clear_state(user_id):
 
 
 def get_session(user_id):
-    return user_sessions.setdefault(user_id, {})
+    session = user_sessions.get(user_id)
+    if session is None:
+        session = {}
+        user_sessions[user_id] = session
+    return session
 
 
 def save_session(user_id, data: dict):
@@ -0,0 +1,144 @@
+# utils/state_store.py
+#
+# Хранилища состояния диалогов (utils/state, photo_sessions, формат картинки).
+# Бэкенд выбирается в config.STATE_BACKEND:
+#   memory — LRUCache в памяти процесса: TTL + лимит записей,
+#            память ограничена при любом числе пользователей;
+#   sqlite — таблица conversation_state в общей базе: состояние видно всем
+#            процессам (gunicorn) и переживает рестарт.
+# Интерфейс у обоих как у dict: get / [] / pop / in.
+# ВАЖНО: значение — копия. Поменяли словарь сессии — сохраните его обратно
+# (store[key] = session), иначе в sqlite изменения не попадут.
+#
+# Здесь же — TTLHandlerBackend для next-step хендлеров TeleBot.
+
+import json
+import threading
+import time
+
+from telebot.handler_backends import HandlerBackend
+
+from config import STATE_BACKEND, STATE_MAX_ITEMS
+from services.db import get_state_row, set_state_row, pop_state_row, purge_expired_state_rows
+from utils.cache import LRUCache
+
+# Раз в сколько записей чистим протухшие строки в sqlite
+PURGE_EVERY = 1000
+
+_MISSING = object()
+
+
+class MemoryStateStore:
+
+    def __init__(self, namespace: str, ttl=None, max_items=STATE_MAX_ITEMS):
+        self.namespace = namespace
+        self._cache = LRUCache(max_items=max_items, ttl=ttl)
+
+    def get(self, key, default=None):
+        return self._cache.get(key, default)
+
+    def set(self, key, value):
+        self._cache.set(key, value)
+
+    def pop(self, key, default=None):
+        return self._cache.pop(key, default)
+
+    def __getitem__(self, key):
+        value = self._cache.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+class SqliteStateStore:
+
+    def __init__(self, namespace: str, ttl=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        raw = get_state_row(self.namespace, str(key), time.time())
+        return default if raw is None else json.loads(raw)
+
+    def set(self, key, value):
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl else None
+        set_state_row(self.namespace, str(key), json.dumps(value, ensure_ascii=False), expires_at)
+        self._maybe_purge(now)
+
+    def pop(self, key, default=None):
+        raw = pop_state_row(self.namespace, str(key), time.time())
+        return default if raw is None else json.loads(raw)
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __contains__(self, key):
+        return get_state_row(self.namespace, str(key), time.time()) is not None
+
+    def _maybe_purge(self, now):
+        with self._lock:
+            self._writes += 1
+            if self._writes % PURGE_EVERY:
+                return
+        try:
+            purge_expired_state_rows(now)
+        except Exception as e:
+            print(f"⚠️ state purge error: {e}")
+
+
+def make_state_store(namespace: str, ttl=None):
+    """
+    Хранилище для одного вида состояния (namespace) на выбранном бэкенде.
+    """
+    if STATE_BACKEND == "sqlite":
+        return SqliteStateStore(namespace, ttl=ttl)
+    return MemoryStateStore(namespace, ttl=ttl)
+
+
+# =============================================================
+# next-step хендлеры TeleBot
+# =============================================================
+
+class TTLHandlerBackend(HandlerBackend):
+    """
+    Как MemoryHandlerBackend TeleBot, но с TTL и лимитом записей:
+    брошенные на полпути диалоги не копятся вечно.
+    Хендлеры — замыкания (lambda msg: ...), поэтому хранятся только в памяти.
+    """
+
+    def __init__(self, ttl=None, max_items=STATE_MAX_ITEMS):
+        super().__init__(LRUCache(max_items=max_items, ttl=ttl))
+        self._lock = threading.Lock()
+
+    def register_handler(self, handler_group_id, handler):
+        with self._lock:
+            handlers = self.handlers.get(handler_group_id) or []
+            handlers.append(handler)
+            self.handlers.set(handler_group_id, handlers)
+
+    def clear_handlers(self, handler_group_id):
+        self.handlers.pop(handler_group_id, None)
+
+    def get_handlers(self, handler_group_id):
+        return self.handlers.pop(handler_group_id, None)
+
+    def load_handlers(self, filename, del_file_after_loading):
+        raise NotImplementedError()
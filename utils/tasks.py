@@ -1,27 +1,58 @@
 # utils/tasks.py
 
+import os
+import socket
+import threading
+import time
 import uuid
 
-# Готовые изображения, к которым привязана кнопка "Анимировать"
-_animation_tasks = {}  # task_id -> {prompt, image_bytes, user_id}
+from services.db import (
+    add_pending_generation_row,
+    get_pending_generation_rows,
+    lease_pending_generation_rows,
+    claim_pending_generation_row,
+    reschedule_pending_generation_row,
+    delete_pending_generation_row,
+    add_animation_task_row,
+    get_animation_task_row,
+    count_animation_task_rows,
+    purge_animation_task_rows,
+)
 
-# Висящие в генерации NanoBanana задачи
-_pending_generations = {}  # nb_task_id -> {user_id, chat_id, prompt, model}
+# Готовые изображения, к которым привязана кнопка "Анимировать".
+# Кнопке нужен только prompt (и ссылка на картинку), сами байты картинки
+# не храним. Записи живут в SQLite (таблица animation_tasks): кнопку
+# могут нажать после рестарта или в другом процессе gunicorn.
+# Старше ANIMATION_TASKS_TTL — не отдаём и раз в PURGE_EVERY записей удаляем.
+ANIMATION_TASKS_TTL = 24 * 3600
+PURGE_EVERY = 500
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "writes": 0}
+
+# Висящие в генерации NanoBanana задачи живут в SQLite (services/db.py,
+# таблица pending_generations): переживают рестарт и видны всем процессам.
 
 
 # --------- Для анимации (готовые картинки) ---------
 
-def create_task(prompt, image_bytes, user_id):
+def create_task(prompt, user_id, image_url=None):
     """
     Создаёт задачу для дальнейшей анимации.
     Возвращает внутренний task_id, который уходит в callback "animate:<task_id>".
     """
     task_id = str(uuid.uuid4())
-    _animation_tasks[task_id] = {
-        "prompt": prompt,
-        "image_bytes": image_bytes,
-        "user_id": user_id,
-    }
+    now = time.time()
+    add_animation_task_row(task_id, user_id, prompt, image_url, now)
+
+    with _stats_lock:
+        _stats["writes"] += 1
+        purge = _stats["writes"] % PURGE_EVERY == 0
+    if purge:
+        try:
+            purge_animation_task_rows(now - ANIMATION_TASKS_TTL)
+        except Exception as e:
+            print(f"⚠️ animation tasks purge error: {e}")
     return task_id
 
 
@@ -29,37 +60,75 @@ def get_task(task_id):
     """
     Возвращает задачу по task_id или None.
     """
-    return _animation_tasks.get(task_id)
+    task = get_animation_task_row(task_id, time.time() - ANIMATION_TASKS_TTL)
+    with _stats_lock:
+        _stats["hits" if task is not None else "misses"] += 1
+    return task
+
+
+def animation_tasks_stats() -> dict:
+    """
+    hits / misses по хранилищу задач анимации и сколько записей в базе.
+    """
+    with _stats_lock:
+        result = dict(_stats)
+    lookups = result["hits"] + result["misses"]
+    result["hit_rate"] = result["hits"] / lookups if lookups else 0.0
+    result["items"] = count_animation_task_rows()
+    return result
 
 
 # --------- Для очереди NanoBanana (без ожидания) ---------
 
+def worker_id() -> str:
+    """
+    Кто держит аренду: один id на процесс. Считаем при каждом вызове —
+    при gunicorn --preload воркеры форкаются после импорта модуля.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
 def add_pending_generation(nb_task_id: str, user_id: int, chat_id: int, prompt: str, model: str):
     """
     Регистрирует задачу, которая сейчас генерится на стороне NanoBanana.
     """
-    _pending_generations[nb_task_id] = {
-        "user_id": user_id,
-        "chat_id": chat_id,
-        "prompt": prompt,
-        "model": model,
-    }
+    add_pending_generation_row(nb_task_id, user_id, chat_id, prompt, model, time.time())
 
 
 def get_all_pending_generations():
     """
     Возвращает список всех задач в очереди в виде удобного списка словарей.
     """
-    result = []
-    for nb_task_id, info in _pending_generations.items():
-        item = {"nb_task_id": nb_task_id}
-        item.update(info)
-        result.append(item)
-    return result
+    return get_pending_generation_rows()
+
+
+def lease_pending_generations(limit: int, lease_seconds: float = 120, owner: str = None):
+    """
+    Забирает в аренду задачи, которые пора опрашивать (не больше limit).
+    Другие воркеры не увидят их, пока аренда не истечёт или не снята.
+    """
+    return lease_pending_generation_rows(owner or worker_id(), time.time(), lease_seconds, limit)
+
+
+def claim_pending_generation(nb_task_id: str, lease_seconds: float = 120, owner: str = None) -> bool:
+    """
+    Застолбить доставку результата на lease_seconds. False — задачу уже
+    доставляет кто-то другой. Если доставка не завершилась (процесс умер),
+    после аренды задачу снова заберёт воркер.
+    """
+    return claim_pending_generation_row(nb_task_id, owner or worker_id(), time.time() + lease_seconds)
+
+
+def reschedule_pending_generation(nb_task_id: str, next_poll_at: float):
+    """
+    Откладывает следующий опрос задачи до next_poll_at (unix time),
+    возвращает её в 'pending' и снимает аренду.
+    """
+    reschedule_pending_generation_row(nb_task_id, next_poll_at)
 
 
 def remove_pending_generation(nb_task_id: str):
     """
     Удаляет задачу из очереди ожидания по её NanoBanana taskId.
     """
-    _pending_generations.pop(nb_task_id, None)
+    delete_pending_generation_row(nb_task_id)
@@ -1,10 +1,11 @@
-import time
-import requests
 import uvicorn
-import jwt  # pip install PyJWT
 from fastapi import FastAPI, Form
 from fastapi.middleware.cors import CORSMiddleware
 
+from services.kling_auth import get_token_provider
+from services.kling_service import parse_kling_task
+from services.http_pool import get_session
+
 # ===========================
 # KLING KEYS (ТВОИ)
 # ===========================
@@ -18,6 +19,9 @@ BASE = "https://api-singapore.klingai.com/v1"
 KLING_EFFECTS_URL = f"{BASE}/videos/effects"      # создание задачи
 KLING_TASK_URL = f"{BASE}/videos/effects"        # проверка статуса
 
+# Общий пул соединений к Kling (тот же, что у бота)
+_session = get_session("kling")
+
 # ===========================
 # FastAPI app
 # ===========================
@@ -41,18 +45,8 @@ DEMO_IMAGES = {
 
 
 def generate_kling_jwt(ak: str, sk: str) -> str:
-    """JWT как в официальном примере Kling"""
-    headers = {"alg": "HS256", "typ": "JWT"}
-    now = int(time.time())
-    payload = {
-        "iss": ak,
-        "exp": now + 1800,
-        "nbf": now - 5,
-    }
-    token = jwt.encode(payload, sk, algorithm="HS256", headers=headers)
-    if isinstance(token, bytes):
-        token = token.decode("utf-8")
-    return token
+    """JWT как в официальном примере Kling (кэшируется до ~истечения, общий с ботом)"""
+    return get_token_provider(ak, sk).get_token()
 
 
 @app.post("/api/kling_effect")
@@ -85,7 +79,7 @@ async def kling_effect(
         "Content-Type": "application/json",
     }
 
-    resp = requests.post(KLING_EFFECTS_URL, json=payload, headers=headers, timeout=60)
+    resp = _session.post(KLING_EFFECTS_URL, json=payload, headers=headers, timeout=60)
 
     if not resp.ok:
         return {
@@ -107,6 +101,7 @@ def kling_task_status(task_id: str):
     """
     Проверяем статус эффекта:
     GET /v1/videos/effects/{task_id}
+    status / video_url разбираются тем же парсером, что и в боте.
     """
     api_token = generate_kling_jwt(AK, SK)
 
@@ -117,7 +112,7 @@ def kling_task_status(task_id: str):
 
     url = f"{KLING_TASK_URL}/{task_id}"
 
-    resp = requests.get(url, headers=headers, timeout=30)
+    resp = _session.get(url, headers=headers, timeout=30)
 
     if not resp.ok:
         return {
@@ -126,9 +121,14 @@ def kling_task_status(task_id: str):
             "text": resp.text,
         }
 
+    data = resp.json()
+    status, video_url = parse_kling_task(data)
+
     return {
         "ok": True,
-        "kling_raw": resp.json(),
+        "status": status,
+        "video_url": video_url,
+        "kling_raw": data,
     }
 
 